@@ -4,13 +4,16 @@
 import os
 import logging
 import configparser
-from json import JSONEncoder
 from flask import Flask, session, current_app
 from flask_babel import _
 
 # utilities
 from . import log
 from . import db
+from . import archive
+from . import partition
+from . import metrics
+from . import export
 from . import ldap
 from . import otrs
 
@@ -26,6 +29,8 @@ from . import status
 from . import version
 from . import errors
 from . import i18n
+from . import compression
+from . import encoding
 
 # this is so that the notifiers are registered
 from . import notifier_slack
@@ -34,16 +39,6 @@ from . import notifier_slack
 from . import burst
 from . import oldjob
 
-# override default JSON encoder to look for `serializable` method
-def json_encoder_override(self, obj):
-  return getattr(
-    obj.__class__,
-    "serialize",
-    json_encoder_override.default
-  )(obj)
-json_encoder_override.default = JSONEncoder().default
-JSONEncoder.default = json_encoder_override
-
 # static defaults - even empty ones need to exist so that app knows to check
 # the environment
 defaults = {
@@ -62,7 +57,15 @@ defaults = {
   'OTRS_QUEUE': 'Test',
   'OTRS_TICKET_STATE': 'new',
   'BURSTS_USAGE_URI': 'https://localhost/plots/{cluster}/{account}_{resource}.html',
-  'DOCUMENTATION_URI': '#document_link_define'
+  'DOCUMENTATION_URI': '#document_link_define',
+  'API_MAX_DECOMPRESSED_SIZE': 64 * 1024 * 1024,
+  'COMPRESSION_MIN_SIZE': 1024,
+  'TEMPLATE_CACHE_TTL': 300,
+  'ARCHIVE_AFTER_DAYS': 90,
+  'IDEMPOTENCY_WINDOW': 120,
+  'IDEMPOTENCY_LEASE': 3600,
+  'BURST_MIN_PAIN': 1.0,
+  'UPGRADE_ROWS_PER_SECOND': 100000
 }
 
 # optional that may appear in environment or configuration
@@ -177,6 +180,9 @@ def create_app(test_config=None):
   # create Flask app object
   app = Flask(__name__, instance_relative_config=True)
 
+  # encode objects providing a `serialize` method
+  app.json_encoder = encoding.JSONEncoder
+
   # initialize Babel
   i18n.babel.init_app(app)
 
@@ -229,6 +235,9 @@ def create_app(test_config=None):
   # register custom context processor to add custom variables
   app.context_processor(inject_custom_vars)
 
+  # compress responses where appropriate
+  app.after_request(compression.compress_response)
+
   # log startup and version
   log.get_log().info("Application initialized: %s", version.version)
 
@@ -243,3 +252,8 @@ def init_app(app):
   app.cli.add_command(db.init_db_command)
   app.cli.add_command(db.seed_db_command)
   app.cli.add_command(db.upgrade_db_command)
+  app.cli.add_command(archive.archive_cases_command)
+  app.cli.add_command(partition.partition_db_command)
+  app.cli.add_command(partition.maintain_partitions_command)
+  app.cli.add_command(metrics.rollup_metrics_command)
+  app.cli.add_command(export.export_cases_command)
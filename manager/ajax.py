@@ -3,21 +3,26 @@
 #
 import html
 
-from flask import Blueprint, jsonify, request, g, session
+from datetime import datetime
+
+from flask import Blueprint, jsonify, request, g, session, Response, stream_with_context
 from werkzeug.exceptions import BadRequest
 
 from manager.auth import login_required, admin_required
 from manager.log import get_log
 from manager.ldap import get_ldap
-from manager.errors import xhr_error, xhr_success
+from manager.errors import xhr_error, xhr_success, xhr_not_modified
 from manager.otrs import create_ticket, ticket_url
 from manager.apikey import get_apikeys, add_apikey, delete_apikey
 from manager.cluster import Cluster, get_clusters, delete_cluster
 from manager.component import get_components, add_component, delete_component
+from manager.compression import matching_etag
 from manager.template import Template
 from manager.exceptions import ResourceNotFound, BadCall, AppException, LdapException, ResourceNotCreated
 from manager.history import History
-from manager.case import Case, registry
+from manager.case import Case, registry, get_view_etag
+from manager.metrics import get_series
+from manager.export import export_cases, date_to_epoch, FORMATS
 from manager.i18n import get_locale
 
 bp = Blueprint('ajax', __name__, url_prefix='/xhr')
@@ -39,9 +44,14 @@ def _must_have(dct, keys):
   ]
   return missing or None
 
-def _reports_by_cluster(cluster):
+def _reports_by_cluster(cluster, paging=None):
   """
   Collect reports available for given cluster.
+
+  Args:
+    cluster: Cluster of interest.
+    paging: Optional dict of paging criteria applied to each report (see
+      `manager.case.Case.view()`).
   """
 
   # trivial response structure
@@ -53,12 +63,71 @@ def _reports_by_cluster(cluster):
   get_log().debug("Starting to look through reports for cluster %s", cluster)
   for name, reporter in registry.reporters.items():
     get_log().debug("Getting view from %s reporter", name)
-    report = reporter.view({'cluster':cluster, 'pretty': True})
+    report = reporter.view(dict(paging or {}, cluster=cluster, pretty=True))
     if report:
       reports[name] = report
 
   return reports
 
+def _datatables_criteria(args):
+  """
+  Interpret DataTables server-side processing parameters as view criteria.
+
+  Columns are identified by the `name` given each column, which is expected
+  to be the data field name described by the report.  Columns DataTables
+  flags as unsearchable or unorderable are ignored.
+
+  See https://datatables.net/manual/server-side for a description of the
+  parameters.
+
+  Args:
+    args: Request arguments.
+
+  Returns:
+    Dict of paging criteria for `manager.case.Case.view()`.
+
+  Raises:
+    BadCall: A parameter cannot be interpreted.
+  """
+  criteria = {
+    'start': args.get('start', 0),
+    'length': args.get('length', -1)
+  }
+
+  # determine column names and their search values
+  names = []
+  columns = {}
+  while 'columns[{}][name]'.format(len(names)) in args:
+    i = len(names)
+    name = args['columns[{}][name]'.format(i)]
+    names.append(name)
+    value = args.get('columns[{}][search][value]'.format(i), '')
+    if value and args.get('columns[{}][searchable]'.format(i)) != 'false':
+      columns[name] = value
+  if columns:
+    criteria['columns'] = columns
+
+  # determine ordering
+  order = []
+  while 'order[{}][column]'.format(len(order)) in args:
+    i = len(order)
+    try:
+      name = names[int(args['order[{}][column]'.format(i)])]
+    except (ValueError, IndexError):
+      raise BadCall("Invalid order column: {}".format(args['order[{}][column]'.format(i)]))
+    order.append((name, args.get('order[{}][dir]'.format(i), 'asc')))
+  if order:
+    criteria['order'] = order
+
+  if args.get('search[value]'):
+    criteria['search'] = args['search[value]']
+
+  # filters on summary values are not part of the DataTables protocol
+  if args.get('summary'):
+    criteria['summary'] = args['summary']
+
+  return criteria
+
 def _get_project_pi(account):
 
   # initialize
@@ -285,13 +354,78 @@ def xhr_delete_component(id):
 @bp.route('/cases/', methods=['GET'])
 @login_required
 def xhr_get_cases():
+  """
+  Return the current cases for a cluster.
+
+  Without further parameters, returns the full view of every report for the
+  cluster.  With `start` and/or `length`, only that page of each report is
+  returned along with the total number of cases of each.  With `report`,
+  returns a page of only that report as requested using DataTables
+  server-side processing parameters, optionally filtered on summary values
+  by `summary` (such as `num_jobs>100`, see
+  `manager.case.parse_summary_filters()`), in the format:
+
+  ```
+  {
+    draw: <DataTables draw counter, as given>,
+    recordsTotal: <number of current cases>,
+    recordsFiltered: <number of current cases matching search criteria>,
+    epoch: <epoch of current cases>,
+    results: [ <case>, ... ]
+  }
+  ```
+  """
   get_log().debug("Retrieving cases")
   if 'cluster' not in request.args:
     return xhr_error(400, "No cluster specified when requesting reports")
 
   # get cluster information
   cluster = request.args['cluster']
-  return jsonify(_reports_by_cluster(cluster))
+
+  if 'report' in request.args and request.args['report'] not in registry.reporters:
+    return xhr_error(400, "Requested report not recognized")
+
+  # answer conditional requests without building the view.  Views are
+  # localized and DataTables' draw counter is echoed, so the tag must
+  # differ accordingly
+  etag = get_view_etag(cluster,
+    [request.args['report']] if 'report' in request.args else registry.reporters,
+    get_locale(), sorted(request.args.items(multi=True)))
+  matched = matching_etag(etag)
+  if matched:
+    return xhr_not_modified(matched)
+
+  if 'report' not in request.args:
+    paging = {
+      k: v for (k, v) in request.args.items() if k in ('start', 'length')
+    }
+    try:
+      response = jsonify(_reports_by_cluster(cluster, paging))
+    except BadCall as e:
+      return xhr_error(400, "Client error: %s", e)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+  # serve page of requested report
+  reporter = registry.reporters[request.args['report']]
+  try:
+    criteria = _datatables_criteria(request.args)
+    draw = int(request.args.get('draw', 0))
+    view = reporter.view(dict(criteria, cluster=cluster, pretty=True))
+  except (BadCall, ValueError) as e:
+    return xhr_error(400, "Client error: %s", e)
+
+  response = jsonify({
+    'draw': draw,
+    'recordsTotal': view['total'] if view else 0,
+    'recordsFiltered': view['filtered'] if view else 0,
+    'epoch': view['epoch'] if view else None,
+    'results': view['results'] if view else []
+  })
+  response.set_etag(etag)
+  response.cache_control.no_cache = True
+  return response
 
 @bp.route('/cases/<int:id>', methods=['GET'])
 @login_required
@@ -398,8 +532,163 @@ def xhr_update_case(id):
 def xhr_get_case_events(id):
 
   get_log().debug("Retrieving events for case %d", id)
-  events = History.get_events(id)
-  return jsonify(events), 200
+
+  # without a limit, all events are returned, oldest first
+  if 'limit' not in request.args:
+    events = History.get_events(id)
+    return jsonify(events), 200
+
+  try:
+    (events, following) = History.get_events_page(id,
+      int(request.args['limit']), request.args.get('before'))
+  except (BadCall, ValueError) as e:
+    return xhr_error(400, "Client error: %s", e)
+  return jsonify({
+    'events': events,
+    'next': following
+  }), 200
+
+@bp.route('/cases/<int:id>/series', methods=['GET'])
+@login_required
+def xhr_get_case_series(id):
+  """
+  Return the time series of a case's primary metric.  The resolution may be
+  given as `resolution` (`raw`, `hour` or `day`) and is otherwise chosen to
+  limit the number of points; the range may be limited by `since` and
+  `until`, as epochs.  See `manager.metrics.get_series()`.
+
+  ```
+  {
+    metric: <field>,
+    resolution: <resolution>,
+    series: [ [ <epoch>, <value> ], ... ]
+  }
+  ```
+
+  Points of rollups are given as `[ <bucket>, <mean>, <low>, <high> ]`.
+  """
+  get_log().debug("Retrieving metric series for case %d", id)
+
+  case = Case.get(id)
+  if not case:
+    return xhr_error(404, f"Could not find case with ID {id}")
+  if not case._metric:
+    return xhr_error(400, f"Case {id} has no metric")
+
+  try:
+    (resolution, series) = get_series(id,
+      request.args.get('resolution') or None,
+      int(request.args.get('since') or 0),
+      int(request.args.get('until') or 0))
+  except (BadCall, ValueError) as e:
+    return xhr_error(400, "Client error: %s", e)
+  return jsonify({
+    'metric': case._metric,
+    'resolution': resolution,
+    'series': series
+  }), 200
+
+# ---------------------------------------------------------------------------
+#                                                              ROUTES - users
+# ---------------------------------------------------------------------------
+
+@bp.route('/users/<string:uid>/cases', methods=['GET'])
+@login_required
+def xhr_get_user_cases(uid):
+  """
+  Return the cases involving a user, such as by submitting the jobs of a
+  burst, on any cluster.  Archived cases are not included.  Cases are grouped
+  by report and only reports with cases involving the user are included:
+
+  ```
+  {
+    user: <uid>,
+    <report>: [ <case>, ... ],
+    ...
+  }
+  ```
+  """
+  get_log().debug("Retrieving cases involving user %s", uid)
+
+  cases = {
+    'user': uid
+  }
+  for name, reporter in registry.reporters.items():
+    found = reporter.get_for_user(uid)
+    if found:
+      cases[name] = [case.serialize(pretty=True) for case in found]
+
+  return jsonify(cases), 200
+
+# ---------------------------------------------------------------------------
+#                                                             ROUTES - search
+# ---------------------------------------------------------------------------
+
+@bp.route('/search/', methods=['GET'])
+@login_required
+def xhr_search_accounts():
+  """
+  Return the cases of accounts beginning with the prefix given by `account`,
+  on any cluster.  Archived cases are not included, and at most
+  `manager.case.SEARCH_LIMIT` cases of each report are returned.  Cases are
+  grouped by report and only reports with matching cases are included:
+
+  ```
+  {
+    account: <prefix>,
+    <report>: [ <case>, ... ],
+    ...
+  }
+  ```
+  """
+  prefix = request.args.get('account', '').strip()
+  if not prefix:
+    return xhr_error(400, "No account specified for search")
+  get_log().debug("Searching for cases of accounts beginning with %s", prefix)
+
+  cases = {
+    'account': prefix
+  }
+  for name, reporter in registry.reporters.items():
+    found = reporter.find_by_account(prefix)
+    if found:
+      cases[name] = [case.serialize(pretty=True) for case in found]
+
+  return jsonify(cases), 200
+
+# ---------------------------------------------------------------------------
+#                                                             ROUTES - export
+# ---------------------------------------------------------------------------
+
+@bp.route('/export/', methods=['GET'])
+@login_required
+def xhr_export_cases():
+  """
+  Export cases of the type given by `type` with their history, as CSV or
+  NDJSON according to `format` (CSV by default), for cases last reported
+  from the date `since` up to the date `until` (as YYYY-MM-DD, UTC).  The
+  export may be limited to clusters given by any number of `cluster`
+  parameters.  The export is streamed as it is read from the database.  See
+  `manager.export`.
+  """
+  fmt = request.args.get('format', 'csv')
+  try:
+    since = date_to_epoch(datetime.strptime(request.args['since'], '%Y-%m-%d'))
+    until = date_to_epoch(datetime.strptime(request.args['until'], '%Y-%m-%d'))
+    chunks = export_cases(request.args.get('type'), since, until,
+      request.args.getlist('cluster'), fmt)
+  except KeyError as e:
+    return xhr_error(400, "Missing parameter: %s", e)
+  except (BadCall, ValueError) as e:
+    return xhr_error(400, "Client error: %s", e)
+  get_log().info("Exporting %s from %s to %s", request.args['type'],
+    request.args['since'], request.args['until'])
+
+  filename = '{}-{}-{}.{}'.format(request.args['type'], request.args['since'],
+    request.args['until'], fmt)
+  return Response(stream_with_context(chunks), mimetype=FORMATS[fmt], headers={
+    'Content-Disposition': 'attachment; filename="{}"'.format(filename)
+  })
 
 # ---------------------------------------------------------------------------
 #                                                          ROUTES - templates
@@ -4,16 +4,24 @@
 import functools
 import time
 import email.utils
+from collections.abc import Iterator
 from flask import (
-    Blueprint, request, abort, session, jsonify
+    Blueprint, current_app, request, abort, session, jsonify
 )
-from manager.errors import xhr_error
+from manager.errors import xhr_error, xhr_not_modified
 from manager.log import get_log
 from manager.apikey import ApiKey
 from manager.component import Component
+from manager.compression import iter_body, spool_body, matching_etag
+from manager.jsonstream import ObjectStream, JsonStreamError
+from manager.encoding import (
+  MSGPACK, MsgpackDecodeError,
+  request_encoding, response_encoding, encode_response, msgpack_members
+)
 from manager.event import report, ReportReceived
-from manager.exceptions import InvalidApiCall
-from manager.case import registry, Case
+from manager.exceptions import BadCall, InvalidApiCall
+from manager.case import registry, Case, get_view_etag, get_report_epochs
+from manager import ledger, burstscore
 
 # establish blueprint
 bp = Blueprint('api', __name__, url_prefix='/api')
@@ -26,6 +34,14 @@ bp = Blueprint('api', __name__, url_prefix='/api')
 # reported by the Detector.
 API_VERSION = 2
 
+# API version of delta reports, which give only the cases added, changed or
+# resolved since a report acknowledged by the server.  Accepted alongside
+# full reports of `API_VERSION`.
+DELTA_API_VERSION = 3
+
+# members of delta reports which are not report sections
+DELTA_MEMBERS = ('base', 'resolved')
+
 # ---------------------------------------------------------------------------
 #                                                            ERROR HANDLERS
 # ---------------------------------------------------------------------------
@@ -45,6 +61,16 @@ def forbidden(error):
   get_log().error("Forbidden (error = %s)", error)
   return jsonify({'error': str(error)}), 403
 
+@bp.errorhandler(413)
+def toolarge(error):
+  get_log().error("Request entity too large (error = %s)", error)
+  return jsonify({'error': str(error)}), 413
+
+@bp.errorhandler(415)
+def unsupported(error):
+  get_log().error("Unsupported media type (error = %s)", error)
+  return jsonify({'error': str(error)}), 415
+
 @bp.errorhandler(500)
 def servererror(error):
   get_log().error("Server error (error = %s)", error)
@@ -54,10 +80,129 @@ def servererror(error):
 #                                                                    HELPERS
 # ---------------------------------------------------------------------------
 
-def items_except(d, unkeys):
-  for k, v in d.items():
-    if k not in unkeys:
-      yield k, v
+def _process_report(report_name, report_data, cluster, epoch, events, typed=False):
+  """
+  Hand a report section to the appropriate reporter.  Nothing is committed.
+
+  Args:
+    report_name: Name of the report type.
+    report_data: Iterable of records reported.
+    cluster: Reporting cluster.
+    epoch: Epoch of report.
+    events: List to which the event of the section's receipt is added, to be
+      reported once the report is committed.
+    typed: Whether records are to be checked against the reporter's report
+      schema, as for MessagePack reports.
+
+  Returns:
+    An error response if the report could not be processed, otherwise None.
+  """
+  # pending jobs are scored here and reported as bursts
+  if report_name == burstscore.SECTION:
+    if not burstscore.available():
+      return xhr_error(501, "Report type %s requires NumPy, which is not installed", report_name)
+    try:
+      report_data = burstscore.score_jobs(report_data, epoch)
+    except InvalidApiCall as e:
+      return xhr_error(400, "Does not conform to API for report type %s: %s", report_name, e)
+    (report_name, typed) = ('bursts', False)
+
+  try:
+    reporter = registry.reporters[report_name]
+  except KeyError as e:
+    return xhr_error(400, "Unrecognized report type: %s", report_name)
+
+  if typed:
+    report_data = (reporter.decode_record(record) for record in report_data)
+
+  try:
+    summary = reporter.report(cluster, epoch, report_data)
+  except InvalidApiCall as e:
+    return xhr_error(400, "Does not conform to API for report type %s: %s", report_name, e)
+
+  # invalidate views of these cases
+  reporter.bump_version(cluster, epoch)
+
+  # report that, um, report was received
+  events.append(ReportReceived("{} on {}: {}".format(report_name, cluster, summary)))
+  return None
+
+def _check_base(base, cluster):
+  """
+  Check the base of a delta report against the latest reports received from
+  the cluster.  A detector whose base is not the latest report, such as
+  after a report was lost, must resynchronize by sending a full report.
+
+  Args:
+    base: Dict of report names to the epochs of the reports on which the
+      delta report is based, or None where the report is full.
+    cluster: Reporting cluster.
+
+  Returns:
+    An error response if the report cannot be applied, otherwise None.  A
+    report on a stale base is answered with status 409 and the epochs of
+    the latest reports.
+  """
+  if not isinstance(base, dict):
+    return xhr_error(400, "API violation: 'base' must map report types to epochs")
+  for (report_name, epoch) in base.items():
+    if report_name not in registry.reporters:
+      return xhr_error(400, "Unrecognized report type: %s", report_name)
+    if epoch is not None and not isinstance(epoch, int):
+      return xhr_error(400, "API violation: invalid base epoch for %s", report_name)
+
+  latest = get_report_epochs(cluster, base)
+  stale = sorted(name for (name, epoch) in base.items()
+    if epoch is not None and epoch != latest[name])
+  if stale:
+    get_log().info("Delta report from %s based on stale %s (latest: %s); resynchronizing",
+      cluster, ', '.join(stale), latest)
+    return (encode_response({
+      'status': 409,
+      'detail': "Report base is not the latest for {}".format(', '.join(stale)),
+      'epochs': latest
+    }), 409)
+  return None
+
+def _carry_forward(base, resolved, cluster, epoch):
+  """
+  Carry forward the cases unchanged since the base of a delta report.
+
+  Args:
+    base: Dict of report names to the epochs of the reports on which the
+      delta report is based, as checked by `_check_base()`.
+    resolved: Dict of report names to lists of records of resolved cases,
+      which are checked against the reporter's report schema.
+    cluster: Reporting cluster.
+    epoch: Epoch of report.
+
+  Returns:
+    Tuple (error, count) where error is an error response if the cases could
+    not be carried forward, otherwise None, and count is the number of cases
+    carried forward.
+  """
+  if not isinstance(resolved, dict):
+    return (xhr_error(400, "API violation: 'resolved' must map report types to records"), 0)
+  for report_name in resolved:
+    if report_name not in base:
+      return (xhr_error(400, "API violation: resolved %s not in base", report_name), 0)
+
+  count = 0
+  for (report_name, base_epoch) in base.items():
+    reporter = registry.reporters[report_name]
+    if base_epoch is not None:
+      records = resolved.get(report_name) or []
+      try:
+        if not isinstance(records, list):
+          raise InvalidApiCall("Resolved records must be a list")
+        records = [reporter.decode_record(record) for record in records]
+        count += reporter.carry_forward(cluster, base_epoch, epoch, records)
+      except InvalidApiCall as e:
+        return (xhr_error(400, "Does not conform to API for report type %s: %s", report_name, e), 0)
+
+    # acknowledge the report as the base of the next
+    reporter.bump_version(cluster, epoch)
+  return (None, count)
 
 def api_key_required(view):
   @functools.wraps(view)
@@ -155,7 +300,7 @@ def api_get_case(id):
   case = Case.get(id)
   if not case:
     return xhr_error(404, "No case found matching ID %d", id)
-  return jsonify(case)
+  return encode_response(case)
 
 @bp.route('/cases/', methods=['GET'])
 @api_key_required
@@ -163,6 +308,9 @@ def api_get_cases():
   """
   Use this API to get list of burst candidates accepted for promotion to the
   burst pool.
+
+  Cases of a report may be filtered on their summary values with `summary`,
+  such as `summary=num_jobs>100` (see `manager.case.parse_summary_filters()`).
   """
 
   cluster = Component(session['api_component']).cluster
@@ -175,6 +323,7 @@ def api_get_cases():
   for k, v in request.args.items():
     if k == "report":
       report_specified = True
+      report_name = v
       reporter = registry.reporters[v]
     else:
       criteria[k] = v
@@ -184,8 +333,21 @@ def api_get_cases():
   if not reporter:
     return xhr_error(400, "Requested report not recognized")
 
-  cases = reporter.view(criteria=criteria)
-  return jsonify(cases), 200
+  # answer conditional requests without building the view
+  etag = get_view_etag(cluster, [report_name], sorted(criteria.items()),
+    response_encoding())
+  matched = matching_etag(etag)
+  if matched:
+    return xhr_not_modified(matched)
+
+  try:
+    cases = reporter.view(criteria=criteria)
+  except BadCall as e:
+    return xhr_error(400, "Client error: %s", e)
+  response = encode_response(cases)
+  response.set_etag(etag)
+  response.cache_control.no_cache = True
+  return response, 200
 
 @bp.route('/cases/', methods=['POST'])
 @api_key_required
@@ -220,49 +382,204 @@ def api_post_cases():
   well as jobs where their age is of potential concern.  Each of these would
   be handled by a subclass of the Reporter base class.
 
+  Rather than scoring burst candidates itself, a Detector may report the
+  cluster's pending jobs in a `pending_jobs` section, from which the Manager
+  scores the candidates and reports them as bursts (see `manager.burstscore`).
+
+  Most cases are unchanged from one report to the next, so Detectors may
+  instead send delta reports (version 3) giving only the cases added or
+  changed since a report acknowledged by the server, along with the cases
+  resolved since then:
+
+  ```
+  report = {
+    version = 3,
+    base = { bursts = 1700000000, oldjobs = null },
+    bursts = [ ... ],
+    resolved = { bursts = [ ... ] }
+  }
+  ```
+
+  Each report type covered by the report is named in `base` with the epoch of
+  the report on which the delta is based, or null for a full report.  Added
+  and changed cases are reported as in version 2.  Resolved cases are given
+  by their records as last reported, although only the fields identifying
+  the case are required (see `Case.resolved_query()`).  All other cases
+  current at the base epoch are carried forward to the epoch of the report.
+  Reports are answered with the epochs of the reports, which are the bases
+  of the next ones:
+
+  ```
+  response = {
+    status = 201,
+    epochs = { bursts = 1700000600, oldjobs = 1700000600 }
+  }
+  ```
+
+  A delta report whose base is not the latest report received is refused
+  with status 409 and the epochs of the latest reports, and the Detector
+  must resynchronize by sending full reports for the report types concerned.
+
+  Reports are JSON by default but may be MessagePack-encoded, as indicated by
+  the `Content-Type` header.  See `manager.encoding`.
+
   The Detector does not need to report the cluster where the detection occurs,
   since this information is associated with the API key the Detector uses.
   The Manager still needs to save this with the record.
+
+  Reports are recorded in a ledger so that retried reports are answered with
+  the result of the original rather than processed again.  Reports are
+  recognized by the `Idempotency-Key` header, if given, or otherwise by their
+  payload.  See `manager.ledger`.
   """
 
   epoch = session['api_epoch']
-  cluster = Component(session['api_component']).cluster
+  component = session['api_component']
+  cluster = Component(component).cluster
 
-  # check basic request validity.  At this stage only verify there is data,
-  # that the version is specified and it matches the expected version.
-  data = request.get_json()
-  if (not data
-      or data.get('version', None) is None
-  ):
-    errmsg = "API violation: must define 'version'"
-    get_log().error(errmsg)
-    abort(400, errmsg)
-  if int(data['version']) != API_VERSION:
-    errmsg = "Client API version ({}) does not match server ({})".format(
-      int(data['version']), API_VERSION)
+  errmsg = "API violation: must define 'version'"
+  encoding = request_encoding()
+  if not encoding:
     get_log().error(errmsg)
     abort(400, errmsg)
 
+  # identify report, spooling it to compute its digest if necessary
+  if 'Idempotency-Key' in request.headers:
+    try:
+      key = ledger.idempotency_key(request.headers['Idempotency-Key'])
+    except ValueError as e:
+      abort(400, str(e))
+    body = iter_body()
+  else:
+    (body, digest) = spool_body(iter_body())
+    key = ledger.payload_key(digest)
+
+  # answer retried reports with the original result
+  claimed = ledger.claim(component, key, epoch)
+  if claimed is not True:
+    if claimed.status is None:
+      return xhr_error(409, "Report is already being processed")
+    response = encode_response(claimed.result)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, claimed.status
+
+  # the report is committed as a whole along with its result, or rolled back
+  # and its claim released so that it may be retried
+  events = []
+  try:
+    (result, status) = _ingest_report(body, encoding, cluster, epoch, events)
+  except Exception:
+    ledger.release(component, key)
+    raise
+  if status >= 400:
+    ledger.release(component, key)
+    return result, status
+
+  ledger.complete(component, key, status, result)
+  for event in events:
+    report(event)
+  return encode_response(result), status
+
+def _ingest_report(body, encoding, cluster, epoch, events):
+  """
+  Parse and process a report.  Nothing is committed, so that a report found
+  to be invalid partway through is not partially ingested.
+
+  Args:
+    body: Iterator over chunks of the report.
+    encoding: Media type of the report (see `manager.encoding`).
+    cluster: Reporting cluster.
+    epoch: Epoch of report.
+    events: List to which events to be reported once the report is committed
+      are added.
+
+  Returns:
+    Tuple (result, status) where result is the dict with which to answer the
+    report or, if status indicates an error, the error response.
+  """
+
+  # The report is parsed incrementally and each report section is handed to
+  # its reporter as an iterator over its records, so that the whole report is
+  # never in memory.  The version, and for delta reports the base, must be
+  # verified before anything is processed, so any sections preceding them in
+  # the report are held until they are seen.
+  if encoding == MSGPACK:
+    members = msgpack_members(body)
+  else:
+    members = ObjectStream(body,
+      int(current_app.config['API_MAX_DECOMPRESSED_SIZE'])).members()
+
   # default status is 200 in case there isn't anything actually
   # created/updated
   status = 200
 
-  # run through reports.  For each, invoke appropriate class
-  for report_name, report_data in items_except(data, ('version',)):
+  version = None
+  delta = {}
+  pending = []
+  try:
+    for (report_name, report_data) in members:
+
+      if report_name == 'version':
+        if report_data is None:
+          break
+        version = int(report_data)
+        if version not in (API_VERSION, DELTA_API_VERSION):
+          errmsg = "Client API version ({}) does not match server ({})".format(
+            version, API_VERSION)
+          get_log().error(errmsg)
+          abort(400, errmsg)
+        if version == API_VERSION and delta:
+          return xhr_error(400, "Unrecognized report type: %s", next(iter(delta)))
+      elif report_name in DELTA_MEMBERS and version != API_VERSION:
+        delta[report_name] = list(report_data) \
+          if isinstance(report_data, Iterator) else report_data
+      else:
+        pending.append((report_name, report_data))
+
+      if version is None or (version == DELTA_API_VERSION and 'base' not in delta):
+        if pending and isinstance(pending[-1][1], Iterator):
+          get_log().debug("Holding report section %s until version and base are known", pending[-1][0])
+          pending[-1] = (pending[-1][0], list(pending[-1][1]))
+        continue
+
+      # check the base once both it and the version are known
+      if version == DELTA_API_VERSION and report_name in ('version', 'base'):
+        error = _check_base(delta['base'], cluster)
+        if error:
+          return error
+
+      # run through reports.  For each, invoke appropriate class
+      (sections, pending) = (pending, [])
+      for (section_name, section_data) in sections:
+        error = _process_report(section_name, section_data, cluster, epoch,
+          events, typed=encoding == MSGPACK)
+        if error:
+          return error
+        status = 201
+
+  except (JsonStreamError, MsgpackDecodeError) as e:
+    errmsg = "Could not parse report: {}".format(e)
+    get_log().error(errmsg)
+    abort(400, errmsg)
 
-    try:
-      reporter = registry.reporters[report_name]
-    except KeyError as e:
-      return xhr_error(400, "Unrecognized report type: %s", report_name)
+  if version is None:
+    errmsg = "API violation: must define 'version'"
+    get_log().error(errmsg)
+    abort(400, errmsg)
 
-    try:
-      summary = reporter.report(cluster, epoch, report_data)
-    except InvalidApiCall as e:
-      return xhr_error(400, "Does not conform to API for report type %s: %s", report_name, e)
+  if version == API_VERSION:
+    return ({'status': status}, status)
 
-    # report that, um, report was received
-    report(ReportReceived("{} on {}: {}".format(report_name, cluster, summary)))
+  if 'base' not in delta:
+    errmsg = "API violation: must define 'base'"
+    get_log().error(errmsg)
+    abort(400, errmsg)
 
+  # carry forward the cases not given by the delta report
+  (error, count) = _carry_forward(delta['base'], delta.get('resolved') or {},
+    cluster, epoch)
+  if error:
+    return error
+  if count:
     status = 201
-
-  return jsonify({'status': status}), status
+  return ({'status': status, 'epochs': dict.fromkeys(delta['base'], epoch)}, status)
@@ -3,6 +3,7 @@
 #
 import hmac
 import base64
+from email.utils import formatdate
 from manager.db import get_db
 from manager.log import get_log
 from manager.exceptions import DatabaseException, BadCall
@@ -83,6 +84,56 @@ APIKEY_UPDATE_LAST_USED = '''
 #                                                                   helpers
 # ---------------------------------------------------------------------------
 
+def make_digest(secret, message):
+  """
+  Create the request digest for the given message using the given secret.
+  This is the HMAC-SHA256 of the message, base64-encoded.
+
+  Args:
+    secret: The API key's secret, as string or bytes.
+    message: The string to digest.  See `sign_request()`.
+
+  Returns:
+    The digest as a string.
+  """
+  if isinstance(secret, str):
+    secret = secret.encode()
+  h = hmac.new(secret, digestmod='sha256')
+  h.update(message.encode())
+  return base64.b64encode(h.digest()).decode('utf-8')
+
+
+def sign_request(access, secret, method, resource, timestamp=None):
+  """
+  Create the headers needed to sign an API request, as a client would.  This
+  is of use to tools and tests making requests against the API.
+
+  The resource must be given as the server will see it: the path, plus the
+  query string with arguments sorted by name, if any.
+
+  Args:
+    access: The API key's access string.
+    secret: The API key's secret.
+    method: The HTTP method of the request, such as "GET".
+    resource: The resource being requested.
+    timestamp: RFC 2822 datestamp of the request.  Generated if not given.
+
+  Returns:
+    Dict of headers, `Date` and `Authorization`, to include in the request.
+  """
+  # Without "localtime" the timezone is given as "-0000", which the RFC
+  # interprets as nothing being known about the local time zone
+  if timestamp is None:
+    timestamp = formatdate(localtime=True)
+
+  digest = make_digest(secret, "{} {}\n{}".format(method, resource, timestamp))
+
+  return {
+    'Date': timestamp,
+    'Authorization': "BEAM {} {}".format(access, digest)
+  }
+
+
 def get_apikeys(pretty=False):
   """
   Retrieves API keys (access part only).
@@ -183,14 +234,8 @@ class ApiKey():
 
   def verify(self, message, digest):
 
-    # calculate digest
-    h = hmac.new(self.secret.encode(), digestmod='sha256')
-    h.update(message.encode())
-
-    # do they match?
-    verified = base64.b64encode(h.digest()).decode('utf-8') == digest
-
-    return verified
+    # calculate digest and compare
+    return make_digest(self.secret, message) == digest
 
   def update_use(self, lastused):
     db = get_db()
@@ -0,0 +1,252 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint: disable=C0415
+#
+"""
+Retention of cases no longer being reported.
+
+Every report epoch adds to the case tables, so cases which are no longer
+reported are periodically moved, along with their history, to archive tables
+of the same structure (`reportables_archive`, `case_users_archive`,
+`history_archive` and `<table>_archive` for each case type).  This keeps the
+tables queried for current cases small.
+
+A case is archived when it has not been reported within the retention window
+and has neither a claimant nor a ticket.  Cases of the latest report from
+their cluster are never archived.  Archived cases may still be looked up by
+ID along with their history, and are restored to the current tables if
+modified.
+
+Archival is run by the `flask archive-cases` command, which may be scheduled
+with cron or similar.  Cases are moved in batches, each in its own
+transaction, so that the tables are not locked for long.
+"""
+
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from manager.db import get_db
+from manager.log import get_log
+
+# ---------------------------------------------------------------------------
+#                                                               SQL queries
+# ---------------------------------------------------------------------------
+
+## use with `.format(tablename, locking)`
+SQL_SELECT_STALE = '''
+  SELECT    R.id
+  FROM      reportables R
+  INNER JOIN {} B
+  ON        (R.id = B.id)
+  WHERE     R.epoch < ?
+    AND     R.claimant IS NULL
+    AND     R.ticket_id IS NULL
+    AND     NOT EXISTS (
+              SELECT  1
+              FROM    case_versions V
+              WHERE   V.cluster = R.cluster
+                AND   V.casetype = ?
+                AND   V.epoch = R.epoch
+            )
+  ORDER BY  R.id
+  LIMIT     ?{}
+'''
+
+## use with `.format(table)`.  Gives the table's columns without reading any
+## rows.
+SQL_GET_COLUMNS = '''
+  SELECT    *
+  FROM      {}
+  LIMIT     0
+'''
+
+## use with `.format(archive, columns, table, key, placeholders)`.  Copies the
+## rows of the table belonging to the cases being archived.
+SQL_COPY_ARCHIVED = '''
+  INSERT INTO {0} ({1})
+  SELECT    {1}
+  FROM      {2}
+  WHERE     {3} IN ({4})
+'''
+
+## use with `.format(table, key, placeholders)`
+SQL_PURGE_ARCHIVED = '''
+  DELETE FROM {}
+  WHERE     {} IN ({})
+'''
+
+## use with `.format(tablename)`
+SQL_IS_ARCHIVED = '''
+  SELECT  id
+  FROM    {}_archive
+  WHERE   id = ?
+'''
+
+## use with `.format(table, columns, archive, key)`
+SQL_RESTORE = '''
+  INSERT INTO {0} ({1})
+  SELECT    {1}
+  FROM      {2}
+  WHERE     {3} = ?
+'''
+
+## use with `.format(table, key)`
+SQL_DELETE_BY_ID = '''
+  DELETE FROM {}
+  WHERE     {} = ?
+'''
+
+# default number of cases moved in each transaction
+BATCH_SIZE = 1000
+
+# maximum number of case IDs given to a single statement, within the limit on
+# query parameters of older SQLite versions
+MAX_IDS = 500
+
+# ---------------------------------------------------------------------------
+#                                                          module functions
+# ---------------------------------------------------------------------------
+
+def _tables(table):
+  """
+  List the tables holding cases of the given type, as tuples (table, key)
+  where key is the column referencing the case ID, in the order rows must be
+  inserted to satisfy foreign key constraints.
+  """
+  return [
+    ('reportables', 'id'), (table, 'id'), ('case_users', 'case_id'),
+    ('history', 'case_id')
+  ]
+
+def _columns(name):
+  """
+  Give the columns of a table as a comma-separated list.  Rows are copied
+  between tables and their archives by column name, as databases built by
+  upgrade scripts do not have their columns in the same order.
+  """
+  cursor = get_db().execute(SQL_GET_COLUMNS.format(name))
+  return ', '.join(column[0] for column in cursor.description)
+
+def _chunks(ids):
+  """
+  Divide case IDs into lists of at most `MAX_IDS`.
+  """
+  return [ids[i:i + MAX_IDS] for i in range(0, len(ids), MAX_IDS)]
+
+def archive_cases(table, cutoff, batch_size=BATCH_SIZE):
+  """
+  Archive one batch of cases of the given type which have not been reported
+  since the cutoff.
+
+  Args:
+    table: The table of the type of case, as `Case._table`.
+    cutoff: Epoch before which cases were last reported to be archived.
+    batch_size: Maximum number of cases to archive.
+
+  Returns:
+    Number of cases archived.  If this is the batch size, there may be more
+    to archive.
+  """
+  db = get_db()
+
+  # lock selected rows in Postgres so they can't be updated by a report
+  # while being moved; SQLite locks the database on the first write
+  locking = '\n  FOR UPDATE OF R' if db.type == 'postgres' else ''
+
+  # the batch's cases are selected first so that their rows are copied and
+  # deleted by ID, through each table's index on the case ID
+  try:
+    ids = [
+      rec['id'] for rec in db.execute(SQL_SELECT_STALE.format(table, locking),
+        (cutoff, table, batch_size)).fetchall() or []
+    ]
+    count = len(ids)
+    tables = _tables(table)
+    columns = {name: _columns(name + '_archive') for (name, key) in tables} if ids else {}
+    for chunk in _chunks(ids):
+      placeholders = ', '.join('?' * len(chunk))
+      for (name, key) in tables:
+        db.execute(SQL_COPY_ARCHIVED.format(name + '_archive', columns[name], name,
+          key, placeholders), chunk)
+      for (name, key) in reversed(tables):
+        db.execute(SQL_PURGE_ARCHIVED.format(name, key, placeholders), chunk)
+    db.commit()
+  except Exception:
+    db.rollback()
+    raise
+
+  get_log().debug("Archived %d cases from %s", count, table)
+  return count
+
+def is_archived(table, id):
+  """
+  Determine whether a case of the given type has been archived.
+
+  Args:
+    table: The table of the type of case, as `Case._table`.
+    id: The case ID.
+  """
+  return get_db().execute(SQL_IS_ARCHIVED.format(table), (id,)).fetchone() is not None
+
+def restore_case(table, id):
+  """
+  Move an archived case back to the current tables, if it has been archived.
+  Changes are committed.
+
+  Args:
+    table: The table of the type of case, as `Case._table`.
+    id: The case ID.
+
+  Returns:
+    True if the case was restored, or False if it was not archived.
+  """
+  if not is_archived(table, id):
+    return False
+
+  db = get_db()
+  tables = _tables(table)
+  try:
+    for (name, key) in tables:
+      db.execute(SQL_RESTORE.format(name, _columns(name + '_archive'),
+        name + '_archive', key), (id,))
+    for (name, key) in reversed(tables):
+      db.execute(SQL_DELETE_BY_ID.format(name + '_archive', key), (id,))
+    db.commit()
+  except Exception:
+    db.rollback()
+    raise
+
+  get_log().info("Restored archived case %d", id)
+  return True
+
+# ---------------------------------------------------------------------------
+#                                                              CLI commands
+# ---------------------------------------------------------------------------
+
+@click.command('archive-cases')
+@click.option('--days', type=int, default=None,
+  help="Archive cases not reported in this many days (default "
+       "ARCHIVE_AFTER_DAYS from configuration)")
+@click.option('--batch-size', type=int, default=BATCH_SIZE, show_default=True,
+  help="Number of cases archived in each transaction")
+@with_appcontext
+def archive_cases_command(days, batch_size):
+  """Archive cases no longer reported."""
+
+  # the registry imports this module
+  from manager.case import registry
+
+  if days is None:
+    days = int(current_app.config['ARCHIVE_AFTER_DAYS'])
+  if days < 1 or batch_size < 1:
+    raise click.BadParameter("Days and batch size must be positive")
+  cutoff = int(time.time()) - days * 24 * 60 * 60
+
+  for reporter in registry.reporters.values():
+    total = 0
+    while True:
+      count = archive_cases(reporter._table, cutoff, batch_size)
+      total += count
+      if count < batch_size:
+        break
+    click.echo("Archived {} cases from {}".format(total, reporter._table))
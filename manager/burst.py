@@ -1,12 +1,13 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint: disable=W0621,raise-missing-from,import-outside-toplevel
 #
+from bisect import bisect_left, insort
 from flask import current_app
 from flask_babel import _
 from manager.db import get_db, DbEnum
 from manager.log import get_log
 from manager.exceptions import InvalidApiCall, DatabaseException
-from manager.case import Case, registry, just_job_id
+from manager.case import Case, registry, column_setter, just_job_id, PAGING_CRITERIA
 
 # ---------------------------------------------------------------------------
 #                                                                     enums
@@ -49,6 +50,17 @@ SQL_UPDATE_BY_ID = '''
   WHERE     id = ?
 '''
 
+## candidates for continuation by the bursts of a report, with the columns
+## selected by `Burst.find_existing_query()`
+SQL_GET_CANDIDATES = '''
+  SELECT    id, R.account, R.ticks, R.claimant, R.ticket_id, R.ticket_no,
+            B.resource, B.pain, B.submitters, B.state, B.firstjob, B.lastjob
+  FROM      reportables R
+  JOIN      bursts B
+  USING     (id)
+  WHERE     R.cluster = ?
+'''
+
 SQL_GET_BURSTERS = '''
   SELECT    R.cluster, R.account, B.resource, B.pain
   FROM      reportables R
@@ -73,6 +85,83 @@ def make_graphs_links(cluster, account, resource):
   graphs_uri = graphs_base.format(cluster=cluster, account=account, resource=resource)
   return f"<a target='beamplot' href='{graphs_uri}'>{_('Dash.cc')}</a>"
 
+def _jobrange_setter(index):
+  """
+  Create a function setting one end of a burst's job range from the
+  `firstjob` or `lastjob` column, for `Burst._columns`.
+  """
+  def setter(burst, value):
+    # pylint: disable=protected-access
+    try:
+      jobrange = burst._jobrange
+    except AttributeError:
+      jobrange = burst._jobrange = [None, None]
+    jobrange[index] = value
+  return setter
+
+class _BurstMatcher:
+  """
+  In-memory index of a cluster's bursts, matching the bursts of a report to
+  the existing bursts they continue without a query for each.  The bursts of
+  each account and resource are kept sorted by last job, so that the match
+  for a reported job range, a burst whose last job is not before the range's
+  first job (as in `Burst.find_existing_query()`), is found by bisection.
+  Where several bursts qualify, the one ending first is matched.
+
+  Args:
+    cluster: The cluster whose bursts are indexed.
+  """
+
+  def __init__(self, cluster):
+    # (account, resource) -> sorted list of (lastjob, id)
+    self._lastjobs = {}
+    # id -> record of burst
+    self._records = {}
+    for rec in get_db().execute(SQL_GET_CANDIDATES, (cluster,)).fetchall() or []:
+      self._add(dict(rec))
+
+  def _add(self, rec):
+    key = (rec['account'], rec['resource'])
+    insort(self._lastjobs.setdefault(key, []), (rec['lastjob'], rec['id']))
+    self._records[rec['id']] = rec
+
+  def match(self, account, resource, firstjob):
+    """
+    Return the record of the burst continued by a reported job range, or
+    False if there is none.
+    """
+    lastjobs = self._lastjobs.get((account, resource.value))
+    if not lastjobs:
+      return False
+    index = bisect_left(lastjobs, (firstjob,))
+    if index == len(lastjobs):
+      return False
+    return self._records[lastjobs[index][1]]
+
+  def update(self, burst):
+    """
+    Index a burst as created or updated by the report.
+    """
+    # pylint: disable=protected-access
+    old = self._records.get(burst._id)
+    if old:
+      lastjobs = self._lastjobs[(old['account'], old['resource'])]
+      del lastjobs[bisect_left(lastjobs, (old['lastjob'], old['id']))]
+    self._add({
+      'id': burst._id,
+      'account': burst._account,
+      'ticks': burst._ticks,
+      'claimant': burst._claimant,
+      'ticket_id': burst._ticket_id,
+      'ticket_no': burst._ticket_no,
+      'resource': burst._resource.value,
+      'pain': burst._pain,
+      'submitters': ' '.join(burst._submitters),
+      'state': burst._state.value,
+      'firstjob': burst._jobrange[0],
+      'lastjob': burst._jobrange[1],
+    })
+
 # ---------------------------------------------------------------------------
 #                                                               burst class
 # ---------------------------------------------------------------------------
@@ -101,12 +190,37 @@ class Burst(Case):
 
   # class variables
   _table = 'bursts'
+  _enums = {
+    'resource': Resource,
+    'state': State
+  }
+  __slots__ = ('_resource', '_pain', '_jobrange', '_submitters', '_state')
+  _fields = Case._fields + tuple(slot[1:] for slot in __slots__)
+  _columns = dict(Case._columns,
+    resource=column_setter('_resource', Resource),
+    pain=column_setter('_pain'),
+    firstjob=_jobrange_setter(0),
+    lastjob=_jobrange_setter(1),
+    submitters=column_setter('_submitters', str.split),
+    state=column_setter('_state', State),
+  )
+  _report_schema = (
+    ('account', str),
+    ('resource', str),
+    ('pain', (int, float)),
+    ('firstjob', int),
+    ('lastjob', int),
+    ('submitters', list),
+    ('summary', (dict, type(None))),
+  )
+
+  _metric = 'pain'
 
   @classmethod
   def describe_me(cls):
     return {
       'title': _('Burst candidates'),
-      'metric': 'pain',
+      'metric': cls._metric,
       'cols': [
         { 'datum': 'pain',
           'searchable': True,
@@ -190,7 +304,7 @@ class Burst(Case):
     Args:
       cluster: reporting cluster
       epoch: epoch of report (UTC)
-      data: list of dicts describing current instances of potential account
+      data: iterable of dicts describing current instances of potential account
             or job pain or other metrics, as appropriate for the type of
             report.
 
@@ -198,8 +312,21 @@ class Burst(Case):
       String describing summary of report.
     """
 
-    # build list of burst objects from report
-    bursts = []
+    # report event, creating or updating each burst as it is summarized so
+    # that records need not all be held at once
+    return cls.summarize_report(cls._bursts_from_report(cluster, epoch, data))
+
+  @classmethod
+  def _bursts_from_report(cls, cluster, epoch, data):
+    """
+    Yield burst objects for each record in the report, in turn.  Existing
+    bursts continued by those reported are matched with an index of the
+    cluster's bursts loaded once for the report (see `_BurstMatcher`).
+
+    Raises:
+      InvalidApiCall: A record does not conform to the API.
+    """
+    matcher = _BurstMatcher(cluster)
     for burst in data:
 
       # get the submitted data
@@ -225,8 +352,8 @@ class Burst(Case):
       except KeyError as e:
         raise InvalidApiCall("Invalid resource type: {}".format(e))
 
-      # create burst and append to list
-      bursts.append(cls(
+      # create or update burst
+      case = cls(
         cluster=cluster,
         account=account,
         resource=resource,
@@ -234,11 +361,11 @@ class Burst(Case):
         submitters=submitters,
         jobrange=[firstjob, lastjob],
         summary=summary,
-        epoch=epoch
-      ))
-
-    # report event
-    return cls.summarize_report(bursts)
+        epoch=epoch,
+        existing=matcher.match(account, resource, firstjob)
+      )
+      matcher.update(case)
+      yield case
 
   @classmethod
   def view(cls, criteria):
@@ -268,9 +395,9 @@ class Burst(Case):
     """
 
     # superclass can handle base case (give me info about the cluster)
-    # if nothing other than pretty and cluster are in keys, we're good
-    # cluster is required, pretty may be included
-    if set(criteria.keys()) - {'pretty'} == {'cluster'}:
+    # if nothing other than pretty, paging and cluster are in keys, we're good
+    # cluster is required, pretty and paging may be included
+    if set(criteria.keys()) - {'pretty'} - PAGING_CRITERIA == {'cluster'}:
       return super(Burst, cls).view(criteria)
 
     # check that criteria make sense
@@ -297,20 +424,13 @@ class Burst(Case):
 
   def __init__(self, id=None, record=None, cluster=None, epoch=None,
       account=None, resource=Resource.CPU, pain=None, jobrange=None, submitters=None,
-      state=State.PENDING, summary=None, other=None):
+      state=State.PENDING, summary=None, other=None, existing=None):
 
     if id or record:
 
-      # initialize through base class and then make own interpretations
+      # initialize through base class, which interprets columns according to
+      # the schema
       super().__init__(id=id, record=record)
-      self._resource = Resource(self._resource)
-      self._state = State(self._state)
-      self._submitters = self._submitters.split()
-
-      # fix base class's interpretation
-      self._jobrange = [self._firstjob, self._lastjob]
-      del self.__dict__['_firstjob']
-      del self.__dict__['_lastjob']
 
     else:
 
@@ -320,7 +440,8 @@ class Burst(Case):
       self._submitters = submitters
       self._state = state
       self._other = other
-      super().__init__(account=account, cluster=cluster, epoch=epoch, summary=summary)
+      super().__init__(account=account, cluster=cluster, epoch=epoch, summary=summary,
+        existing=existing)
 
   def find_existing_query(self):
     return (
@@ -329,12 +450,26 @@ class Burst(Case):
       ['resource', 'pain', 'submitters', 'state', 'firstjob', 'lastjob']
     )
 
+  @classmethod
+  def resolved_query(cls, record):
+    try:
+      res_raw = record['resource']
+      lastjob = just_job_id(record['lastjob'])
+    except KeyError as e:
+      raise InvalidApiCall("Missing required field: {}".format(e))
+    try:
+      resource = Resource.get(res_raw)
+    except KeyError as e:
+      raise InvalidApiCall("Invalid resource type: {}".format(e))
+    return ("resource = ? AND lastjob = ?", [resource, lastjob])
+
   def update_existing_me(self, rec):
-    self._state = rec['state']
+    self._columns['state'](self, rec['state'])
     self._jobrange[0] = rec['firstjob']
 
     # update list of submitters, prioritizing new submitters
-    self._submitters = self._submitters + [ x for x in rec['submitters'].split() if x not in self._submitters ]
+    reported = set(self._submitters)
+    self._submitters = self._submitters + [ x for x in rec['submitters'].split() if x not in reported ]
 
     affected = get_db().execute(SQL_UPDATE_BY_ID, (
       self._pain, self._jobrange[1], ' '.join(self._submitters), self._id
@@ -0,0 +1,191 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint: disable=import-outside-toplevel
+#
+"""
+Scoring of burst candidates from raw pending job data.
+
+Detectors normally compute the pain, job range and submitters of each burst
+candidate themselves.  Alternatively, they may report the cluster's pending
+jobs and the accounts' allocations in a `pending_jobs` report section, from
+which the Manager scores the candidates and reports them as bursts, so that
+the scoring is done once, here, and follows any change to the formula.
+
+Jobs are given as parallel arrays, one element per job:
+
+```
+pending_jobs = {
+  'jobid':       [ integer job IDs, without any array part ],
+  'account':     [ account names ],
+  'submitter':   [ usernames of submitters ],
+  'resource':    [ resource types ('cpu', 'gpu') ],
+  'submit':      [ epochs (UTC) at which jobs were submitted ],
+  'request':     [ units of the resource requested by each job ],
+  'allocations': { account: { resource: units allocated, ... }, ... }
+}
+```
+
+The pain of an account's jobs for a resource is the work waiting in the
+queue, as requested units times hours waited, per unit allocated.  That is,
+an account whose pending jobs have waited an hour for its whole allocation
+has a pain of 1.  Accounts with a pain of at least `BURST_MIN_PAIN` are
+reported as burst candidates.
+
+Jobs are grouped by account and resource with vectorized NumPy operations,
+so that scoring is proportional to the number of jobs with a small constant,
+and only the candidates are handled individually.  NumPy is optional: if it
+is not installed, reports of pending jobs are refused.  As it is slow to
+import, it is imported when first used rather than with the application.
+"""
+
+from importlib.util import find_spec
+from flask import current_app
+from manager.exceptions import InvalidApiCall
+from manager.burst import Resource
+
+# ---------------------------------------------------------------------------
+#                                                                 constants
+# ---------------------------------------------------------------------------
+
+# name of the report section of pending jobs
+SECTION = 'pending_jobs'
+
+# arrays of the report section, one element per job
+JOB_FIELDS = ('jobid', 'account', 'submitter', 'resource', 'submit', 'request')
+
+# ---------------------------------------------------------------------------
+#                                                                   helpers
+# ---------------------------------------------------------------------------
+
+def _job_arrays(jobs):
+  """
+  Convert the arrays of a report of pending jobs to NumPy arrays.
+
+  Raises:
+    InvalidApiCall: The report does not conform to the API.
+  """
+  import numpy as np
+
+  if not isinstance(jobs, dict):
+    raise InvalidApiCall("Pending jobs must be a map of arrays")
+  try:
+    columns = {field: jobs[field] for field in JOB_FIELDS + ('allocations',)}
+  except KeyError as e:
+    raise InvalidApiCall("Missing required field: {}".format(e))
+
+  if not all(isinstance(columns[field], list) for field in JOB_FIELDS):
+    raise InvalidApiCall("Pending jobs must be a map of arrays")
+  if len({len(columns[field]) for field in JOB_FIELDS}) != 1:
+    raise InvalidApiCall("Pending job arrays must be of equal length")
+
+  try:
+    return {
+      'jobid': np.asarray(columns['jobid'], dtype=np.int64),
+      'account': np.asarray(columns['account'], dtype=str),
+      'submitter': np.asarray(columns['submitter'], dtype=str),
+      'resource': np.asarray(columns['resource'], dtype=str),
+      'submit': np.asarray(columns['submit'], dtype=np.int64),
+      'request': np.asarray(columns['request'], dtype=np.float64),
+    }
+  except (TypeError, ValueError) as e:
+    raise InvalidApiCall("Invalid pending job data: {}".format(e))
+
+def _allocation(allocations, account, resource):
+  try:
+    units = float(allocations[account][resource])
+  except (KeyError, TypeError, ValueError):
+    raise InvalidApiCall("No allocation of {} for account {}".format(resource, account))
+  if units <= 0:
+    raise InvalidApiCall("Invalid allocation of {} for account {}".format(resource, account))
+  return units
+
+# ---------------------------------------------------------------------------
+#                                                          module functions
+# ---------------------------------------------------------------------------
+
+def available():
+  """
+  Whether reports of pending jobs can be scored, which requires NumPy.
+  """
+  return find_spec('numpy') is not None
+
+def score_jobs(jobs, epoch):
+  """
+  Score the burst candidates of a report of pending jobs.
+
+  Args:
+    jobs: The report of pending jobs, as described above.
+    epoch: Epoch of report (UTC), from which jobs' waits are measured.
+
+  Returns:
+    List of dicts describing the burst candidates, as expected by
+    `Burst.report()`, ordered by account and resource.
+
+  Raises:
+    InvalidApiCall: The report does not conform to the API.
+  """
+  import numpy as np
+
+  arrays = _job_arrays(jobs)
+  if not arrays['jobid'].size:
+    return []
+  allocations = jobs['allocations'] if isinstance(jobs['allocations'], dict) else {}
+  min_pain = float(current_app.config['BURST_MIN_PAIN'])
+
+  # group jobs by account and resource
+  (accounts, account_idx) = np.unique(arrays['account'], return_inverse=True)
+  (resources, resource_idx) = np.unique(arrays['resource'], return_inverse=True)
+  for resource in resources:
+    try:
+      Resource.get(str(resource))
+    except KeyError as e:
+      raise InvalidApiCall("Invalid resource type: {}".format(e))
+  (groups, group_idx) = np.unique(account_idx * len(resources) + resource_idx,
+    return_inverse=True)
+  group_idx = group_idx.reshape(-1)
+
+  # work waiting for each group, in unit-hours
+  waited = np.maximum(epoch - arrays['submit'], 0) / 3600.0
+  work = np.bincount(group_idx, weights=arrays['request'] * waited,
+    minlength=len(groups))
+  requested = np.bincount(group_idx, weights=arrays['request'], minlength=len(groups))
+  num_jobs = np.bincount(group_idx, minlength=len(groups))
+
+  # job range and longest wait of each group, reduced over jobs sorted by group
+  order = np.argsort(group_idx, kind='stable')
+  starts = np.concatenate(([0], np.cumsum(num_jobs)[:-1]))
+  firstjobs = np.minimum.reduceat(arrays['jobid'][order], starts)
+  lastjobs = np.maximum.reduceat(arrays['jobid'][order], starts)
+  longest = np.maximum.reduceat(waited[order], starts)
+
+  # submitters of each group, by number of jobs.  Pairs are sorted by group,
+  # so each group's are found by bisection
+  (submitters, submitter_idx) = np.unique(arrays['submitter'], return_inverse=True)
+  (pairs, pair_counts) = np.unique(
+    group_idx * len(submitters) + submitter_idx.reshape(-1), return_counts=True)
+  (pair_groups, pair_submitters) = np.divmod(pairs, len(submitters))
+  bounds = np.searchsorted(pair_groups, np.arange(len(groups) + 1))
+
+  candidates = []
+  for (group, key) in enumerate(groups):
+    (account, resource) = (str(accounts[key // len(resources)]),
+      str(resources[key % len(resources)]))
+    pain = work[group] / _allocation(allocations, account, resource)
+    if pain < min_pain:
+      continue
+
+    mine = slice(bounds[group], bounds[group + 1])
+    ranked = np.argsort(-pair_counts[mine], kind='stable')
+    candidates.append({
+      'account': account,
+      'resource': resource,
+      'pain': round(float(pain), 3),
+      'firstjob': int(firstjobs[group]),
+      'lastjob': int(lastjobs[group]),
+      'submitters': [str(submitters[i]) for i in pair_submitters[mine][ranked]],
+      'summary': {
+        'num_jobs': int(num_jobs[group]),
+        'requested': float(requested[group]),
+        'longest_wait': round(float(longest[group]), 2),
+      },
+    })
+  return candidates
@@ -20,18 +20,24 @@ whether it may be of use to other case types.
 
 import re
 import json
+import math
+import hashlib
 from inspect import isclass
+from operator import attrgetter
+from flask import g, has_app_context
 from flask_babel import _
 from manager.log import get_log
-from manager.db import get_db
+from manager.db import get_db, DbEnum
 from manager.ldap import get_ldap
 from manager.otrs import ticket_url
 from manager.cluster import Cluster
 from manager.history import History
 from manager.exceptions import (
-  AppException, BadCall, DatabaseException, ResourceNotFound
+  AppException, BadCall, DatabaseException, InvalidApiCall, ResourceNotFound
 )
 from manager.template import get_templates_for_case_type
+from manager.archive import restore_case
+from manager.metrics import record_sample, record_samples
 
 # ---------------------------------------------------------------------------
 #                                                                   helpers
@@ -67,6 +73,10 @@ def just_job_id(jobid):
 #                                                               SQL queries
 # ---------------------------------------------------------------------------
 
+## Queries grouping by case include R.epoch, which is functionally dependent
+## on R.id, because where reportables is partitioned (see `manager.partition`)
+## its primary key is (id, epoch).
+
 ## use with `.format(tablename)`
 SQL_LOOKUP = '''
   SELECT    R.ticks, R.account, R.cluster, R.epoch, B.*, R.summary,
@@ -77,7 +87,20 @@ SQL_LOOKUP = '''
   LEFT JOIN history N
   ON        (R.id = N.case_id)
   WHERE     R.id = ?
-  GROUP BY  R.id, B.id
+  GROUP BY  R.id, R.epoch, B.id
+'''
+
+## use with `.format(tablename)`
+SQL_LOOKUP_ARCHIVED = '''
+  SELECT    R.ticks, R.account, R.cluster, R.epoch, B.*, R.summary,
+            R.claimant, R.ticket_id, R.ticket_no, COUNT(N.id) AS notes
+  FROM      reportables_archive R
+  JOIN      {}_archive B
+  USING     (id)
+  LEFT JOIN history_archive N
+  ON        (R.id = N.case_id)
+  WHERE     R.id = ?
+  GROUP BY  R.id, R.epoch, B.id
 '''
 
 SQL_INSERT_NEW = '''
@@ -106,7 +129,37 @@ SQL_GET_CURRENT_FOR_CLUSTER = '''
   WHERE     cluster = ?
     AND     epoch = (SELECT MAX(epoch) FROM reportables 
               WHERE cluster = ? AND id IN (SELECT id FROM {}))
-  GROUP BY  R.id, B.id
+  GROUP BY  R.id, R.epoch, B.id
+'''
+
+SQL_GET_CURRENT_EPOCH = '''
+  SELECT    MAX(epoch) AS epoch
+  FROM      reportables
+  WHERE     cluster = ? AND id IN (SELECT id FROM {})
+'''
+
+## use with `.format(tablename, conditions)`
+SQL_COUNT_FOR_EPOCH = '''
+  SELECT    COUNT(*) AS count
+  FROM      reportables R
+  INNER JOIN {} B
+  ON        (R.id = B.id)
+  WHERE     R.cluster = ? AND R.epoch = ?{}
+'''
+
+## use with `.format(tablename, conditions, ordering, limits)`
+SQL_GET_PAGE_FOR_EPOCH = '''
+  SELECT    R.ticks, R.account, R.cluster, R.epoch, B.*, R.summary,
+            R.claimant, R.ticket_id, R.ticket_no, COUNT(N.id) AS notes
+  FROM      reportables R
+  INNER JOIN {} B
+  ON        (R.id = B.id)
+  LEFT JOIN history N
+  ON        (R.id = N.case_id)
+  WHERE     R.cluster = ? AND R.epoch = ?{}
+  GROUP BY  R.id, R.epoch, B.id
+  ORDER BY  {}
+  {}
 '''
 
 # Only query for columns we're not going to overwrite in subsequent update operation.
@@ -118,12 +171,212 @@ SQL_FIND_EXISTING = '''
   WHERE     R.account = ? AND R.cluster = ? AND {}
 '''
 
+## use with `.format(tablename, conditions)`.  Finds the cases of a delta
+## report's resolved records (see `Case.carry_forward()`)
+SQL_FIND_RESOLVED = '''
+  SELECT    R.id
+  FROM      reportables R
+  INNER JOIN {} B
+  ON        (R.id = B.id)
+  WHERE     R.account = ? AND R.cluster = ? AND R.epoch = ? AND {}
+'''
+
+## use with `.format(tablename, exclusions)`, where `exclusions` is empty or
+## a condition on the ID beginning with AND
+SQL_CARRY_FORWARD = '''
+  UPDATE    reportables
+  SET       epoch = ?,
+            ticks = ticks + 1
+  WHERE     cluster = ? AND epoch = ?
+    AND     id IN (SELECT id FROM {}){}
+'''
+
 SQL_SET_TICKET = '''
   UPDATE  reportables
   SET     ticket_id = ?, ticket_no = ?
   WHERE   id = ?
 '''
 
+SQL_ADD_USER = '''
+  INSERT INTO case_users
+              (case_id, username)
+  VALUES      (?, ?)
+'''
+
+SQL_REMOVE_USER = '''
+  DELETE FROM case_users
+  WHERE     case_id = ? AND username = ?
+'''
+
+## use with `.format(tablename)`
+SQL_GET_FOR_USER = '''
+  SELECT    R.ticks, R.account, R.cluster, R.epoch, B.*, R.summary,
+            R.claimant, R.ticket_id, R.ticket_no, COUNT(N.id) AS notes
+  FROM      case_users U
+  INNER JOIN reportables R
+  ON        (R.id = U.case_id)
+  INNER JOIN {} B
+  ON        (R.id = B.id)
+  LEFT JOIN history N
+  ON        (R.id = N.case_id)
+  WHERE     U.username = ?
+  GROUP BY  R.id, R.epoch, B.id
+  ORDER BY  R.epoch DESC, R.id
+'''
+
+## use with `.format(tablename, account)`, where `account` is the account
+## expression matched by prefix, ignoring case, using its index
+SQL_FIND_BY_ACCOUNT = '''
+  SELECT    R.ticks, R.account, R.cluster, R.epoch, B.*, R.summary,
+            R.claimant, R.ticket_id, R.ticket_no, COUNT(N.id) AS notes
+  FROM      reportables R
+  INNER JOIN {0} B
+  ON        (R.id = B.id)
+  LEFT JOIN history N
+  ON        (R.id = N.case_id)
+  WHERE     {1} LIKE ? ESCAPE '\\'
+  GROUP BY  R.id, R.epoch, B.id
+  ORDER BY  R.account, R.cluster, R.epoch DESC, R.id
+  LIMIT     ?
+'''
+
+SQL_BUMP_VERSION = '''
+  INSERT INTO case_versions
+              (cluster, casetype, serial, epoch)
+  VALUES      (?, ?, 1, ?)
+  ON CONFLICT (cluster, casetype)
+  DO UPDATE
+  SET         serial = case_versions.serial + 1,
+              epoch = COALESCE(excluded.epoch, case_versions.epoch)
+'''
+
+SQL_BUMP_VERSION_BY_ID = '''
+  INSERT INTO case_versions
+              (cluster, casetype, serial)
+  SELECT      cluster, ?, 1
+  FROM        reportables
+  WHERE       id = ?
+  ON CONFLICT (cluster, casetype)
+  DO UPDATE
+  SET         serial = case_versions.serial + 1
+'''
+
+SQL_GET_VERSIONS = '''
+  SELECT    casetype, serial, epoch
+  FROM      case_versions
+  WHERE     cluster = ?
+'''
+
+# maximum number of cases of each type found by account search
+SEARCH_LIMIT = 100
+
+# criteria understood by `Case.view()` for paging, sorting and filtering
+PAGING_CRITERIA = {'start', 'length', 'order', 'search', 'columns', 'summary'}
+
+# regular expression to match a filter on a summary value, such as
+# `num_jobs>100`
+__summary_filter_re = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*$')
+
+# operators of summary filters and their equivalents in SQL/JSON path
+# expressions
+SUMMARY_OPERATORS = {
+  '=': '==',
+  '!=': '!=',
+  '<': '<',
+  '<=': '<=',
+  '>': '>',
+  '>=': '>=',
+}
+
+def column_setter(attribute, convert=None):
+  """
+  Create a function setting an attribute of a case from a database column's
+  value, for use in `Case._columns`.
+
+  Args:
+    attribute: Name of the attribute (slot) to set.
+    convert: Optional function converting the column value to the attribute
+      value.
+
+  Returns:
+    A function taking arguments (case, value).
+  """
+  if convert:
+    return lambda case, value: setattr(case, attribute, convert(value))
+  return lambda case, value: setattr(case, attribute, value)
+
+def _decode_summary(value):
+  """
+  Interpret a case summary as read from the database.  Postgres stores
+  summaries as JSONB, which is decoded by the database adapter, while SQLite
+  stores them as JSON text.
+  """
+  if isinstance(value, str):
+    return json.loads(value) if value else None
+  return value
+
+def parse_summary_filters(text):
+  """
+  Parse filters on the values of case summaries.
+
+  Filters are given as comma-separated conditions of the form `<key><op>
+  <value>`, such as `num_jobs>100,partition=gpu`, where the operator is one
+  of `=`, `!=`, `<`, `<=`, `>` or `>=`.  Values which can be interpreted as
+  numbers are compared as numbers, others as strings.
+
+  Args:
+    text: The filters, as above.
+
+  Returns:
+    List of tuples (key, operator, value).
+
+  Raises:
+    BadCall: A filter cannot be interpreted.
+  """
+  filters = []
+  for condition in text.split(','):
+    match = __summary_filter_re.match(condition)
+    if not match:
+      raise BadCall("Invalid summary filter: {}".format(condition))
+    (key, operator, value) = match.groups()
+    for convert in (int, float):
+      try:
+        value = convert(value)
+        break
+      except ValueError:
+        pass
+    if isinstance(value, float) and not math.isfinite(value):
+      raise BadCall("Invalid summary filter value: {}".format(condition))
+    filters.append((key, operator, value))
+  return filters
+
+def _identity_map():
+  """
+  Get the identity map of cases loaded in the current application context,
+  which is specific to a request when handling one, so that a case loaded
+  more than once is only looked up once.  The map is keyed by case ID.
+
+  Returns:
+    Dict of case IDs to case objects, or None if there is no application
+    context.
+  """
+  if not has_app_context():
+    return None
+  return g.setdefault('case_identity_map', {})
+
+def forget_case(id):
+  """
+  Remove a case from the identity map, so that it is looked up again the
+  next time it is requested.  This must be done whenever a case is modified
+  other than through its own object.
+
+  Args:
+    id: The case ID.
+  """
+  cases = _identity_map()
+  if cases:
+    cases.pop(id, None)
+
 # ---------------------------------------------------------------------------
 #                                                         Case registry
 # ---------------------------------------------------------------------------
@@ -193,6 +446,7 @@ class CaseRegistry:
     description = reporter.describe()
 
     # register
+    reporter.compile_serializer()
     self._reporters[name] = reporter
     self._descriptions[name] = description
     get_log().info("Registered reporter for %s", name)
@@ -231,6 +485,61 @@ class CaseRegistry:
 # create global reporter registry
 registry = CaseRegistry.get_registry()
 
+# ---------------------------------------------------------------------------
+#                                                     case view versioning
+# ---------------------------------------------------------------------------
+
+def get_view_etag(cluster, reports, *qualifiers):
+  """
+  Determine the entity tag for a view of the current cases on a cluster.
+
+  The tag is derived from the modification counter and latest epoch of each
+  of the given reports on the cluster (see `Case.bump_version()`), so it
+  changes whenever any case which may appear in the view is reported or
+  updated.  Anything else the view depends on, such as the requested locale
+  or paging parameters, must be given as qualifiers.
+
+  This only requires a lookup of the counters, so it can be used to answer
+  conditional requests without building the view.
+
+  Args:
+    cluster: The cluster of the view.
+    reports: Names of the reports included in the view.
+    qualifiers: Other values the view depends on.
+
+  Returns:
+    String suitable for use as a strong entity tag.
+  """
+  versions = {
+    rec['casetype']: (rec['serial'], rec['epoch'])
+    for rec in get_db().execute(SQL_GET_VERSIONS, (cluster,)).fetchall() or []
+  }
+  parts = [cluster]
+  for name in sorted(reports):
+    (serial, epoch) = versions.get(registry.reporters[name]._table, (0, None))
+    parts.append("{}:{}:{}".format(name, serial, epoch))
+  parts.extend(str(qualifier) for qualifier in qualifiers)
+  return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def get_report_epochs(cluster, reports):
+  """
+  Determine the epoch of the latest report of each of the given reports on a
+  cluster (see `Case.bump_version()`).  Delta reports are based on these.
+
+  Args:
+    cluster: The reporting cluster.
+    reports: Names of the reports.
+
+  Returns:
+    Dict of report names to epochs, or None where a report has not been
+    received from the cluster.
+  """
+  epochs = {
+    rec['casetype']: rec['epoch']
+    for rec in get_db().execute(SQL_GET_VERSIONS, (cluster,)).fetchall() or []
+  }
+  return {name: epochs.get(registry.reporters[name]._table) for name in reports}
+
 # ---------------------------------------------------------------------------
 #                                                       base Case class
 # ---------------------------------------------------------------------------
@@ -251,7 +560,10 @@ class Case:
 
   Instances of these subclasses are represented in the database by a row in
   each of two tables: the reportables table, which stores information common
-  to all types, and in a table specific to the subclass.
+  to all types, and in a table specific to the subclass.  Cases no longer
+  reported are eventually moved to archive tables (see `manager.archive`), so
+  the subclass's table must have an archive counterpart of the same
+  structure named with the suffix "_archive".
 
   Additionally subclasses define methods for reporting and presenting problem
   cases.
@@ -259,8 +571,72 @@ class Case:
   Subclasses must implement some methods and may override others, as
   documented.  Methods implemented here merely as stubs will throw
   `NotImplementedError` if called.
+
+  Attributes:
+    _sql_columns: Dict of data field names, as described by `describe()`, to
+      the SQL expression used to sort or search on that field where it is not
+      simply a column of the subclass's table (see `sql_column()`).
+    _enums: Dict of data field names to the `manager.db.DbEnum` stored in
+      that column of the subclass's table, so that searches and sorting
+      operate on the enumeration names rather than the stored values.
+    _fields: Names of the attributes included in the serialization of a
+      case, without their leading underscores.  These are the declared slots
+      of the class and its ancestors.  See `compile_serializer()`.
+    _columns: Dict of database column names to the function which sets the
+      corresponding attribute of a case from the column's value when the case
+      is loaded or updated.  Subclasses extend this with the columns of their
+      own table.  See `column_setter()`.
+    _report_schema: Sequence of tuples (field, types) describing records
+      reported through the API, where `types` is the type or tuple of types
+      permitted for that field.  Used to check typed (MessagePack) reports,
+      where records may be given as arrays of values in this order.  See
+      `decode_record()`.
+    _metric: Name of the data field holding the primary metric of the case
+      type, sampled each time a case is reported so that its trend can be
+      charted (see `manager.metrics`), or None if the type has none.
   """
 
+  # Cases are created in quantity for views, so attributes are declared as
+  # slots rather than kept in a per-instance dictionary.  Subclasses must
+  # declare slots for their own attributes.
+  __slots__ = (
+    '_id', '_ticks', '_account', '_cluster', '_epoch', '_summary',
+    '_claimant', '_ticket_id', '_ticket_no', '_other'
+  )
+
+  _sql_columns = {
+    'ticks': 'R.ticks',
+    'account': 'R.account',
+    'summary': 'R.summary',
+    'claimant': 'R.claimant',
+    'ticket': 'R.ticket_no',
+    'notes': 'COUNT(N.id)',
+  }
+
+  _enums = {}
+
+  _fields = tuple(slot[1:] for slot in __slots__)
+
+  _columns = {
+    'id': column_setter('_id'),
+    'ticks': column_setter('_ticks'),
+    'account': column_setter('_account'),
+    'cluster': column_setter('_cluster'),
+    'epoch': column_setter('_epoch'),
+    'summary': column_setter('_summary', _decode_summary),
+    'claimant': column_setter('_claimant'),
+    'ticket_id': column_setter('_ticket_id'),
+    'ticket_no': column_setter('_ticket_no'),
+    'notes': column_setter('_other', lambda v: {'notes': v}),
+  }
+
+  _report_schema = ()
+
+  _metric = None
+
+  # compiled by `compile_serializer()`
+  _serializer = None
+
   @classmethod
   def describe(cls):
     """
@@ -417,23 +793,26 @@ class Case:
     Subclasses may override this method to provide additional information.
 
     Args:
-      cases: The list of cases created or updated from the last report.
+      cases: Iterable of cases created or updated from the last report.  It
+        is iterated once, so it may be a generator.
 
     Returns:
       A string description of the last report.
     """
+    total = 0
     claimed = 0
     newbs = 0
     existing = 0
 
     for case in cases:
+      total += 1
       if case.claimant is not None:
         claimed += 1
       if case.ticks > 1:
         existing += 1
       else:
         newbs += 1
-    return f"There are {len(cases)} cases ({newbs} new and {existing} existing).  {claimed} are claimed."
+    return f"There are {total} cases ({newbs} new and {existing} existing).  {claimed} are claimed."
 
   @classmethod
   def report(cls, cluster, epoch, data):
@@ -443,7 +822,8 @@ class Case:
     Subclasses must implement this to interpret reports coming through the API
     from a Detector.  Those implementations should describe the expected
     format of the `data` argument and should call `Case.summarize_report()`
-    to provide a summary as return value.
+    to provide a summary as return value.  Nothing is committed: the report
+    is committed once all of it has been processed, or rolled back.
 
     Args:
       cluster: The reporting cluster.
@@ -457,6 +837,37 @@ class Case:
     """
     raise NotImplementedError
 
+  @classmethod
+  def decode_record(cls, record):
+    """
+    Check a record of a typed report against the report schema.
+
+    Args:
+      record: Dict of field names to values, or list of values in the order
+        given by the report schema.
+
+    Returns:
+      Dict of field names to values, as expected by `report()`.
+
+    Raises:
+      InvalidApiCall: The record does not conform to the report schema.
+        Missing fields are not reported here but left to `report()`.
+    """
+    fields = [field for (field, _types) in cls._report_schema]
+    if isinstance(record, (list, tuple)):
+      if len(record) != len(fields):
+        raise InvalidApiCall("Expected {} fields ({}) but got {}".format(
+          len(fields), ', '.join(fields), len(record)))
+      record = dict(zip(fields, record))
+    elif not isinstance(record, dict):
+      raise InvalidApiCall("Record must be a map or array")
+
+    for (field, types) in cls._report_schema:
+      if field in record and not isinstance(record[field], types):
+        raise InvalidApiCall("Invalid type for field {}: {}".format(
+          field, type(record[field]).__name__))
+    return record
+
   @classmethod
   def view(cls, criteria):
     """
@@ -485,33 +896,55 @@ class Case:
     Attributes suffixed with `_pretty` provide display versions of those
     attributes without, if appropriate and requested.
 
+    If any of the paging criteria are given, only the requested page of the
+    current cases is provided and the view additionally includes `total`, the
+    number of current cases, and `filtered`, the number of those matching the
+    search criteria.
+
     Args:
       criteria: Dict of criteria for selecting data for view.  In this
-      implementation, `cluster` is required and `pretty` is optional.
+      implementation, `cluster` is required and the others are optional.
         * `cluster`: (required) Cluster for which to provide data.
         * `pretty`: (optional, default False): provide display-friendly
           alternatives on some fields, if possible.
+        * `start`, `length`, `order`, `search`, `columns`: (optional) paging,
+          sorting and filtering, as described for `get_current_page()`.
 
     Returns:
       None or a data structure conforming to the above.
 
     Raises:
-      NotImplementedError: Criteria other than `pretty` or `cluster` were
-        specified, indicating this method should have been overridden by a
-        subclass and was not.
+      NotImplementedError: Criteria other than those above were specified,
+        indicating this method should have been overridden by a subclass and
+        was not.
+      BadCall: Paging criteria are invalid.
     """
 
-    # 'cluster' required, 'pretty' optional, nothing else handled
-    if set(criteria.keys()) - {'pretty'} != {'cluster'}:
+    # 'cluster' required, others optional, nothing else handled
+    if set(criteria.keys()) - {'pretty'} - PAGING_CRITERIA != {'cluster'}:
       raise NotImplementedError
 
+    pretty = criteria.get('pretty', False)
+
+    if PAGING_CRITERIA & set(criteria.keys()):
+      page = cls.get_current_page(criteria['cluster'],
+        **{ k: v for (k, v) in criteria.items() if k in PAGING_CRITERIA })
+      if not page:
+        return None
+      return {
+        'epoch': page['epoch'],
+        'total': page['total'],
+        'filtered': page['filtered'],
+        'results': [
+          rec.serialize(pretty=pretty) for rec in page['records']
+        ]
+      }
+
     records = cls.get_current(criteria['cluster'])
     if not records:
       return None
     epoch = records[0].epoch
 
-    pretty = criteria.get('pretty', False)
-
     # serialize records individually so as to add attributes
     serialized = [
       rec.serialize(pretty=pretty) for rec in records
@@ -532,7 +965,10 @@ class Case:
     subclass-specific table.
 
     This implementation tries to instantiate each of the registered case
-    classes using the given ID.  This is not efficient or graceful.
+    classes using the given ID.  This is not efficient or graceful, so cases
+    loaded in the current request are kept in an identity map, and a case
+    already loaded is returned as is.  If no current case has the ID, the
+    archived cases are searched in the same way.
 
     Args:
       id: The numeric ID of the case.
@@ -544,6 +980,11 @@ class Case:
     # TODO: This could be improved by having a bidirectional link--such as
     #       storing the subclass report type in the reportables table
 
+    # return case already loaded in this request, if any
+    cases = _identity_map()
+    if cases and id in cases:
+      return cases[id]
+
     registry = CaseRegistry.get_registry()
 
     # try to instantiate appropriate subclass by going through each in turn
@@ -553,6 +994,14 @@ class Case:
       except ResourceNotFound:
         pass
 
+    # otherwise it may have been archived
+    for reportercls in registry.reporters.values():
+      rec = get_db().execute(
+        SQL_LOOKUP_ARCHIVED.format(reportercls._table), (id,)
+      ).fetchone()
+      if rec:
+        return reportercls(record=rec)
+
     get_log().error("Could not find reporter class for case ID %d", id)
     return None
 
@@ -577,6 +1026,258 @@ class Case:
       cls(record=rec) for rec in res
     ]
 
+  @classmethod
+  def get_for_user(cls, username):
+    """
+    Get the cases of this type involving a user, on any cluster, most
+    recently reported first.  Archived cases are not included.
+
+    Args:
+      username: The user of interest.
+
+    Returns:
+      A list of appropriate case objects, which may be empty.
+    """
+    res = get_db().execute(
+      SQL_GET_FOR_USER.format(cls._table), (username,)
+    ).fetchall()
+    return [cls(record=rec) for rec in res or []]
+
+  @classmethod
+  def find_by_account(cls, prefix, limit=SEARCH_LIMIT):
+    """
+    Find the cases of this type for accounts beginning with the given
+    prefix, ignoring case, on any cluster, in a single query.  Archived
+    cases are not included.
+
+    Args:
+      prefix: Beginning of the account names of interest.
+      limit: Maximum number of cases to return.
+
+    Returns:
+      A list of appropriate case objects ordered by account, cluster and most
+      recent report, which may be empty.
+    """
+    db = get_db()
+
+    # SQLite's LIKE ignores case already, and only uses the index on the
+    # column itself
+    account = 'LOWER(R.account)' if db.type == 'postgres' else 'R.account'
+    escaped = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    res = db.execute(
+      SQL_FIND_BY_ACCOUNT.format(cls._table, account), (escaped + '%', limit)
+    ).fetchall()
+    return [cls(record=rec) for rec in res or []]
+
+  @classmethod
+  def get_current_page(cls, cluster, start=0, length=None, order=None,
+      search=None, columns=None, summary=None):
+    """
+    Get a page of the current cases for this type of report, sorted and
+    filtered in the database.
+
+    Columns are identified by their data field names as given by
+    `describe()`.  Only columns described as sortable may be used for
+    ordering and only those described as searchable may be used for
+    searching.  Searches are case-insensitive substring matches.  Filters
+    on summary values are evaluated by the database: in Postgres, as SQL/JSON
+    path expressions on the indexed JSONB column.
+
+    Args:
+      cluster: The identifier for the cluster of interest.
+      start: Offset of the first case of the page.
+      length: Maximum number of cases in the page, or None or a negative
+        number for all remaining cases.  Zero may be used to get only the
+        counts.
+      order: List of tuples (datum, direction) where direction is `asc` or
+        `desc`, in order of precedence.
+      search: Text to search for in any searchable column.
+      columns: Dict of data field names to text to search for in that
+        column.
+      summary: Filters on summary values, either as text to be interpreted
+        by `parse_summary_filters()` or as a list of tuples (key, operator,
+        value) as it returns.
+
+    Returns:
+      None if there are no current cases, or a dict with the following:
+        * `epoch`: The epoch of the current cases.
+        * `total`: The number of current cases.
+        * `filtered`: The number of current cases matching the searches.
+        * `records`: List of appropriate case objects in the page.
+
+    Raises:
+      BadCall: A column is not recognized or not sortable or searchable as
+        requested, or the paging or filter parameters are invalid.
+    """
+    cols = { col['datum']: col for col in cls.describe()['cols'] }
+
+    try:
+      start = int(start or 0)
+      length = int(length) if length is not None else -1
+    except ValueError:
+      raise BadCall("Invalid paging parameters ({}, {})".format(start, length))
+    if start < 0:
+      raise BadCall("Invalid page start: {}".format(start))
+
+    # build conditions
+    conditions = []
+    terms = []
+    for (datum, text) in (columns or {}).items():
+      if not cols.get(datum, {}).get('searchable'):
+        raise BadCall("Column is not searchable: {}".format(datum))
+      if text:
+        (condition, condition_terms) = cls._search_condition(datum, text)
+        conditions.append(condition)
+        terms.extend(condition_terms)
+    if search:
+      alternatives = []
+      for datum in [datum for (datum, col) in cols.items() if col['searchable']]:
+        (condition, condition_terms) = cls._search_condition(datum, search)
+        alternatives.append(condition)
+        terms.extend(condition_terms)
+      conditions.append("({})".format(' OR '.join(alternatives)))
+    if isinstance(summary, str):
+      summary = parse_summary_filters(summary)
+    for (key, operator, value) in summary or []:
+      (condition, condition_terms) = cls._summary_condition(key, operator, value)
+      conditions.append(condition)
+      terms.extend(condition_terms)
+    where = ''.join(["\n    AND     " + condition for condition in conditions])
+
+    # build ordering, always ending with ID so paging is stable
+    ordering = []
+    for (datum, direction) in order or []:
+      if not cols.get(datum, {}).get('sortable'):
+        raise BadCall("Column is not sortable: {}".format(datum))
+      if direction.lower() not in ('asc', 'desc'):
+        raise BadCall("Invalid sort direction: {}".format(direction))
+      ordering.append("{} {}".format(cls._sort_expression(datum), direction.upper()))
+    ordering.append("R.id")
+
+    # build limits
+    limits = ''
+    if length >= 0:
+      limits = "LIMIT {} OFFSET {}".format(length, start)
+    elif start:
+      limits = "OFFSET {}".format(start)
+
+    db = get_db()
+    rec = db.execute(SQL_GET_CURRENT_EPOCH.format(cls._table), (cluster,)).fetchone()
+    if not rec or rec['epoch'] is None:
+      return None
+    epoch = rec['epoch']
+
+    total = db.execute(
+      SQL_COUNT_FOR_EPOCH.format(cls._table, ''), (cluster, epoch)
+    ).fetchone()['count']
+    filtered = total
+    if conditions:
+      filtered = db.execute(
+        SQL_COUNT_FOR_EPOCH.format(cls._table, where), [cluster, epoch] + terms
+      ).fetchone()['count']
+
+    records = []
+    if length != 0:
+      res = db.execute(
+        SQL_GET_PAGE_FOR_EPOCH.format(cls._table, where, ', '.join(ordering), limits),
+        [cluster, epoch] + terms
+      ).fetchall()
+      records = [cls(record=rec) for rec in res or []]
+
+    return {
+      'epoch': epoch,
+      'total': total,
+      'filtered': filtered,
+      'records': records
+    }
+
+  @classmethod
+  def sql_column(cls, datum):
+    """
+    Return the SQL expression for the column holding the given data field.
+
+    By default, a data field is assumed to be a column of the same name in the
+    subclass's table unless it is listed in `_sql_columns`.  Subclasses
+    describing data fields which are derived or stored under another name
+    should add them to `_sql_columns`.
+
+    Args:
+      datum: Name of the data field, as described by `describe()`.
+
+    Returns:
+      String SQL expression, valid in the queries used by
+      `get_current_page()`.
+    """
+    return cls._sql_columns.get(datum, 'B.' + datum)
+
+  @classmethod
+  def _search_condition(cls, datum, text):
+    """
+    Return the SQL condition and terms matching the given text in a column.
+    """
+    column = cls.sql_column(datum)
+
+    # enumerations are matched by name, as displayed
+    if datum in cls._enums:
+      matches = [
+        member for member in cls._enums[datum]
+        if text.lower() in str(member).lower()
+          or text.lower() in _(str(member)).lower()
+      ]
+      if not matches:
+        return ("1 = 0", [])
+      return (
+        "{} IN ({})".format(column, ', '.join(['?'] * len(matches))),
+        [member.value for member in matches]
+      )
+
+    # escape wildcards in search text
+    escaped = text.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return (
+      "LOWER(CAST({} AS TEXT)) LIKE ? ESCAPE '\\'".format(column),
+      ['%' + escaped + '%']
+    )
+
+  @classmethod
+  def _summary_condition(cls, key, operator, value):
+    """
+    Return the SQL condition and terms comparing a value of the summary.
+    Values of a different type than that compared never match.
+    """
+    if not re.match(r'^\w+$', key) or operator not in SUMMARY_OPERATORS:
+      raise BadCall("Invalid summary filter: {}{}{}".format(key, operator, value))
+    path = '$."{}"'.format(key)
+
+    # Postgres evaluates a JSON path predicate, which may use the GIN index
+    if get_db().type == 'postgres':
+      return (
+        "R.summary @@ CAST(? AS jsonpath)",
+        ["{} {} {}".format(path, SUMMARY_OPERATORS[operator], json.dumps(value))]
+      )
+
+    # SQLite would otherwise order numbers before all text
+    types = "'text'" if isinstance(value, str) else "'integer', 'real'"
+    return (
+      "(json_type(R.summary, ?) IN ({}) AND json_extract(R.summary, ?) {} ?)".format(
+        types, operator),
+      [path, path, value]
+    )
+
+  @classmethod
+  def _sort_expression(cls, datum):
+    """
+    Return the SQL expression used to sort on a column.
+    """
+    column = cls.sql_column(datum)
+
+    # enumerations are sorted by name rather than stored value
+    if datum in cls._enums:
+      return "CASE {} {} END".format(column, ' '.join([
+        "WHEN '{}' THEN '{}'".format(member.value, str(member).lower())
+        for member in cls._enums[datum]
+      ]))
+    return column
+
   @classmethod
   def set_ticket(cls, id, ticket_id, ticket_no):
     """
@@ -597,13 +1298,95 @@ class Case:
       The ticket ID and number are confusing and meaningful only to OTRS.
       The Dude abides.
     """
+    # determine table of this case type, or consider all types if not known
+    if hasattr(cls, '_table'):
+      tables = [cls._table]
+    else:
+      tables = [reporter._table for reporter in registry.reporters.values()]
+
+    # a ticket makes an archived case current again
+    for table in tables:
+      if restore_case(table, id):
+        break
+
     db = get_db()
     res = db.execute(SQL_SET_TICKET, (ticket_id, ticket_no, id))
 
     # TODO: should use rowcount == 1 instead of res
     if not res:
       raise DatabaseException("Could not set ticket information for case ID {}".format(id))
+
+    # invalidate views of this case type, or of all types if not known
+    for table in tables:
+      db.execute(SQL_BUMP_VERSION_BY_ID, (table, id))
     db.commit()
+    forget_case(id)
+
+  @classmethod
+  def bump_version(cls, cluster, epoch=None):
+    """
+    Increment the modification counter of this type of case on the given
+    cluster, invalidating the entity tags of views including these cases (see
+    `get_view_etag()`).
+
+    This must be called whenever cases of this type are reported or updated.
+    Updates handled by this class do this already.  The caller must commit.
+
+    Args:
+      cluster: The cluster of the modified cases.
+      epoch: The epoch of the report, if the modification is a new report.
+    """
+    get_db().execute(SQL_BUMP_VERSION, (cluster, cls._table, epoch))
+
+  @classmethod
+  def carry_forward(cls, cluster, base, epoch, resolved=()):
+    """
+    Advance the cases of this type current at the base epoch of a delta
+    report (see `manager.api`), other than those resolved, to the epoch of
+    the report as though reported again unchanged.  This is a single update
+    however many cases are unchanged.
+
+    This must be called once the cases added or changed by the report have
+    been reported, so that those are no longer at the base epoch.  The caller
+    must commit.
+
+    Args:
+      cluster: The reporting cluster.
+      base: The epoch of the report on which the delta report is based.
+      epoch: The epoch of the delta report.
+      resolved: Iterable of records identifying cases no longer current, as
+        understood by `resolved_query()`.
+
+    Returns:
+      The number of cases carried forward.
+
+    Raises:
+      InvalidApiCall: A resolved record does not conform to the API.
+    """
+    db = get_db()
+    ids = []
+    for record in resolved:
+      (query, terms) = cls.resolved_query(record)
+      try:
+        account = record['account']
+      except KeyError as e:
+        raise InvalidApiCall("Missing required field: {}".format(e))
+      ids.extend(rec['id'] for rec in db.execute(
+        SQL_FIND_RESOLVED.format(cls._table, query),
+        [account, cluster, base] + list(terms)
+      ).fetchall() or [])
+
+    exclusions = ''
+    if ids:
+      exclusions = ' AND id NOT IN ({})'.format(', '.join('?' * len(ids)))
+    count = db.execute(SQL_CARRY_FORWARD.format(cls._table, exclusions),
+      [epoch, cluster, base] + ids).rowcount
+    if cls._metric:
+      record_samples(cls._table, cls._metric, cluster, epoch)
+
+    get_log().debug("Carried forward %d %s cases on %s from %d to %d (%d resolved)",
+      count, cls._table, cluster, base, epoch, len(ids))
+    return count
 
   @classmethod
   def appropriate_templates(cls, language):
@@ -621,7 +1404,7 @@ class Case:
 
   def __init__(self,
       id=None, record=None,
-      account=None, cluster=None, epoch=None, summary=None
+      account=None, cluster=None, epoch=None, summary=None, existing=None
     ):
     """
     There are three modes for creating a Case object:
@@ -632,7 +1415,8 @@ class Case:
     3.  Creating a "new" Case specifying information about it.  Note that it
         may be that an existing case is found matching enough of the
         information to be effectively the same case.  Both `id` and `record`
-        should not be set.
+        should not be set.  Changes are not committed, so that a report is
+        committed or rolled back as a whole by the caller.
 
     Subclasses will need to override this method but _must_ invoke the base
     implementation via `super().__init__()` to ensure the entire object is
@@ -647,6 +1431,10 @@ class Case:
       epoch: The UNIX epoch (UTC) when this case was (last) reported.
       summary: A dictionary of arbitrary information supplied by the Detector
         which may be of use to analysts in addressing the case.
+      existing: The record of the existing case matching a new report, as
+        found by `find_existing_query()`, if already known, or False if
+        known not to exist.  Used where the cases of a report are matched
+        in bulk rather than queried individually.
 
     Raises:
       `manager.exceptions.ResourceNotFound` if the ID (but no record) is
@@ -663,9 +1451,11 @@ class Case:
       if not rec:
         raise ResourceNotFound("Could not find {} record with ID {}".format(self.__class__.__name__, id))
       self._load_from_rec(dict(rec))
+      self._remember()
     elif record and not id:
       # factory load
       self._load_from_rec(dict(record))
+      self._remember()
     else:
       # new report--either a new record or overlaps with existing
       if not epoch or not cluster:
@@ -678,7 +1468,7 @@ class Case:
       db = get_db()
 
       # update existing record if possible, if not...
-      if not self.update_existing():
+      if not self.update_existing(existing):
 
         self._ticket_no = None
         self._ticket_id = None
@@ -686,26 +1476,74 @@ class Case:
         self._ticks = 1
 
         self._id = db.insert_returning_id(SQL_INSERT_NEW,
-          (self._epoch, self._account, self._cluster, json.dumps(self._summary)
-          ))
+          (self._epoch, self._account, self._cluster, self._summary))
         self.insert_new()
+        self._update_users()
+
+      if self._metric:
+        record_sample(self._id, self._epoch, getattr(self, '_' + self._metric))
 
-      db.commit()
+      # any copy loaded earlier is out of date
+      forget_case(self._id)
+
+  def _remember(self):
+    """
+    Register this case in the request's identity map, replacing any copy
+    loaded earlier.
+    """
+    cases = _identity_map()
+    if cases is not None:
+      cases[self._id] = self
 
   def _load_from_rec(self, rec):
     """
     Helper method for initializing an object given a dictionary describing its
-    attributes.
+    attributes.  Each column is interpreted according to `_columns`.
+
+    Raises:
+      `manager.exceptions.AppException` if the record includes a column not
+        described by `_columns`.
     """
+    columns = self._columns
     for (k, v) in rec.items():
-      if k == 'notes':
-        self._other = {
-          'notes': v
-        }
-      elif k == 'summary':
-        self._summary = json.loads(v) if v else None
-      else:
-        self.__dict__['_'+k] = v
+      try:
+        setter = columns[k]
+      except KeyError:
+        raise AppException("Unexpected column for {}: {}".format(
+          self.__class__.__name__, k))
+      setter(self, v)
+
+  def _update_users(self, existing=None):
+    """
+    Record the users involved in this case (see `users`) in the
+    `case_users` table, by which the cases involving a user are found.  Only
+    changes are written, judged against the users of the existing case as
+    last reported rather than read back from the table.  The caller must
+    commit.
+
+    Args:
+      existing: The record of the existing case before this report, as found
+        by `find_existing_query()`, or None if the case has just been
+        created, so that no users have been recorded.
+    """
+    try:
+      users = {user for user in self.users if user}
+      recorded = set()
+      if existing:
+        # pylint: disable=protected-access
+        previous = self.__class__.__new__(self.__class__)
+        previous._account = self._account
+        previous._cluster = self._cluster
+        previous._load_from_rec(dict(existing))
+        recorded = {user for user in previous.users if user}
+    except NotImplementedError:
+      return
+
+    db = get_db()
+    if users - recorded:
+      db.executemany(SQL_ADD_USER, [(self._id, user) for user in sorted(users - recorded)])
+    if recorded - users:
+      db.executemany(SQL_REMOVE_USER, [(self._id, user) for user in sorted(recorded - users)])
 
   def find_existing_query(self):
     """
@@ -724,6 +1562,28 @@ class Case:
     """
     raise NotImplementedError
 
+  @classmethod
+  def resolved_query(cls, record):
+    """
+    Returns partial query and terms to complete the SQL_FIND_RESOLVED query,
+    identifying the case of a record reported as resolved by a delta report
+    among the cases of the record's account current at the report's base
+    epoch.  The record is as last reported, though only the fields
+    identifying the case are required.
+
+    Subclasses must implement this to accept delta reports.
+
+    Returns:
+      A tuple (query, terms) where:
+        - `query` (string) completes the WHERE clauses in SQL_FIND_RESOLVED,
+          and
+        - `terms` (list) lists the search terms in the query.
+
+    Raises:
+      InvalidApiCall: The record does not conform to the API.
+    """
+    raise NotImplementedError
+
   def update_existing_me(self, rec):
     """
     Updates the subclass's partial record of an existing case.  Subclasses
@@ -739,36 +1599,44 @@ class Case:
     """
     raise NotImplementedError
 
-  def update_existing(self):
+  def update_existing(self, existing=None):
     """
     Handle updates to existing records.  This is called on initialization
     to handle existing cases, as partially defined by subclasses (see
     `find_existing_query()`).  Updates are also handled by subclass (see
-    `update_existing_me()`).
+    `update_existing_me()`).  Changes to the users of the case are recorded
+    (see `_update_users()`).
 
     At this point this is called, self should be initialized with the
     details provided, but this may need to be appropriately adjusted with
     data from the matching case in the database.
 
+    Args:
+      existing: The record of the matching case if already known, with the
+        columns selected by `find_existing_query()`, or False if known not
+        to exist.  If None, the matching case is queried.
+
     Returns:
       A boolean indicating whether there was a record to update.
     """
-    (query, terms, columns_list) = self.find_existing_query()
+    rec = existing
+    if rec is None:
+      (query, terms, columns_list) = self.find_existing_query()
 
-    # turn list of column names into "B.col1, B.col2, ..."
-    columns_str = ", ".join(map(lambda x: "B." + x, columns_list))
+      # turn list of column names into "B.col1, B.col2, ..."
+      columns_str = ", ".join(map(lambda x: "B." + x, columns_list))
 
-    rec = get_db().execute(
-      SQL_FIND_EXISTING.format(columns_str, self.__class__._table, query),
-      [self._account, self._cluster] + list(terms)
-    ).fetchone()
+      rec = get_db().execute(
+        SQL_FIND_EXISTING.format(columns_str, self.__class__._table, query),
+        [self._account, self._cluster] + list(terms)
+      ).fetchone()
     if not rec:
       return False
 
     # populate self as appropriate.  Currently only has data from report
     self._ticks = rec['ticks'] + 1
     for col in ['id', 'claimant', 'ticket_id', 'ticket_no']:
-      self.__dict__['_'+col] = rec[col]
+      self._columns[col](self, rec[col])
     try:
       if not self.update_existing_me(rec):
         return False
@@ -780,10 +1648,13 @@ class Case:
       )
 
     affected = get_db().execute(SQL_UPDATE_BY_ID, (
-      self._ticks, self._epoch, json.dumps(self._summary), self._id
+      self._ticks, self._epoch, self._summary, self._id
     )).rowcount
+    if affected != 1:
+      return False
 
-    return affected == 1
+    self._update_users(rec)
+    return True
 
   def insert_new(self):
     """
@@ -802,7 +1673,8 @@ class Case:
     value database-friendly, but should pass the execution back to the super
     class which will execute the SQL statement.
 
-    A history record is created for the update.
+    A history record is created for the update.  If the case has been
+    archived, it is first restored to the current tables.
 
     Args:
       update: A dict with `note` and/or `datum` and `value` defined describing
@@ -811,6 +1683,8 @@ class Case:
         logged-in user.
     """
 
+    restore_case(self.__class__._table, self._id)
+
     was = None
     now = None
     what = update.get('datum', None)
@@ -826,7 +1700,7 @@ class Case:
       get_log().debug("Updating case %d, %s: %s => %s", self._id, what, was, now)
 
       # update self locally and persistently
-      self.__dict__['_'+what] = now
+      self._columns[what](self, now)
       query = "UPDATE {} SET {} = ? WHERE id = ?".format(table, what)
       get_log().debug("Going to execute '%s' with (%s, %d)", query, now, self._id)
       affected = get_db().execute("UPDATE {} SET {} = ? WHERE id = ?".format(table, what), (now, self._id)).rowcount
@@ -839,6 +1713,12 @@ class Case:
     # record update in history
     History(caseID=self._id, analyst=who, timestamp=timestamp, text=text, datum=what, was=was, now=now)
 
+    # note count is now out of date
+    forget_case(self._id)
+
+    self.bump_version(self._cluster)
+    get_db().commit()
+
   @property
   def id(self):
     """
@@ -936,16 +1816,58 @@ class Case:
     case.  This method should return all usernames associated with the case,
     such as those submitting problematic jobs, and so on.
 
-    Order is preserved and can be used to suggest defaults.
+    Order is preserved and can be used to suggest defaults.  These users are
+    recorded in the `case_users` table whenever the case is reported, so that
+    the cases involving a user can be found (see `get_for_user()`).
     """
     raise NotImplementedError
 
+  @classmethod
+  def compile_serializer(cls):
+    """
+    Build the function used by `serialize()` to create the basic dictionary
+    representation of a case of this class, from the declared `_fields`.
+    Enumerations (see `_enums`) are represented by their serialized form.
+    This is called when the class is registered.
+
+    Returns:
+      The serializer, which is also stored as the `_serializer` class
+      attribute.
+    """
+    keys = tuple(cls._fields)
+    attrs = tuple('_' + key for key in keys)
+    enums = tuple(key for key in keys if key in cls._enums)
+    getter = attrgetter(*attrs)
+    if len(attrs) == 1:
+      single = getter
+      getter = lambda case: (single(case),)
+
+    def serializer(case):
+      try:
+        dct = dict(zip(keys, getter(case)))
+      except AttributeError:
+        # not all attributes are set, as for a case being created
+        dct = {
+          key: getattr(case, attr)
+          for (key, attr) in zip(keys, attrs) if hasattr(case, attr)
+        }
+      for key in enums:
+        value = dct.get(key)
+        if isinstance(value, DbEnum):
+          dct[key] = value.serialize()
+      return dct
+
+    cls._serializer = serializer
+    return serializer
+
   def serialize(self, pretty=False):
     """
     Provide a dictionary representation of self.
 
-    By default, simply returns a dictionary of attributes with leading
-    underscores removed.  If `pretty` is specified, the dictionary may be
+    By default, simply returns a dictionary of the attributes named by
+    `_fields`, keyed without their leading underscores, as built by the
+    compiled serializer (see `compile_serializer()`).  Enumerations are given
+    in their serialized form.  If `pretty` is specified, the dictionary may be
     augmented with prettified versions of some attributes, depending on the
     implementation.  In the base implementation, prettification includes:
 
@@ -969,10 +1891,10 @@ class Case:
       A dictionary representation of the case.
     """
 
-    dct = {
-      key.lstrip('_'): val
-      for (key, val) in self.__dict__.items()
-    }
+    serializer = self.__class__.__dict__.get('_serializer')
+    if not serializer:
+      serializer = self.__class__.compile_serializer()
+    dct = serializer(self)
     if pretty:
 
       # add claimant's name
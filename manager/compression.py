@@ -0,0 +1,176 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Compression of request and response bodies.
+
+Detectors may compress report bodies, which are decoded according to the
+`Content-Encoding` header.  The decompressed size is capped by
+`API_MAX_DECOMPRESSED_SIZE` to guard against decompression bombs.  Note the
+message digest used for API authentication does not cover the body, so it is
+unaffected by the encoding.
+
+JSON and MessagePack responses at least `COMPRESSION_MIN_SIZE` bytes long are
+compressed if the client accepts it.  Since compressed and uncompressed
+responses are different representations, strong entity tags are given a suffix
+naming the encoding; use `matching_etag()` to check conditional requests.
+"""
+
+import zlib
+import hashlib
+import tempfile
+from flask import current_app, request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+# supported encodings in order of preference, and the zlib window bits used
+# for each
+ENCODINGS = {
+  'gzip': 16 + zlib.MAX_WBITS,
+  'deflate': zlib.MAX_WBITS,
+}
+
+# size of chunks read from request stream
+CHUNK_SIZE = 64 * 1024
+
+# size of request bodies held in memory when spooled; larger bodies are
+# spooled to a temporary file
+SPOOL_SIZE = 1024 * 1024
+
+# media types of responses which may be compressed
+COMPRESSIBLE = ('application/json', 'application/msgpack')
+
+# ---------------------------------------------------------------------------
+#                                                            request bodies
+# ---------------------------------------------------------------------------
+
+def _read_chunks(stream):
+  """
+  Yield chunks read from stream until exhausted.
+  """
+  while True:
+    chunk = stream.read(CHUNK_SIZE)
+    if not chunk:
+      return
+    yield chunk
+
+def _decompress(stream, encoding, limit):
+  """
+  Yield decompressed chunks of stream, raising `RequestEntityTooLarge` as
+  soon as the decompressed data exceeds the given limit.
+  """
+  decompressor = zlib.decompressobj(ENCODINGS[encoding])
+  size = 0
+  try:
+    while not decompressor.eof:
+      data = decompressor.unconsumed_tail or stream.read(CHUNK_SIZE)
+      if not data:
+        break
+      chunk = decompressor.decompress(data, limit - size + 1)
+      size += len(chunk)
+      if size > limit:
+        raise RequestEntityTooLarge(
+          "Decompressed request body exceeds {} bytes".format(limit))
+      if chunk:
+        yield chunk
+  except zlib.error as e:
+    raise BadRequest("Could not decompress request body: {}".format(e))
+
+def iter_body():
+  """
+  Return an iterator over chunks of the current request's body, decoded
+  according to its `Content-Encoding`, without reading the entire body into
+  memory.
+
+  Raises:
+    `werkzeug.exceptions.UnsupportedMediaType` if the encoding is not
+      supported.  Iterating may raise
+      `werkzeug.exceptions.RequestEntityTooLarge` if the decompressed body is
+      too large or `werkzeug.exceptions.BadRequest` if the body cannot be
+      decompressed.
+  """
+  encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+  if encoding == 'identity':
+    return _read_chunks(request.stream)
+  if encoding not in ENCODINGS:
+    raise UnsupportedMediaType("Unsupported content encoding: {}".format(encoding))
+  limit = int(current_app.config['API_MAX_DECOMPRESSED_SIZE'])
+  return _decompress(request.stream, encoding, limit)
+
+def spool_body(chunks):
+  """
+  Spool chunks of a request body, such as from `iter_body()`, while computing
+  their digest, so that the body may be identified before it is processed.
+  Bodies larger than `SPOOL_SIZE` are spooled to a temporary file rather
+  than held in memory.
+
+  Returns:
+    Tuple (chunks, digest) of an iterator over chunks of the spooled body and
+    the hexadecimal SHA-256 digest of the body.
+  """
+  spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+  digest = hashlib.sha256()
+  for chunk in chunks:
+    digest.update(chunk)
+    spool.write(chunk)
+  spool.seek(0)
+
+  def read():
+    with spool:
+      yield from _read_chunks(spool)
+
+  return (read(), digest.hexdigest())
+
+# ---------------------------------------------------------------------------
+#                                                           response bodies
+# ---------------------------------------------------------------------------
+
+def matching_etag(etag):
+  """
+  Determine whether the current request's `If-None-Match` header matches any
+  representation of the entity with the given tag.
+
+  Args:
+    etag: The entity tag of the uncompressed representation.
+
+  Returns:
+    The matching tag, with any suffix for its encoding, or None.
+  """
+  for variant in [etag] + ["{}-{}".format(etag, encoding) for encoding in ENCODINGS]:
+    if request.if_none_match.contains(variant):
+      return variant
+  return None
+
+def compress_response(response):
+  """
+  Compress the response body if the client accepts a supported encoding and
+  the response is JSON or MessagePack of at least the minimum size.
+  Registered to be called after each request.
+  """
+  if response.mimetype not in COMPRESSIBLE:
+    return response
+  response.vary.add('Accept-Encoding')
+
+  if (response.status_code != 200
+      or response.direct_passthrough
+      or response.is_streamed
+      or 'Content-Encoding' in response.headers):
+    return response
+
+  encoding = request.accept_encodings.best_match(list(ENCODINGS))
+  if not encoding:
+    return response
+
+  data = response.get_data()
+  if len(data) < int(current_app.config['COMPRESSION_MIN_SIZE']):
+    return response
+
+  compressor = zlib.compressobj(wbits=ENCODINGS[encoding])
+  response.set_data(compressor.compress(data) + compressor.flush())
+  response.headers['Content-Encoding'] = encoding
+
+  # compressed body is a different representation
+  (etag, weak) = response.get_etag()
+  if etag and not weak:
+    response.set_etag("{}-{}".format(etag, encoding))
+
+  return response
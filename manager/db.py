@@ -4,6 +4,7 @@
 #       https://github.com/PyCQA/pylint/issues/3793 resolved
 #
 import os
+from collections import namedtuple
 from enum import Enum
 import re
 import click
@@ -20,7 +21,7 @@ from manager import exceptions
 # or an upgrade should be performed.
 #
 # See README in SQL scripts dir for guidance on updating the schema.
-SCHEMA_VERSION = '20211005'
+SCHEMA_VERSION = '20261029'
 
 # query to fetch latest schema version
 SQL_GET_SCHEMA_VERSION = """
@@ -30,9 +31,77 @@ SQL_GET_SCHEMA_VERSION = """
   LIMIT     1
 """
 
+# queries recording the progress of upgrade scripts run in segments.  The
+# table is created by the runner if necessary, so that scripts preceding the
+# schema version adding it may have batches.
+SQL_CREATE_PROGRESS = """
+  CREATE TABLE IF NOT EXISTS schema_progress (
+    script VARCHAR(64) NOT NULL,
+    segment INTEGER NOT NULL,
+    position BIGINT,
+    completed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (script, segment)
+  )
+"""
+
+SQL_GET_PROGRESS = """
+  SELECT    segment, position, completed
+  FROM      schema_progress
+  WHERE     script = ?
+"""
+
+SQL_SET_PROGRESS = """
+  INSERT INTO schema_progress
+              (script, segment, position, completed)
+  VALUES      (?, ?, ?, ?)
+  ON CONFLICT (script, segment)
+  DO UPDATE
+  SET         position = excluded.position,
+              completed = excluded.completed
+"""
+
+SQL_CLEAR_PROGRESS = """
+  DELETE FROM schema_progress
+  WHERE     script = ?
+"""
+
+# range of the key of a batched statement; use with `.format(column, table)`
+SQL_GET_KEY_RANGE = """
+  SELECT    MIN({0}) AS low, MAX({0}) AS high
+  FROM      {1}
+"""
+
 # scripts path
 SQL_SCRIPTS_DIR = 'sql'
 
+# directive preceding a statement of an upgrade script to be run in batches
+# over ranges of an integer key: `-- batch: <table>.<column> <size>`
+_batch_re = re.compile(r'^--\s*batch:\s*(\w+)\.(\w+)\s+(\d+)\s*$', re.M)
+
+# statements of upgrade scripts whose cost depends on the rows of a table, by
+# the kind of work they do.  Changing a column's type rewrites the table while
+# holding an exclusive lock.
+_statement_res = (
+  ('rewrite', re.compile(r'^ALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?(\w+)\s.*?'
+    r'\bALTER\s+(?:COLUMN\s+)?\w+\s+(?:SET\s+DATA\s+)?TYPE\b', re.I | re.S)),
+  ('alter', re.compile(r'^ALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?(\w+)', re.I)),
+  ('index', re.compile(r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?'
+    r'(?:IF\s+NOT\s+EXISTS\s+)?(?:\w+\s+)?ON\s+(?:ONLY\s+)?(\w+)', re.I)),
+  ('update', re.compile(r'^UPDATE\s+(?:ONLY\s+)?(\w+)', re.I)),
+  ('delete', re.compile(r'^DELETE\s+FROM\s+(?:ONLY\s+)?(\w+)', re.I)),
+  ('copy', re.compile(r'^INSERT\s+INTO\s+\w+.*?\bSELECT\b.*?\bFROM\s+(\w+)', re.I | re.S)),
+)
+
+# upgrade scripts found, by directory and extension; see `_upgrade_graph()`
+_upgrade_graphs = {}
+
+ScriptSegment = namedtuple('ScriptSegment', ['sql', 'batch'])
+ScriptSegment.__doc__ = """
+Part of an upgrade script executed as a whole, or if `batch` is given as
+`(table, column, size)`, a single statement executed once per range of
+`size` values of the table's key column.
+"""
+
 # This is used to queue custom DB-ready classes for to be registered for use
 # with specific databases, once the appropriate database is identified and
 # initialized.
@@ -87,6 +156,14 @@ def close_db(e=None):
     db.close()
 
 
+def _invalidate_caches():
+  """
+  Discard application caches of database content after running scripts.
+  """
+  from manager.template import invalidate_templates
+  invalidate_templates()
+
+
 def init_db(schema=None):
   db = get_db()
 
@@ -102,6 +179,7 @@ def init_db(schema=None):
     db.executescript(f.read().decode('utf8'))
 
   db.commit()
+  _invalidate_caches()
 
 
 def seed_db(seedfile):
@@ -113,6 +191,7 @@ def seed_db(seedfile):
     db.executescript(f.read().decode('utf8'))
 
   db.commit()
+  _invalidate_caches()
 
 
 def get_schema_version():
@@ -128,33 +207,32 @@ def get_schema_version():
   return (vers, SCHEMA_VERSION)
 
 
-def upgrade_schema(data_updates=None):
-  (actual, expected) = get_schema_version()
-  if actual == expected:
-    # trivial: actual matches expected, no action needed
-    return (actual, expected, None)
+def _upgrade_graph(directory, ext):
+  """
+  Find the upgrade scripts for a database type.  Scripts are
+  "${from}_to_${to}.[sql|psql]".  As they only change with the application,
+  the directory is only walked once per process.
 
-  get_log().info("DB schema is at version %s; app expects %s", actual, expected)
+  Args:
+    directory: Directory of the scripts.
+    ext: Extension of scripts for the database type.
 
-  ## Find upgrade path.  Scripts are "${from}_to_${to}.[sql|psql]".  Might need
-  ## to run several, such as if there is ${from}_to_int1.sql, int1_to_${to}.sql
-  ## for example.
+  Returns:
+    Dict of upgrade scripts keyed on their starting versions.  Values are the
+    ending version and the filename.
 
-  ## Build dictionary of upgrade scripts keyed on their starting versions.
-  ## Values are the ending version and the filename.
-  scriptdict = {}
+  Raises:
+    ImpossibleSchemaUpgrade: Several scripts have the same starting version.
+  """
+  if (directory, ext) in _upgrade_graphs:
+    return _upgrade_graphs[(directory, ext)]
 
-  # build regular expression for matching upgrade scripts
-  db = get_db()
-  if db.type == 'sqlite':
-    ext = 'sql'
-  elif db.type == 'postgres':
-    ext = 'psql'
+  scriptdict = {}
   regex = re.compile(r'^([^_]+)_to_([^_]+)\.{}$'.format(ext))
 
   # iterate through each file and if it's an update script add it to dict
   # pylint: disable=unused-variable
-  for root, dirs, files in os.walk(current_app.root_path + '/' + SQL_SCRIPTS_DIR):
+  for root, dirs, files in os.walk(directory):
     for file in files:
       m = regex.match(file)
       if m:
@@ -162,11 +240,46 @@ def upgrade_schema(data_updates=None):
           # this should not happen
           description = 'Multiple upgrade scripts have the same starting ' \
             'version.  This is not supported and leaves no clear upgrade ' \
-            'path.  In conflict: {} and {}.  Trying to upgrade schema from ' \
-            '{} to {}'.format(scriptdict[m[1]][1], file, actual, expected)
+            'path.  In conflict: {} and {}.'.format(scriptdict[m[1]][1], file)
           raise exceptions.ImpossibleSchemaUpgrade(description)
         scriptdict[m[1]] = (m[2], "{}/{}".format(root, file))
 
+  _upgrade_graphs[(directory, ext)] = scriptdict
+  return scriptdict
+
+
+def plan_upgrade(data_updates=None):
+  """
+  Plan the upgrade of the database to the schema version expected by the
+  application, without running it.
+
+  Args:
+    data_updates: Optional dict of scripts updating seed data, keyed on the
+      version after whose upgrade script each is to be run.
+
+  Returns:
+    Tuple of the schema version of the database, the version expected, and a
+    list of `(version, path)` of the scripts to run in order, which is empty
+    if no upgrade is needed.
+
+  Raises:
+    ImpossibleSchemaUpgrade: There is no path of upgrade scripts from the
+      database's version to that expected.
+  """
+  (actual, expected) = get_schema_version()
+  if actual == expected:
+    # trivial: actual matches expected, no action needed
+    return (actual, expected, [])
+
+  ## Find upgrade path.  Might need to run several scripts, such as if there
+  ## is ${from}_to_int1.sql, int1_to_${to}.sql for example.
+  ext = 'sql' if get_db().type == 'sqlite' else 'psql'
+  try:
+    scriptdict = _upgrade_graph(current_app.root_path + '/' + SQL_SCRIPTS_DIR, ext)
+  except exceptions.ImpossibleSchemaUpgrade as e:
+    description = '{}  Trying to upgrade schema from {} to {}'.format(e, actual, expected)
+    raise exceptions.ImpossibleSchemaUpgrade(description) from e
+
   # find path through upgrades from actual to expected
   have_upgrade_path = False
   upgrades = {}
@@ -194,19 +307,228 @@ def upgrade_schema(data_updates=None):
     if data_updates and version in data_updates:
       scripts.append((version, data_updates[version]))
 
+  return (actual, expected, scripts)
+
+
+def parse_upgrade_script(text):
+  """
+  Divide an upgrade script into the segments executed in turn.  A script
+  without batch directives is a single segment.  Otherwise each directive
+  and the statement following it, up to the first line ending with a
+  semicolon, form a batched segment, and the SQL between them form ordinary
+  segments.
+
+  A batched statement must compare the key column to two placeholders, the
+  start (inclusive) and end (exclusive) of each range, and must not
+  otherwise contain `?` or `%`:
+
+  ```
+  -- batch: reportables.id 10000
+  UPDATE reportables SET ticks = 0 WHERE ticks IS NULL AND id >= ? AND id < ?;
+  ```
+
+  Returns:
+    List of `ScriptSegment`.
+
+  Raises:
+    ImpossibleSchemaUpgrade: A batch directive is not followed by a suitable
+      statement.
+  """
+  segments = []
+  position = 0
+  for m in _batch_re.finditer(text):
+    if m.start() < position:
+      raise exceptions.ImpossibleSchemaUpgrade(
+        "Batch directive within batched statement: {}".format(m[0]))
+    end = re.compile(r';\s*$', re.M).search(text, m.end())
+    if not end or text[m.end():end.start()].count('?') != 2:
+      raise exceptions.ImpossibleSchemaUpgrade(
+        "Batch directive must be followed by a statement with two placeholders: {}".format(m[0]))
+    if text[position:m.start()].strip():
+      segments.append(ScriptSegment(text[position:m.start()], None))
+    segments.append(ScriptSegment(text[m.end():end.start()].strip(), (m[1], m[2], int(m[3]))))
+    position = end.end()
+
+  if text[position:].strip():
+    segments.append(ScriptSegment(text[position:], None))
+  return segments
+
+
+def _run_batches(script, index, segment, position):
+  """
+  Execute a batched segment of an upgrade script one range of its key at a
+  time, committing each range along with the progress made so that an
+  interrupted upgrade resumes from the next.  The key's maximum is taken
+  again after each range so that rows added meanwhile are included.
+  """
+  (table, column, size) = segment.batch
+  db = get_db()
+  sql = SQL_GET_KEY_RANGE.format(column, table)
+  bounds = db.execute(sql).fetchone()
+  low = bounds['low'] if position is None else position
+  while bounds['high'] is not None and low <= bounds['high']:
+    count = db.execute(segment.sql, (low, low + size)).rowcount
+    db.execute(SQL_SET_PROGRESS, (script, index, low + size, 0))
+    db.commit()
+    get_log().debug("Upgrading DB: %s: %s.%s from %d to %d (%d rows)", script,
+      table, column, low, low + size, count)
+    low += size
+    bounds = db.execute(sql).fetchone()
+
+
+def _run_upgrade_script(script, text):
+  """
+  Execute an upgrade script.  A script without batch directives is executed
+  as a whole in a single transaction.  Otherwise each segment is committed
+  with a record of its completion in the `schema_progress` table, so that
+  on a later attempt completed segments are skipped and batches resume,
+  and the record is cleared along with the script's final segment.
+
+  Args:
+    script: Name of the script, by which its progress is recorded.
+    text: The script.
+  """
+  db = get_db()
+  segments = parse_upgrade_script(text)
+  if not any(segment.batch for segment in segments):
+    db.executescript(text)
+    db.commit()
+    return
+
+  db.execute(SQL_CREATE_PROGRESS)
+  progress = {
+    rec['segment']: rec
+    for rec in db.execute(SQL_GET_PROGRESS, (script,)).fetchall() or []
+  }
+  for (index, segment) in enumerate(segments):
+    rec = progress.get(index)
+    if rec and rec['completed']:
+      get_log().info("Upgrading DB: %s: segment %d already completed", script, index)
+      continue
+
+    if segment.batch:
+      _run_batches(script, index, segment, rec['position'] if rec else None)
+    else:
+      db.executescript(segment.sql)
+
+    if index == len(segments) - 1:
+      db.execute(SQL_CLEAR_PROGRESS, (script,))
+    else:
+      db.execute(SQL_SET_PROGRESS, (script, index, None, 1))
+    db.commit()
+
+
+def _statement_costs(sql):
+  """
+  Yield the kind of work and the table of each statement in SQL whose cost
+  depends on the rows of the table.
+  """
+  sql = re.sub(r'/\*.*?\*/', '', sql, flags=re.S)
+  for statement in re.split(r';\s*$', sql, flags=re.M):
+    statement = '\n'.join(line for line in statement.splitlines()
+      if not line.strip().startswith('--')).strip()
+    for (kind, regex) in _statement_res:
+      m = regex.match(statement)
+      if m:
+        yield (kind, m[1])
+        break
+
+
+def estimate_upgrade(steps):
+  """
+  Estimate the work of an upgrade plan from the number of rows in the tables
+  affected by each statement, without running it.  Statements affecting no
+  existing rows, such as those creating tables, are omitted.
+
+  Args:
+    steps: Scripts of the plan, from `plan_upgrade()`.
+
+  Returns:
+    List of dicts, one per statement, giving the `script`, the `kind` of
+    statement (`rewrite`, `alter`, `index`, `update`, `delete` or `copy`),
+    the `table`, the estimated `rows`, the number of `batches` if the
+    statement is batched or otherwise None, whether it is `blocking`, that
+    is a full-table rewrite under an exclusive lock, and the estimated
+    `seconds` taken at `UPGRADE_ROWS_PER_SECOND`.
+  """
+  db = get_db()
+  rate = float(current_app.config['UPGRADE_ROWS_PER_SECOND'])
+  rows = {}
+  estimates = []
+  for (version, script) in steps:
+    with current_app.open_resource(script) as f:
+      segments = parse_upgrade_script(f.read().decode('utf8'))
+    for segment in segments:
+      for (kind, table) in _statement_costs(segment.sql):
+        if table not in rows:
+          rows[table] = db.estimate_rows(table)
+        if not rows[table]:
+          continue
+        batches = None
+        if segment.batch:
+          (keytable, column, size) = segment.batch
+          bounds = db.execute(SQL_GET_KEY_RANGE.format(column, keytable)).fetchone()
+          batches = 0 if bounds['high'] is None \
+            else (bounds['high'] - bounds['low']) // size + 1
+        estimates.append({
+          'script': script,
+          'version': version,
+          'kind': kind,
+          'table': table,
+          'rows': rows[table],
+          'batches': batches,
+          'blocking': kind == 'rewrite',
+          'seconds': rows[table] / rate,
+        })
+  return estimates
+
+
+def upgrade_schema(data_updates=None):
+  (actual, expected, steps) = plan_upgrade(data_updates)
+  if not steps:
+    return (actual, expected, None)
+
+  get_log().info("DB schema is at version %s; app expects %s", actual, expected)
+
   # carry out the plan
   actions = []
-  for (version, upgrade) in scripts:
+  for (version, upgrade) in steps:
     with current_app.open_resource(upgrade) as f:
       get_log().info("Upgrading DB: %s (version %s)", upgrade, version)
-      db.executescript(f.read().decode('utf8'))
+      _run_upgrade_script(os.path.basename(upgrade), f.read().decode('utf8'))
     actions.append("Executed {}".format(upgrade))
 
-    db.commit()
+  _invalidate_caches()
   get_log().info("Upgraded DB.")
 
   return (actual, expected, actions)
 
+
+def _describe_plan(actual, expected, steps):
+  """
+  Describe an upgrade plan and the estimates of its work.
+  """
+  if not steps:
+    return "DB schema at {}, code schema at {}, no action needed".format(actual, expected)
+
+  estimates = estimate_upgrade(steps)
+  lines = ["DB requires upgrade from {} to {}".format(actual, expected)]
+  for (version, script) in steps:
+    lines.append("Would execute {}".format(script))
+    for estimate in estimates:
+      if estimate['script'] != script:
+        continue
+      batches = ''
+      if estimate['batches'] is not None:
+        batches = " in {} batches".format(estimate['batches'])
+      blocking = ' (blocking full-table rewrite)' if estimate['blocking'] else ''
+      lines.append("  {} {}: ~{} rows{}, ~{:.1f}s{}".format(estimate['kind'],
+        estimate['table'], estimate['rows'], batches, estimate['seconds'], blocking))
+  lines.append("Estimated time: ~{:.1f}s at {} rows/s".format(
+    sum(estimate['seconds'] for estimate in estimates),
+    current_app.config['UPGRADE_ROWS_PER_SECOND']))
+  return "\n".join(lines)
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
@@ -233,17 +555,22 @@ def seed_db_command(seedfile):
 
 
 @click.command('upgrade-db')
+@click.option('--dry-run', is_flag=True,
+  help="Show the upgrade plan and estimates of its work without running it")
 @with_appcontext
-def upgrade_db_command():
+def upgrade_db_command(dry_run):
   """Upgrade database to expected schema version."""
 
   try:
-    (actual, expected, actions) = upgrade_schema()
-    if actions:
-      status_text = "DB required upgrade from {} to {}\n{}".format(
-        actual, expected, "\n".join(actions))
+    if dry_run:
+      status_text = _describe_plan(*plan_upgrade())
     else:
-      status_text = "DB schema at {}, code schema at {}, no action taken".format(actual, expected)
+      (actual, expected, actions) = upgrade_schema()
+      if actions:
+        status_text = "DB required upgrade from {} to {}\n{}".format(
+          actual, expected, "\n".join(actions))
+      else:
+        status_text = "DB schema at {}, code schema at {}, no action taken".format(actual, expected)
     #status_code = 0
   except exceptions.ImpossibleSchemaUpgrade as e:
     status_text = str(e)
@@ -1,8 +1,27 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+import itertools
 import psycopg2
 import psycopg2.extensions
+import psycopg2.extras
+
+# dicts, such as case summaries, are stored as JSON.  JSONB columns are
+# decoded by psycopg2 when read.
+psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+
+# names of server-side cursors are drawn from this sequence
+_cursor_names = ('iterate_{}'.format(n) for n in itertools.count())
+
+# planner's estimate of the rows of a table and any partitions, and the least
+# estimate of any of them, which is negative for tables never analyzed
+SQL_ESTIMATE_ROWS = '''
+  SELECT    SUM(GREATEST(C.reltuples, 0)) AS estimate,
+            MIN(CASE WHEN C.relkind <> 'p' THEN C.reltuples END) AS least
+  FROM      pg_class C
+  WHERE     C.oid = to_regclass(%s)
+  OR        C.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%s))
+'''
 
 
 def register_adapter(target):
@@ -58,6 +77,42 @@ class ExtConnection(psycopg2.extensions.connection):
     cursor.execute(sql)
     return cursor
 
+  def iterate(self, sql, parameters=None, size=1000):
+    """
+    Execute a query and yield its rows one at a time, as dicts, fetching
+    them in batches of the given size from a server-side (named) cursor so
+    that the whole result is never held in memory.  The cursor belongs to
+    the current transaction, which should be ended once done.
+    """
+    cursor = self.cursor(next(_cursor_names))
+    cursor.itersize = size
+    try:
+      cursor.execute(sql.replace('?', '%s'), parameters)
+      rows = cursor.fetchmany(size)
+      while rows:
+        names = [column.name for column in cursor.description]
+        for row in rows:
+          yield dict(zip(names, row))
+        rows = cursor.fetchmany(size)
+    finally:
+      cursor.close()
+
+  def estimate_rows(self, table):
+    """
+    Estimate the number of rows in a table, including its partitions, from
+    the planner's statistics rather than by scanning it.  Tables which have
+    never been analyzed are counted.  Returns None if there is no such table.
+    """
+    cursor = self.cursor()
+    cursor.execute(SQL_ESTIMATE_ROWS, (table, table))
+    rec = cursor.fetchone()
+    if rec is None or rec['estimate'] is None:
+      return None
+    if rec['least'] is not None and rec['least'] < 0:
+      cursor.execute('SELECT COUNT(*) AS count FROM {}'.format(table))
+      return cursor.fetchone()['count']
+    return int(rec['estimate'])
+
   def insert_returning_id(self, sql, parameters):
     cursor = self.cursor()
     updated_sql = sql.replace('?', '%s') + ' RETURNING id'
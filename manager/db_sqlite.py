@@ -2,10 +2,13 @@
 # pylint:
 #
 from enum import Enum
+import json
 import re
 import sqlite3
 from manager.exceptions import DatabaseException
 
+# dicts, such as case summaries, are stored as JSON text
+sqlite3.register_adapter(dict, json.dumps)
 
 def register_adapter(target):
   sqlite3.register_adapter(target, target.__str__)
@@ -123,6 +126,34 @@ class ExtConnection(sqlite3.Connection):
 
     return sqlite3.Connection.execute(self, sql)
 
+  def iterate(self, sql, parameters=None, size=1000):
+    """
+    Execute a query and yield its rows one at a time, as dicts, fetching
+    them in batches of the given size so that the whole result is never held
+    in memory.  Normalizes with the Postgres connection's server-side
+    cursors.
+    """
+    cursor = self.execute(sql, parameters)
+    try:
+      rows = cursor.fetchmany(size)
+      while rows:
+        for row in rows:
+          yield dict(row)
+        rows = cursor.fetchmany(size)
+    finally:
+      cursor.close()
+
+  def estimate_rows(self, table):
+    """
+    Count the rows in a table, or return None if there is no such table.
+    SQLite keeps no estimates, and is not used for databases large enough for
+    counting to matter.  Normalizes with the Postgres connection's estimates.
+    """
+    if not self.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table,)).fetchone():
+      return None
+    return self.execute('SELECT COUNT(*) AS count FROM {}'.format(table)).fetchone()['count']
+
   def insert_returning_id(self, sql, parameters):
     cursor = self.execute(sql, parameters)
     return cursor.lastrowid
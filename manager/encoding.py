@@ -0,0 +1,257 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Negotiation of report and response encodings for the API.
+
+JSON is the default encoding.  If the `msgpack` package is installed, API
+clients may also send reports encoded as MessagePack by specifying a
+`Content-Type` of `application/msgpack`, and may request MessagePack responses
+using the `Accept` header.  The message digest used for API authentication
+does not cover the body, so it is unaffected by the encoding.
+
+MessagePack reports are typed: each record of a report section is checked
+against the `report_schema` of the case type, and may be given either as a
+map or, more compactly, as an array of values in schema order.  Job IDs, for
+example, are integers rather than strings to be parsed.
+"""
+
+from collections.abc import Iterator
+from datetime import date
+from contextlib import contextmanager
+from flask import request, current_app, jsonify
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from werkzeug.exceptions import UnsupportedMediaType
+from werkzeug.http import http_date
+from manager.compression import CHUNK_SIZE
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# ---------------------------------------------------------------------------
+#                                                                      JSON
+# ---------------------------------------------------------------------------
+
+class JSONEncoder(FlaskJSONEncoder):
+  """
+  JSON encoder for the application's objects, which provide a `serialize`
+  method giving their JSON-compatible representation.  Set as the
+  application's JSON encoder; use it explicitly with `json.dumps()` outside of
+  Flask's helpers.
+  """
+
+  def default(self, o):
+    serialize = getattr(o.__class__, 'serialize', None)
+    if serialize:
+      return serialize(o)
+    return super().default(o)
+
+# encoders for `json_response()`, by options
+_json_encoders = {}
+
+def json_response(data):
+  """
+  Create a JSON response, as `flask.jsonify()` does for a single argument and
+  producing identical output, but reusing an encoder configured once for the
+  application's settings.
+
+  Args:
+    data: Data to be encoded.
+
+  Returns:
+    A `flask.Response` object.
+  """
+  app = current_app
+  if app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug:
+    return jsonify(data)
+
+  options = (app.json_encoder, app.config['JSON_SORT_KEYS'], app.config['JSON_AS_ASCII'])
+  encoder = _json_encoders.get(options)
+  if not encoder:
+    encoder = options[0](
+      sort_keys=options[1], ensure_ascii=options[2], separators=(',', ':'))
+    _json_encoders[options] = encoder
+  return app.response_class(
+    encoder.encode(data) + '\n', mimetype=app.config['JSONIFY_MIMETYPE'])
+
+# ---------------------------------------------------------------------------
+#                                                               negotiation
+# ---------------------------------------------------------------------------
+
+def request_encoding():
+  """
+  Determine the encoding of the current request's body from its
+  `Content-Type`.
+
+  Returns:
+    `MSGPACK` for MessagePack bodies, `JSON` for JSON bodies, or None if the
+    body is of neither type.
+
+  Raises:
+    `werkzeug.exceptions.UnsupportedMediaType` if the body is MessagePack but
+      MessagePack support is not installed.
+  """
+  if request.mimetype == MSGPACK:
+    if not msgpack:
+      raise UnsupportedMediaType("MessagePack encoding is not supported")
+    return MSGPACK
+  if request.is_json:
+    return JSON
+  return None
+
+def response_encoding():
+  """
+  Determine the encoding of the response to the current request from its
+  `Accept` header, preferring JSON where the client has no preference.
+  """
+  offered = [JSON, MSGPACK] if msgpack else [JSON]
+  return request.accept_mimetypes.best_match(offered, default=JSON)
+
+def _default(obj):
+  """
+  Encode objects MessagePack doesn't natively support, in the same way as
+  the application's JSON encoder.
+  """
+  serialize = getattr(obj.__class__, 'serialize', None)
+  if serialize:
+    return serialize(obj)
+  if isinstance(obj, date):
+    return http_date(obj)
+  raise TypeError("Object of type {} is not serializable".format(
+    obj.__class__.__name__))
+
+def encode_response(data):
+  """
+  Create a response encoding the given data as negotiated with the client.
+
+  Args:
+    data: Data to be encoded.
+
+  Returns:
+    A `flask.Response` object.
+  """
+  encoding = response_encoding()
+  if encoding == MSGPACK:
+    response = current_app.response_class(
+      msgpack.packb(data, default=_default, use_bin_type=True),
+      mimetype=MSGPACK)
+  else:
+    response = json_response(data)
+  response.vary.add('Accept')
+  return response
+
+# ---------------------------------------------------------------------------
+#                                                          MessagePack reports
+# ---------------------------------------------------------------------------
+
+class MsgpackDecodeError(ValueError):
+  """
+  Raised when a MessagePack report is malformed.
+  """
+
+@contextmanager
+def _unpacking():
+  """
+  Translate errors raised while unpacking into `MsgpackDecodeError`.
+  """
+  try:
+    yield
+  except MsgpackDecodeError:
+    raise
+  except msgpack.OutOfData:
+    raise MsgpackDecodeError("Unexpected end of document")
+  except (msgpack.UnpackException, ValueError) as e:
+    raise MsgpackDecodeError("Invalid MessagePack: {}".format(e))
+
+class _ChunkReader:
+  """
+  File-like wrapper around an iterable of byte chunks, for `msgpack.Unpacker`.
+  """
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+    self._pending = b''
+
+  def read(self, size=-1):
+    if not self._pending:
+      self._pending = next(self._chunks, b'')
+    if size < 0 or size >= len(self._pending):
+      (data, self._pending) = (self._pending, b'')
+    else:
+      (data, self._pending) = (self._pending[:size], self._pending[size:])
+    return data
+
+class _ArrayItems(Iterator):
+  """
+  Iterator over the elements of an array being unpacked.
+  """
+
+  def __init__(self, unpacker, count):
+    self._unpacker = unpacker
+    self._remaining = count
+
+  def __next__(self):
+    if not self._remaining:
+      raise StopIteration
+    self._remaining -= 1
+    with _unpacking():
+      return self._unpacker.unpack()
+
+  def drain(self):
+    """
+    Skip any remaining elements.
+    """
+    with _unpacking():
+      while self._remaining:
+        self._remaining -= 1
+        self._unpacker.skip()
+
+def msgpack_members(chunks):
+  """
+  Incrementally unpack a MessagePack map read from a stream of chunks,
+  yielding tuples (name, value) for each entry.  Where the value is an array,
+  it is given as an iterator yielding each element in turn, as with
+  `manager.jsonstream.ObjectStream.members()`.
+
+  Args:
+    chunks: Iterable of byte strings forming the MessagePack document.
+
+  Raises:
+    MsgpackDecodeError: The document is not a valid MessagePack map.
+  """
+  unpacker = msgpack.Unpacker(_ChunkReader(chunks), raw=False,
+    read_size=CHUNK_SIZE, strict_map_key=True)
+
+  with _unpacking():
+    try:
+      count = unpacker.read_map_header()
+    except ValueError:
+      raise MsgpackDecodeError("Expected map")
+
+  for _ in range(count):
+    with _unpacking():
+      name = unpacker.unpack()
+      if not isinstance(name, str):
+        raise MsgpackDecodeError("Expected string key")
+      try:
+        array = _ArrayItems(unpacker, unpacker.read_array_header())
+      except ValueError:
+        array = None
+        value = unpacker.unpack()
+    if array is None:
+      yield (name, value)
+    else:
+      yield (name, array)
+      array.drain()
+
+  with _unpacking():
+    try:
+      unpacker.skip()
+    except msgpack.OutOfData:
+      return
+    raise MsgpackDecodeError("Unexpected data after map")
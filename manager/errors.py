@@ -3,7 +3,7 @@
 #
 import sys
 import traceback
-from flask import render_template, jsonify
+from flask import render_template, jsonify, make_response
 from manager.log import get_log
 
 
@@ -80,3 +80,12 @@ def xhr_success(status=200, title=None):
   if title:
     response['title'] = title
   return jsonify(response), status
+
+def xhr_not_modified(etag):
+  """
+  Respond to a conditional request for an entity that has not changed since
+  the client last retrieved it.
+  """
+  response = make_response('', 304)
+  response.set_etag(etag)
+  return response
@@ -0,0 +1,261 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Bulk export of case data for reporting.
+
+Cases of one type, along with their history and ticket information, are
+exported for a range of report epochs and optionally a set of clusters, as
+CSV or newline-delimited JSON (NDJSON).  Archived cases are included.
+
+Exports are produced by a generator reading from a single query through
+`iterate()` on the database connection, which in Postgres uses a server-side
+cursor, and output is yielded in chunks as rows are read.  Memory use is
+therefore bounded regardless of the number of cases exported, and the query
+takes only the shared locks of an ordinary read.
+
+In CSV, each row is an event of a case's history along with the case's
+columns, and cases without history have a single row with empty event
+columns.  In NDJSON, each line is a case with its history as a list of
+events.
+
+Exports are available through `/xhr/export/` and `flask export-cases`.
+"""
+
+import io
+import csv
+import json
+import calendar
+import click
+from flask.cli import with_appcontext
+from manager.db import get_db
+from manager.otrs import ticket_url
+from manager.case import Case, registry, _decode_summary
+from manager.exceptions import BadCall
+
+# ---------------------------------------------------------------------------
+#                                                               SQL queries
+# ---------------------------------------------------------------------------
+
+## use with `.format(columns, table, clusters)`, where `clusters` is empty or
+## a condition on the cluster beginning with AND
+SQL_EXPORT_CASES = '''
+  SELECT    C.*,
+            H.id AS event_id, H.timestamp AS event_timestamp,
+            H.analyst AS event_analyst, H.note AS event_note,
+            H.change AS event_change
+  FROM      (
+              SELECT  R.id, R.cluster, R.account, R.epoch, R.ticks, R.claimant,
+                      R.ticket_id, R.ticket_no, R.summary, {0}, 0 AS archived
+              FROM    reportables R
+              JOIN    {1} T
+              ON      (T.id = R.id)
+              WHERE   R.epoch >= ? AND R.epoch < ? {2}
+              UNION ALL
+              SELECT  R.id, R.cluster, R.account, R.epoch, R.ticks, R.claimant,
+                      R.ticket_id, R.ticket_no, R.summary, {0}, 1 AS archived
+              FROM    reportables_archive R
+              JOIN    {1}_archive T
+              ON      (T.id = R.id)
+              WHERE   R.epoch >= ? AND R.epoch < ? {2}
+            ) C
+  LEFT JOIN (
+              SELECT id, case_id, timestamp, analyst, note, change FROM history
+              UNION ALL
+              SELECT id, case_id, timestamp, analyst, note, change FROM history_archive
+            ) H
+  ON        (H.case_id = C.id)
+  ORDER BY  C.id, H.timestamp, H.id
+'''
+
+# ---------------------------------------------------------------------------
+#                                                                 constants
+# ---------------------------------------------------------------------------
+
+# export formats and their media types
+FORMATS = {
+  'csv': 'text/csv',
+  'ndjson': 'application/x-ndjson',
+}
+
+# number of rows read from the database at a time, and so roughly the number
+# of rows written to each chunk of output
+BATCH_SIZE = 500
+
+# columns of every case type, in order of export
+CASE_COLUMNS = (
+  'id', 'cluster', 'account', 'epoch', 'ticks', 'claimant', 'ticket_id',
+  'ticket_no', 'ticket_url', 'summary', 'archived'
+)
+
+# columns of history events, in order of export
+EVENT_COLUMNS = ('id', 'timestamp', 'analyst', 'note', 'change')
+
+# ---------------------------------------------------------------------------
+#                                                                   helpers
+# ---------------------------------------------------------------------------
+
+def _type_columns(reporter):
+  """
+  Get the columns of the case type's own table, in order.
+  """
+  return [column for column in reporter._columns if column not in Case._columns]
+
+def _case_record(reporter, columns, rec):
+  """
+  Interpret the case columns of an exported row as a dict, giving enumerated
+  values by name and including the URL of any ticket.
+  """
+  case = {
+    'id': rec['id'],
+    'cluster': rec['cluster'],
+    'account': rec['account'],
+    'epoch': rec['epoch'],
+    'ticks': rec['ticks'],
+    'claimant': rec['claimant'],
+    'ticket_id': rec['ticket_id'],
+    'ticket_no': rec['ticket_no'],
+    'ticket_url': ticket_url(rec['ticket_id']) if rec['ticket_id'] else None,
+    'summary': _decode_summary(rec['summary']),
+    'archived': bool(rec['archived']),
+  }
+  for column in columns:
+    value = rec[column]
+    if column in reporter._enums and value is not None:
+      value = reporter._enums[column](value).serialize()
+    case[column] = value
+  return case
+
+def _event_record(rec):
+  """
+  Interpret the history columns of an exported row as a dict, or None if the
+  row has no event.
+  """
+  if rec['event_id'] is None:
+    return None
+  return {
+    'id': rec['event_id'],
+    'timestamp': str(rec['event_timestamp']),
+    'analyst': rec['event_analyst'],
+    'note': rec['event_note'],
+    'change': json.loads(rec['event_change']) if rec['event_change'] else None,
+  }
+
+def _export_csv(reporter, columns, rows):
+  buf = io.StringIO()
+  writer = csv.writer(buf)
+  writer.writerow(list(CASE_COLUMNS) + columns + ['event_' + column for column in EVENT_COLUMNS])
+
+  for (count, rec) in enumerate(rows, 1):
+    case = _case_record(reporter, columns, rec)
+    if case['summary'] is not None:
+      case['summary'] = json.dumps(case['summary'])
+    event = _event_record(rec) or {}
+    if event.get('change') is not None:
+      event['change'] = json.dumps(event['change'])
+    writer.writerow(
+      [case[column] for column in CASE_COLUMNS + tuple(columns)]
+      + [event.get(column) for column in EVENT_COLUMNS])
+
+    if count % BATCH_SIZE == 0:
+      yield buf.getvalue()
+      buf.seek(0)
+      buf.truncate()
+
+  yield buf.getvalue()
+
+def _export_ndjson(reporter, columns, rows):
+  lines = []
+  case = None
+  for rec in rows:
+    if case is None or case['id'] != rec['id']:
+      if case is not None:
+        lines.append(json.dumps(case))
+        if len(lines) >= BATCH_SIZE:
+          yield '\n'.join(lines) + '\n'
+          lines = []
+      case = _case_record(reporter, columns, rec)
+      case['history'] = []
+    event = _event_record(rec)
+    if event:
+      case['history'].append(event)
+
+  if case is not None:
+    lines.append(json.dumps(case))
+  if lines:
+    yield '\n'.join(lines) + '\n'
+
+# ---------------------------------------------------------------------------
+#                                                          module functions
+# ---------------------------------------------------------------------------
+
+def export_cases(casetype, since, until, clusters=None, fmt='csv'):
+  """
+  Export cases of the given type reported in a range of epochs.  The
+  arguments are checked immediately, while the export itself is produced as
+  the result is iterated.
+
+  Args:
+    casetype: Name of the case type, such as `bursts`.
+    since: Epoch from which to include cases, by their latest report.
+    until: Epoch before which to include cases.
+    clusters: Optional sequence of cluster IDs to which to limit the export.
+    fmt: `csv` or `ndjson`.
+
+  Returns:
+    Generator of strings which together form the export.
+
+  Raises:
+    BadCall: The case type or format is not recognized.
+  """
+  reporter = registry.reporters.get(casetype)
+  if reporter is None:
+    raise BadCall("Unrecognized case type: {}".format(casetype))
+  if fmt not in FORMATS:
+    raise BadCall("Unrecognized export format: {}".format(fmt))
+
+  columns = _type_columns(reporter)
+  condition = ''
+  terms = [since, until]
+  if clusters:
+    condition = 'AND R.cluster IN ({})'.format(', '.join('?' * len(clusters)))
+    terms += list(clusters)
+  sql = SQL_EXPORT_CASES.format(
+    ', '.join('T.' + column for column in columns), reporter._table, condition)
+
+  rows = get_db().iterate(sql, terms * 2, BATCH_SIZE)
+  if fmt == 'csv':
+    return _export_csv(reporter, columns, rows)
+  return _export_ndjson(reporter, columns, rows)
+
+def date_to_epoch(date):
+  """
+  Return the epoch at the start (UTC) of the given date or datetime.
+  """
+  return calendar.timegm(date.timetuple()[:3] + (0, 0, 0))
+
+# ---------------------------------------------------------------------------
+#                                                              CLI commands
+# ---------------------------------------------------------------------------
+
+@click.command('export-cases')
+@click.argument('casetype')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), required=True,
+  help="Date (UTC) from which to include cases, by their latest report")
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), required=True,
+  help="Date (UTC) before which to include cases")
+@click.option('--cluster', 'clusters', multiple=True,
+  help="Cluster of cases to include; may be repeated (default: all)")
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv',
+  show_default=True, help="Output format")
+@click.option('--output', type=click.File('w', lazy=True), default='-',
+  help="File to which to write the export (default: standard output)")
+@with_appcontext
+def export_cases_command(casetype, since, until, clusters, fmt, output):
+  """Export cases of a type with their history."""
+  try:
+    chunks = export_cases(casetype, date_to_epoch(since), date_to_epoch(until), clusters, fmt)
+  except BadCall as e:
+    raise click.ClickException(str(e)) from e
+  for chunk in chunks:
+    output.write(chunk)
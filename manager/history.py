@@ -2,9 +2,12 @@
 # pylint: disable=raise-missing-from
 #
 import json
+import base64
+import binascii
 from .db import get_db
+from .encoding import JSONEncoder
 from .event import CaseEvent
-from .exceptions import ResourceNotFound, ResourceNotCreated
+from .exceptions import ResourceNotFound, ResourceNotCreated, BadCall
 
 # ---------------------------------------------------------------------------
 #                                                               SQL queries
@@ -28,13 +31,65 @@ SQL_GET_HISTORY_BY_ID = '''
   WHERE   id = ?
 '''
 
+## queries by case use with `.format(tablename)`, as the history of archived
+## cases is in `history_archive`
 SQL_GET_HISTORY_BY_CASE = '''
   SELECT    *
-  FROM      history
+  FROM      {}
   WHERE     case_id = ?
   ORDER BY  timestamp
 '''
 
+# a page of history, newest first
+SQL_GET_HISTORY_PAGE = '''
+  SELECT    *
+  FROM      {}
+  WHERE     case_id = ?
+  ORDER BY  timestamp DESC, id DESC
+  LIMIT     ?
+'''
+
+# a page of history older than a given (timestamp, id)
+SQL_GET_HISTORY_PAGE_BEFORE = '''
+  SELECT    *
+  FROM      {}
+  WHERE     case_id = ?
+  AND       (timestamp, id) < (?, ?)
+  ORDER BY  timestamp DESC, id DESC
+  LIMIT     ?
+'''
+
+# tables searched for a case's history in turn
+HISTORY_TABLES = ('history', 'history_archive')
+
+# ---------------------------------------------------------------------------
+#                                                                   helpers
+# ---------------------------------------------------------------------------
+
+def _encode_cursor(rec):
+  """
+  Encode the position of a history record as an opaque cursor.  The
+  timestamp is given as text, which both databases compare correctly with
+  their timestamps.
+  """
+  position = json.dumps([str(rec['timestamp']), rec['id']])
+  return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor):
+  """
+  Decode a cursor given by `_encode_cursor()` to a tuple (timestamp, id).
+
+  Raises:
+    BadCall: The cursor is invalid.
+  """
+  try:
+    (timestamp, id) = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+  except (binascii.Error, UnicodeError, ValueError, TypeError):
+    raise BadCall("Invalid cursor: {}".format(cursor))
+  if not isinstance(timestamp, str) or not isinstance(id, int) or isinstance(id, bool):
+    raise BadCall("Invalid cursor: {}".format(cursor))
+  return (timestamp, id)
+
 # ---------------------------------------------------------------------------
 #                                                              History class
 # ---------------------------------------------------------------------------
@@ -53,11 +108,54 @@ class History(CaseEvent):
 
   @classmethod
   def get_events(cls, caseID):
-    res = get_db().execute(SQL_GET_HISTORY_BY_CASE, (caseID,)).fetchall()
+    for table in HISTORY_TABLES:
+      res = get_db().execute(SQL_GET_HISTORY_BY_CASE.format(table), (caseID,)).fetchall()
+      if res:
+        break
     if not res:
       return None
     return [ History(record=rec) for rec in res ]
 
+  @classmethod
+  def get_events_page(cls, caseID, limit, before=None):
+    """
+    Retrieve a page of a case's history, newest first, using the position of
+    the last event of the previous page rather than an offset so that each
+    page is found directly from the index.
+
+    Args:
+      caseID: ID of case.
+      limit: Maximum number of events to return.
+      before: Cursor returned with the previous page, or None for the first
+        page.
+
+    Returns:
+      A tuple (events, next) of the list of events and the cursor for the
+      next page of older events, or None if there are no more.
+
+    Raises:
+      BadCall: The limit or cursor is invalid.
+    """
+    if limit < 1:
+      raise BadCall("Limit must be positive")
+
+    # fetch one more than requested to determine if there is another page
+    if before:
+      (timestamp, id) = _decode_cursor(before)
+      (sql, params) = (SQL_GET_HISTORY_PAGE_BEFORE, (caseID, timestamp, id, limit + 1))
+    else:
+      (sql, params) = (SQL_GET_HISTORY_PAGE, (caseID, limit + 1))
+    for table in HISTORY_TABLES:
+      res = get_db().execute(sql.format(table), params).fetchall()
+      if res:
+        break
+
+    following = None
+    if len(res) > limit:
+      res = res[:limit]
+      following = _encode_cursor(res[-1])
+    return ([ History(record=rec) for rec in res ], following)
+
   def __init__(self, id=None, caseID=None, record=None, analyst=None, timestamp=None,
     text=None, datum=None, was=None, now=None):
 
@@ -87,11 +185,11 @@ class History(CaseEvent):
       if id is None:
         if timestamp:
           id = db.insert_returning_id(SQL_CREATE_HISTORY_WITH_TIMESTAMP, (
-            caseID, analyst, self._text, timestamp, json.dumps(self._change)
+            caseID, analyst, self._text, timestamp, json.dumps(self._change, cls=JSONEncoder)
           ))
         else:
           id = db.insert_returning_id(SQL_CREATE_HISTORY, (
-            caseID, analyst, self._text, json.dumps(self._change)
+            caseID, analyst, self._text, json.dumps(self._change, cls=JSONEncoder)
           ))
         if not id:
           raise ResourceNotCreated('Could not create new record in history')
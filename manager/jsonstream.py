@@ -0,0 +1,258 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Incremental parsing of large JSON documents.
+
+Detector reports are JSON objects whose members are (potentially very long)
+arrays of records.  Rather than parsing the whole document into memory, the
+`ObjectStream` class reads the document from a stream of chunks and yields
+each member in turn, with arrays given as iterators yielding one record at a
+time.  Each record is parsed with the standard library's decoder, so only the
+record being parsed and the unparsed remainder of the current chunk are held
+in memory.  A value which fails to parse is only read further if the error
+may be due to the value continuing in the next chunk, and no value may grow
+beyond the stream's `max_value` characters.
+
+Basic usage:
+
+```
+for (name, value) in ObjectStream(chunks).members():
+  if isinstance(value, ArrayStream):
+    for record in value:
+      ...
+```
+"""
+
+import re
+import json
+import codecs
+
+# characters considered whitespace between JSON tokens
+_WHITESPACE = ' \t\n\r'
+
+# characters which may continue a number
+_NUMERIC = set('0123456789.eE+-')
+
+# remainder of the buffer after a parsing error which may be the start of a
+# token cut off at the end of the chunk, such as "tru", "1e-" or "\\u00"
+_PARTIAL_TOKEN = re.compile(r'[\w.+-]{1,12}')
+
+class JsonStreamError(ValueError):
+  """
+  Raised when the document is not valid JSON or not of the expected shape.
+  """
+
+class ArrayStream:
+  """
+  Iterator over the elements of an array being parsed by an `ObjectStream`.
+
+  The array must be iterated before the next member of the object can be
+  parsed.  If it is not, any remaining elements are parsed and discarded
+  when the next member is requested.
+  """
+
+  def __init__(self, parser):
+    self._parser = parser
+    self._done = False
+    self._first = True
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._done:
+      raise StopIteration
+    parser = self._parser
+
+    if self._first:
+      self._first = False
+      if parser.peek() == ']':
+        parser.advance()
+        self._done = True
+        raise StopIteration
+    else:
+      char = parser.next_token()
+      if char == ']':
+        self._done = True
+        raise StopIteration
+      if char != ',':
+        raise parser.error("Expected ',' or ']' in array")
+    return parser.value()
+
+  def drain(self):
+    """
+    Parse and discard any remaining elements.
+    """
+    for _ in self:
+      pass
+
+class ObjectStream:
+  """
+  Incremental parser for a JSON object read from a stream of byte chunks.
+
+  Args:
+    chunks: Iterable of byte strings, such as those read from a request
+      stream, which together form a UTF-8 encoded JSON document.
+    max_value: Optional maximum length, in characters, of any single value
+      read, such as a record of an array.
+  """
+
+  def __init__(self, chunks, max_value=None):
+    self._chunks = iter(chunks)
+    self._max_value = max_value
+    self._utf8 = codecs.getincrementaldecoder('utf-8')()
+    self._decoder = json.JSONDecoder()
+    self._buf = ''
+    self._pos = 0
+    self._eof = False
+
+  def error(self, message):
+    """
+    Return exception describing a parsing error at the current position.
+    """
+    return JsonStreamError("{} (near '{}')".format(
+      message, self._buf[self._pos:self._pos + 20]))
+
+  def _fill(self, minimum=1):
+    """
+    Read at least the given number of characters into the buffer.  Returns
+    False if at the end of the stream and nothing more could be read.
+    """
+    if self._eof:
+      return False
+
+    # discard what has been parsed already
+    self._buf = self._buf[self._pos:]
+    self._pos = 0
+
+    added = 0
+    pieces = [self._buf]
+    try:
+      while added < minimum:
+        try:
+          text = self._utf8.decode(next(self._chunks))
+        except StopIteration:
+          text = self._utf8.decode(b'', final=True)
+          self._eof = True
+        pieces.append(text)
+        added += len(text)
+        if self._eof:
+          break
+    except UnicodeDecodeError as e:
+      raise JsonStreamError("Invalid UTF-8 in document: {}".format(e))
+    self._buf = ''.join(pieces)
+    return added > 0
+
+  def _truncated(self, e):
+    """
+    Determine whether a parsing error may be due to the value continuing
+    beyond the buffer, rather than the document being invalid: the error is
+    at the end of the buffer, in a string running to the end, or in a token
+    which may be cut off.
+    """
+    return (e.pos >= len(self._buf)
+      or e.msg.startswith('Unterminated string')
+      or _PARTIAL_TOKEN.fullmatch(self._buf, e.pos) is not None)
+
+  def peek(self):
+    """
+    Return the next non-whitespace character without consuming it, or None
+    at the end of the document.
+    """
+    while True:
+      while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+        self._pos += 1
+      if self._pos < len(self._buf):
+        return self._buf[self._pos]
+      if not self._fill():
+        return None
+
+  def advance(self):
+    """
+    Consume the character returned by `peek()`.
+    """
+    self._pos += 1
+
+  def next_token(self):
+    """
+    Consume and return the next non-whitespace character.
+    """
+    char = self.peek()
+    if char is None:
+      raise self.error("Unexpected end of document")
+    self.advance()
+    return char
+
+  def value(self):
+    """
+    Parse and return the next complete JSON value.
+    """
+    if self.peek() is None:
+      raise self.error("Unexpected end of document")
+    while True:
+      try:
+        (value, end) = self._decoder.raw_decode(self._buf, self._pos)
+      except json.JSONDecodeError as e:
+        # may be incomplete: read at least as much again and retry, so that
+        # large values are not reparsed too often
+        if not self._truncated(e):
+          raise JsonStreamError("Invalid JSON: {}".format(e))
+        length = len(self._buf) - self._pos
+        if self._max_value is not None:
+          if length > self._max_value:
+            raise self.error("Value exceeds {} characters".format(self._max_value))
+          minimum = min(length, self._max_value + 1 - length)
+        else:
+          minimum = length
+        if self._fill(max(minimum, 1)):
+          continue
+        raise JsonStreamError("Invalid JSON: {}".format(e))
+
+      # a number at the end of the buffer may continue in the next chunk,
+      # including when the buffer ends partway through a fraction or exponent
+      # such as "1." or "1e-"
+      if (isinstance(value, (int, float))
+          and not isinstance(value, bool)
+          and _NUMERIC.issuperset(self._buf[end:])
+          and self._fill()):
+        continue
+
+      self._pos = end
+      return value
+
+  def members(self):
+    """
+    Parse the object, yielding tuples (name, value) for each member in
+    document order.  Where the value is an array, it is given as an
+    `ArrayStream` which yields each element in turn.
+
+    Raises:
+      JsonStreamError: The document is not a valid JSON object.
+    """
+    if self.next_token() != '{':
+      raise self.error("Expected object")
+    if self.peek() == '}':
+      self.advance()
+    else:
+      while True:
+        name = self.value()
+        if not isinstance(name, str):
+          raise self.error("Expected member name")
+        if self.next_token() != ':':
+          raise self.error("Expected ':' after member name")
+        if self.peek() == '[':
+          self.advance()
+          array = ArrayStream(self)
+          yield (name, array)
+          array.drain()
+        else:
+          yield (name, self.value())
+        char = self.next_token()
+        if char == '}':
+          break
+        if char != ',':
+          raise self.error("Expected ',' or '}' in object")
+
+    if self.peek() is not None:
+      raise self.error("Unexpected data after object")
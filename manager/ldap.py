@@ -1,23 +1,24 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
-# pylint: disable=assigning-non-slot
+# pylint: disable=assigning-non-slot,import-outside-toplevel
 # NOTE: "assigning-non-slot" test is broken in Pylint; can remove when
 #       https://github.com/PyCQA/pylint/issues/3793 resolved
 #
-import ldap
+# The LDAP client library is imported when a connection is first opened
+# rather than with the application, which does not otherwise need it.
+#
 from flask import current_app, g
-from ccldap import ccldap
 from manager.log import get_log
 from manager.exceptions import LdapException
 
-# LDAP options translation table
+# LDAP options translation table, by names of the client library's constants
 _ldap_opts = {
   'LDAP_TLS_REQCERT': (
-    ldap.OPT_X_TLS_REQUIRE_CERT,
+    'OPT_X_TLS_REQUIRE_CERT',
     {
-      'never':  ldap.OPT_X_TLS_NEVER,
-      'allow':  ldap.OPT_X_TLS_ALLOW,
-      'try':    ldap.OPT_X_TLS_TRY,
-      'demand': ldap.OPT_X_TLS_DEMAND
+      'never':  'OPT_X_TLS_NEVER',
+      'allow':  'OPT_X_TLS_ALLOW',
+      'try':    'OPT_X_TLS_TRY',
+      'demand': 'OPT_X_TLS_DEMAND'
     }
   )
 }
@@ -41,10 +42,12 @@ def _translate_options(config):
                   'LDAP_STUB')
   )
 
+  import ldap
+
   options = {}
   try:
     for key in filter(f, config):
-      options[_ldap_opts[key][0]] = _ldap_opts[key][1][config[key]]
+      options[getattr(ldap, _ldap_opts[key][0])] = getattr(ldap, _ldap_opts[key][1][config[key]])
   except KeyError as e:
     # pylint: disable=W0707
     # ...because I don't want to have the traceback of this expected exception
@@ -56,11 +59,13 @@ def _translate_options(config):
 def get_ldap():
   if 'ldap' not in g:
 
-    options = _translate_options(current_app.config)
-
     if current_app.config.get('LDAP_STUB'):
       g.ldap = current_app.config['LDAP_STUB']
     else:
+      import ldap
+      from ccldap import ccldap
+
+      options = _translate_options(current_app.config)
       try:
         binddn = current_app.config['LDAP_BINDDN']
         bindpw = current_app.config['LDAP_PASSWORD']
@@ -0,0 +1,189 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Idempotent ingestion of reports.
+
+Detectors retry reports on timeouts, and a report processed twice counts
+every case as reported twice.  Each report received is therefore recorded
+in the `report_ledger` table, keyed by the reporting component and either the
+`Idempotency-Key` header given by the detector or, failing that, the SHA-256
+digest of the report's payload.  A report matching one recorded within
+`IDEMPOTENCY_WINDOW` seconds is answered with the stored result of the
+original, without touching the case tables, or as a conflict if the original
+is still being processed.
+
+Detectors time out and retry precisely when processing is slow, so a report
+still being processed is not forgotten with the window.  Its claim is held
+until it completes or, should the worker processing it have died, for
+`IDEMPOTENCY_LEASE` seconds, which must exceed the longest time a report may
+take to process.
+
+Detectors report full snapshots, so consecutive reports may legitimately be
+identical.  Where reports are recognized by their payload, the window must
+therefore be shorter than the detector's reporting interval; detectors
+giving an `Idempotency-Key` with each report avoid this ambiguity.
+
+Basic usage:
+
+```
+claimed = claim(component, key, epoch)
+if claimed is not True:
+  ... answer with the `LedgerEntry` claimed
+try:
+  ... process report
+except Exception:
+  release(component, key)
+  raise
+complete(component, key, status, result)
+```
+"""
+
+import json
+from collections import namedtuple
+from flask import current_app
+from manager.db import get_db
+from manager.log import get_log
+
+# ---------------------------------------------------------------------------
+#                                                               SQL queries
+# ---------------------------------------------------------------------------
+
+## expires completed entries older than the window and unfinished claims
+## older than the lease
+SQL_EXPIRE = '''
+  DELETE FROM report_ledger
+  WHERE     (status IS NOT NULL AND epoch < ?)
+  OR        (status IS NULL AND epoch < ?)
+'''
+
+## claims an entry, replacing any which has expired
+SQL_CLAIM = '''
+  INSERT INTO report_ledger
+              (component, request_key, epoch)
+  VALUES      (?, ?, ?)
+  ON CONFLICT (component, request_key)
+  DO UPDATE
+  SET         epoch = excluded.epoch,
+              status = NULL,
+              result = NULL
+  WHERE       (report_ledger.status IS NOT NULL AND report_ledger.epoch < ?)
+  OR          (report_ledger.status IS NULL AND report_ledger.epoch < ?)
+'''
+
+SQL_GET_ENTRY = '''
+  SELECT    epoch, status, result
+  FROM      report_ledger
+  WHERE     component = ? AND request_key = ?
+'''
+
+SQL_COMPLETE = '''
+  UPDATE    report_ledger
+  SET       status = ?,
+            result = ?
+  WHERE     component = ? AND request_key = ?
+'''
+
+SQL_RELEASE = '''
+  DELETE FROM report_ledger
+  WHERE     component = ? AND request_key = ?
+'''
+
+# ---------------------------------------------------------------------------
+#                                                                 constants
+# ---------------------------------------------------------------------------
+
+# maximum length of an Idempotency-Key header
+MAX_KEY_LENGTH = 128
+
+# ---------------------------------------------------------------------------
+#                                                                   classes
+# ---------------------------------------------------------------------------
+
+LedgerEntry = namedtuple('LedgerEntry', ['epoch', 'status', 'result'])
+LedgerEntry.__doc__ = """
+Report recorded in the ledger.  The status and result (a dict) are None while
+the report is being processed.
+"""
+
+# ---------------------------------------------------------------------------
+#                                                          module functions
+# ---------------------------------------------------------------------------
+
+def payload_key(digest):
+  """
+  Return the ledger key of a report recognized by its payload's digest.
+  """
+  return 'sha256:' + digest
+
+def idempotency_key(key):
+  """
+  Return the ledger key of a report given an `Idempotency-Key`.
+
+  Raises:
+    ValueError: The key is empty or too long.
+  """
+  if not key or len(key) > MAX_KEY_LENGTH:
+    raise ValueError("Idempotency-Key must be 1 to {} characters".format(MAX_KEY_LENGTH))
+  return 'key:' + key
+
+def claim(component, key, epoch):
+  """
+  Record a report as being processed, unless the same report has been
+  recorded within the window or is still being processed.  Expired entries
+  and stale claims are discarded.  The claim is committed immediately so that
+  concurrent retries see it.
+
+  Args:
+    component: ID of the reporting component.
+    key: Key of the report, from `payload_key()` or `idempotency_key()`.
+    epoch: Epoch at which the report was received.
+
+  Returns:
+    True if the report was claimed, otherwise the `LedgerEntry` of the
+    original report.
+  """
+  cutoff = epoch - int(current_app.config['IDEMPOTENCY_WINDOW'])
+  stale = epoch - int(current_app.config['IDEMPOTENCY_LEASE'])
+  db = get_db()
+  try:
+    db.execute(SQL_EXPIRE, (cutoff, stale))
+    claimed = db.execute(SQL_CLAIM, (component, key, epoch, cutoff, stale)).rowcount
+    db.commit()
+  except Exception:
+    db.rollback()
+    raise
+  if claimed:
+    return True
+
+  rec = db.execute(SQL_GET_ENTRY, (component, key)).fetchone()
+  get_log().info("Report from %s already received at %d (%s)", component,
+    rec['epoch'], key)
+  return LedgerEntry(rec['epoch'], rec['status'],
+    json.loads(rec['result']) if rec['result'] else None)
+
+def complete(component, key, status, result):
+  """
+  Record the result of a report claimed with `claim()`, committing it along
+  with the changes made by the report, so that a report is never ingested
+  without its result being recorded.
+
+  Args:
+    component: ID of the reporting component.
+    key: Key of the report.
+    status: HTTP status with which the report was answered.
+    result: Dict with which the report was answered.
+  """
+  db = get_db()
+  db.execute(SQL_COMPLETE, (status, json.dumps(result), component, key))
+  db.commit()
+
+def release(component, key):
+  """
+  Discard the claim on a report which could not be processed, along with
+  any changes it made, so that it may be retried.
+  """
+  db = get_db()
+  db.rollback()
+  db.execute(SQL_RELEASE, (component, key))
+  db.commit()
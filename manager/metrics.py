@@ -0,0 +1,240 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Time series of the primary metric of each case, such as a burst's pain.
+
+Reports update cases in place, so a sample of the case's metric is recorded
+in the append-only `case_metrics` table each time a case is reported.  To keep
+queries over long ranges fast, samples are rolled up into hourly and daily
+buckets in `case_metrics_rollup` by the `flask rollup-metrics` command, which
+should be scheduled to run regularly, such as hourly with cron.  Each run
+recomputes the buckets from the one before the latest rolled up onwards, so
+that buckets still filling are completed by later runs, as are samples of
+reports committed just after a run.  Older buckets may be recomputed by
+giving the epoch from which to roll up, such as after upgrading.
+
+Neither table references `reportables`, so samples are kept when cases are
+archived and the tables may be used with partitioned databases.
+"""
+
+import click
+from flask.cli import with_appcontext
+from manager.db import get_db
+from manager.log import get_log
+from manager.exceptions import BadCall
+
+# ---------------------------------------------------------------------------
+#                                                               SQL queries
+# ---------------------------------------------------------------------------
+
+SQL_RECORD_SAMPLE = '''
+  INSERT INTO case_metrics
+              (case_id, epoch, value)
+  VALUES      (?, ?, ?)
+  ON CONFLICT (case_id, epoch)
+  DO UPDATE
+  SET         value = excluded.value
+'''
+
+## use with `.format(metric, tablename)`.  Samples the cases of a type on a
+## cluster at an epoch which have not already been sampled
+SQL_RECORD_SAMPLES = '''
+  INSERT INTO case_metrics
+              (case_id, epoch, value)
+  SELECT      R.id, R.epoch, B.{0}
+  FROM        reportables R
+  INNER JOIN  {1} B
+  ON          (R.id = B.id)
+  WHERE       R.cluster = ? AND R.epoch = ?
+  ON CONFLICT (case_id, epoch)
+  DO NOTHING
+'''
+
+SQL_GET_WATERMARK = '''
+  SELECT    MAX(bucket) AS bucket
+  FROM      case_metrics_rollup
+  WHERE     resolution = ?
+'''
+
+## buckets are grouped by position as the bucket expression is parameterized
+SQL_ROLLUP = '''
+  INSERT INTO case_metrics_rollup
+              (case_id, resolution, bucket, low, high, total, samples)
+  SELECT      case_id, ?, epoch / ? * ?, MIN(value), MAX(value), SUM(value), COUNT(*)
+  FROM        case_metrics
+  WHERE       epoch >= ?
+  GROUP BY    1, 3
+  ON CONFLICT (case_id, resolution, bucket)
+  DO UPDATE
+  SET         low = excluded.low,
+              high = excluded.high,
+              total = excluded.total,
+              samples = excluded.samples
+'''
+
+SQL_COUNT_SAMPLES = '''
+  SELECT    COUNT(*) AS count
+  FROM      case_metrics
+  WHERE     case_id = ? AND epoch >= ? AND epoch < ?
+'''
+
+SQL_GET_SAMPLES = '''
+  SELECT    epoch, value
+  FROM      case_metrics
+  WHERE     case_id = ? AND epoch >= ? AND epoch < ?
+  ORDER BY  epoch
+'''
+
+SQL_COUNT_BUCKETS = '''
+  SELECT    COUNT(*) AS count
+  FROM      case_metrics_rollup
+  WHERE     case_id = ? AND resolution = ? AND bucket >= ? AND bucket < ?
+'''
+
+SQL_GET_BUCKETS = '''
+  SELECT    bucket, total / samples AS mean, low, high
+  FROM      case_metrics_rollup
+  WHERE     case_id = ? AND resolution = ? AND bucket >= ? AND bucket < ?
+  ORDER BY  bucket
+'''
+
+# ---------------------------------------------------------------------------
+#                                                                 constants
+# ---------------------------------------------------------------------------
+
+# resolutions of the rollups, by name, as the width of their buckets in
+# seconds
+RESOLUTIONS = {
+  'hour': 60 * 60,
+  'day': 24 * 60 * 60,
+}
+
+# maximum number of points served in a series when the resolution is chosen
+# automatically
+MAX_POINTS = 500
+
+# upper bound of ranges not otherwise limited
+_END_OF_TIME = 2 ** 31 - 1
+
+# ---------------------------------------------------------------------------
+#                                                          module functions
+# ---------------------------------------------------------------------------
+
+def record_sample(case_id, epoch, value):
+  """
+  Record a sample of a case's metric, replacing any already recorded for the
+  same epoch.  The caller must commit.
+
+  Args:
+    case_id: The case ID.
+    epoch: The epoch of the report.
+    value: The value of the case's metric as reported.
+  """
+  get_db().execute(SQL_RECORD_SAMPLE, (case_id, epoch, value))
+
+def record_samples(table, metric, cluster, epoch):
+  """
+  Record a sample of the metric of each case of a type reported at an epoch
+  which has not already been sampled, such as cases carried forward in bulk
+  by a delta report.  The caller must commit.
+
+  Args:
+    table: The table of the case type.
+    metric: The column of the case type's metric.
+    cluster: The reporting cluster.
+    epoch: The epoch of the report.
+  """
+  get_db().execute(SQL_RECORD_SAMPLES.format(metric, table), (cluster, epoch))
+
+def rollup_metrics(since=None):
+  """
+  Roll up samples into buckets of each resolution.  Unless otherwise
+  specified, the latest two buckets of each resolution are recomputed along
+  with any later ones.
+
+  Args:
+    since: Epoch from which to roll up samples, or None.
+
+  Returns:
+    Dict of resolution names to the number of buckets written.
+  """
+  db = get_db()
+  written = {}
+  try:
+    for (name, width) in RESOLUTIONS.items():
+      start = since
+      if start is None:
+        watermark = db.execute(SQL_GET_WATERMARK, (width,)).fetchone()['bucket']
+        start = max((watermark or 0) - width, 0)
+      written[name] = db.execute(SQL_ROLLUP,
+        (width, width, width, start // width * width)).rowcount
+      db.commit()
+  except Exception:
+    db.rollback()
+    raise
+
+  get_log().debug("Rolled up metrics: %s", written)
+  return written
+
+def get_series(case_id, resolution=None, since=None, until=None):
+  """
+  Get the time series of a case's metric.
+
+  Without a resolution, raw samples are served if there are no more than
+  `MAX_POINTS` of them in the range, otherwise the finest rollup with no more
+  than that many buckets, or failing that daily buckets.
+
+  Args:
+    case_id: The case ID.
+    resolution: `raw`, or the name of a rollup resolution (`hour` or `day`).
+    since: Epoch from which to include samples, or None.
+    until: Epoch before which to include samples, or None.
+
+  Returns:
+    Tuple (resolution, points).  Raw points are lists [epoch, value] and
+    rollup points are lists [bucket, mean, low, high] where bucket is the
+    epoch at the start of the bucket.
+
+  Raises:
+    BadCall: The resolution is not recognized.
+  """
+  if resolution not in (None, 'raw') and resolution not in RESOLUTIONS:
+    raise BadCall("Unrecognized resolution: {}".format(resolution))
+  since = since or 0
+  until = until or _END_OF_TIME
+
+  db = get_db()
+  if resolution is None:
+    resolution = 'day'
+    candidates = [('raw', SQL_COUNT_SAMPLES, (case_id, since, until))] + [
+      (name, SQL_COUNT_BUCKETS, (case_id, width, since, until))
+      for (name, width) in RESOLUTIONS.items()
+    ]
+    for (name, sql, terms) in candidates:
+      if db.execute(sql, terms).fetchone()['count'] <= MAX_POINTS:
+        resolution = name
+        break
+
+  if resolution == 'raw':
+    res = db.execute(SQL_GET_SAMPLES, (case_id, since, until)).fetchall()
+    return (resolution, [[rec['epoch'], rec['value']] for rec in res or []])
+
+  res = db.execute(SQL_GET_BUCKETS,
+    (case_id, RESOLUTIONS[resolution], since, until)).fetchall()
+  return (resolution, [
+    [rec['bucket'], rec['mean'], rec['low'], rec['high']] for rec in res or []
+  ])
+
+# ---------------------------------------------------------------------------
+#                                                              CLI commands
+# ---------------------------------------------------------------------------
+
+@click.command('rollup-metrics')
+@click.option('--since', type=int, default=None,
+  help="Epoch from which to roll up samples, rather than the latest buckets")
+@with_appcontext
+def rollup_metrics_command(since):
+  """Roll up case metrics into hourly and daily buckets."""
+  for (name, count) in rollup_metrics(since).items():
+    click.echo("Wrote {} {} buckets".format(count, name))
@@ -3,6 +3,7 @@
 #
 import json
 from manager.db import get_db
+from manager.encoding import JSONEncoder
 from manager.log import get_log
 from manager.exceptions import DatabaseException
 
@@ -107,7 +108,7 @@ class Notification():
     # creating or retrieving?
     if not id:
       db = get_db()
-      serialized = json.dumps(data)
+      serialized = json.dumps(data, cls=JSONEncoder)
       try:
         db.execute(NOTFN_CREATE_NEW, (context, recipient, sender, serialized))
         db.commit()
@@ -1,8 +1,7 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
-# pylint: disable=raise-missing-from
+# pylint: disable=raise-missing-from,import-outside-toplevel
 #
 import json
-import requests
 from manager.db import get_db
 from manager.log import get_log
 from manager.notifier import register_notifier, Notifier, SQL_GET_NOTIFIER
@@ -57,6 +56,9 @@ class SlackNotifier(Notifier):
     if self._emoji:
       data['icon_emoji'] = self._emoji
 
+    # imported on first use, as it is slow to import
+    import requests
+
     r = requests.post(self._url, data=json.dumps(data))
     if r.status_code == 200:
       get_log().info("Sent Slack notification")
@@ -5,7 +5,7 @@ from flask_babel import _
 from manager.log import get_log
 from manager.db import get_db, DbEnum
 from manager.exceptions import InvalidApiCall, ResourceNotCreated
-from manager.case import Case, registry
+from manager.case import Case, registry, column_setter
 
 # enum of resources
 class JobResource(DbEnum):
@@ -35,12 +35,31 @@ SQL_UPDATE_BY_ID = '''
 class OldJob(Case):
 
   _table = 'oldjobs'
+  _enums = {
+    'resource': JobResource
+  }
+  __slots__ = ('_resource', '_age', '_submitter')
+  _fields = Case._fields + tuple(slot[1:] for slot in __slots__)
+  _columns = dict(Case._columns,
+    resource=column_setter('_resource', JobResource),
+    age=column_setter('_age'),
+    submitter=column_setter('_submitter'),
+  )
+  _report_schema = (
+    ('account', str),
+    ('resource', str),
+    ('age', (int, float)),
+    ('submitter', str),
+    ('summary', (dict, type(None))),
+  )
+
+  _metric = 'age'
 
   @classmethod
   def describe_me(cls):
     return {
       'title': _('Job age'),
-      'metric': 'age',
+      'metric': cls._metric,
       'cols': [
         { 'datum': 'resource',
           'searchable': True,
@@ -72,7 +91,7 @@ class OldJob(Case):
     Args:
       cluster: reporting cluster
       epoch: epoch of report (UTC)
-      data: list of dicts describing current instances of potential account
+      data: iterable of dicts describing current instances of potential account
             or job pain or other metrics, as appropriate for the type of
             report.
 
@@ -96,8 +115,18 @@ class OldJob(Case):
     ```
     """
 
-    # build list of objects from report
-    records = []
+    # report event, creating or updating each record as it is summarized so
+    # that records need not all be held at once
+    return cls.summarize_report(cls._records_from_report(cluster, epoch, data))
+
+  @classmethod
+  def _records_from_report(cls, cluster, epoch, data):
+    """
+    Yield old job objects for each record in the report, in turn.
+
+    Raises:
+      InvalidApiCall: A record does not conform to the API.
+    """
     for record in data:
 
       # get the submitted data
@@ -119,17 +148,14 @@ class OldJob(Case):
       except KeyError as e:
         raise InvalidApiCall("Invalid resource type: {}".format(e))
 
-      records.append(cls(
+      yield cls(
         account=account,
         cluster=cluster,
         epoch=epoch,
         submitter=submitter,
         resource=resource,
         age=age,
-        summary=summary))
-
-    # report event
-    return cls.summarize_report(records)
+        summary=summary)
 
   def __init__(self, id=None, record=None,
       account=None, cluster=None, epoch=None, submitter=None, resource=None, age=None, summary=None
@@ -137,14 +163,11 @@ class OldJob(Case):
     if id or record:
       super().__init__(id=id, record=record)
     else:
-      self._resource = resource
+      self._resource = JobResource(resource)
       self._age = age
       self._submitter = submitter
       super().__init__(account=account, cluster=cluster, epoch=epoch, summary=summary)
 
-    # now fix up a few special data types
-    self._resource = JobResource(self._resource)
-
   def update_existing_me(self, rec):
     affected = get_db().execute(SQL_UPDATE_BY_ID, (
       self._age, self._submitter, self._id
@@ -162,6 +185,18 @@ class OldJob(Case):
       ('resource', 'age', 'submitter')
     )
 
+  @classmethod
+  def resolved_query(cls, record):
+    try:
+      res_raw = record['resource']
+    except KeyError as e:
+      raise InvalidApiCall("Missing required field: {}".format(e))
+    try:
+      resource = JobResource.get(res_raw)
+    except KeyError as e:
+      raise InvalidApiCall("Invalid resource type: {}".format(e))
+    return ("resource = ?", [resource])
+
   def insert_new(self):
     try:
       get_db().execute(SQL_INSERT_NEW, (
@@ -170,7 +205,7 @@ class OldJob(Case):
     # TODO: develop normalized exceptions for different database types
     #       except UniqueViolation:
     except Exception:
-      get_log().debug("Could not create OldJob record: %s", self.__dict__)
+      get_log().debug("Could not create OldJob record: %s", self.serialize())
       raise ResourceNotCreated("Unable to create OldJob record")
 
   @property
@@ -1,11 +1,13 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
-# pylint: disable=raise-missing-from
+# pylint: disable=raise-missing-from,import-outside-toplevel
+#
+# The OTRS client library, along with the HTTP library it uses, is imported
+# when first used rather than with the application.
 #
 
 # TODO: use this instead of Exception in get_otrs()--but wasn't
 # getting caught
 #from requests import HTTPError
-import pyotrs
 from .exceptions import BadConfig
 
 # TEMPORARY FOR TESTING
@@ -71,6 +73,7 @@ def get_otrs():
         client = None
       else:
         # create OTRS client object
+        import pyotrs
         try:
           get_log().debug("Creating OTRS client session with url=%s, username=%s", url, user)
           client = pyotrs.Client(url, user, pw)
@@ -123,6 +126,7 @@ def create_ticket(title, body, owner, client, clientEmail, CCs=None):
     raise BadConfig("Missing OTRS configuration")
 
   # create ticket object
+  import pyotrs
   ticket = pyotrs.lib.Ticket.create_basic(
     Title=title,
     Queue=queue,
@@ -0,0 +1,356 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Optional range partitioning of the largest Postgres tables.
+
+Detector reports add to the `reportables` table every epoch, and analysts'
+changes add to `history`.  In large deployments these may be partitioned by
+month: `reportables` by `epoch` and `history` by `timestamp`.  Queries for
+the current cases of a cluster are then confined to the partition of the
+current epoch, and old partitions can be detached rather than vacuumed.
+
+The database is converted once with `flask partition-db`, and partitions are
+maintained with `flask maintain-partitions`, which should be scheduled to run
+regularly, such as daily with cron.  Maintenance creates partitions for the
+coming months and optionally detaches and drops partitions older than a given
+number of months, once they are empty.  Cases no longer reported are expected
+to have been archived (see `manager.archive`) by then.  Partitions still
+holding rows, such as the history of cases still current, are kept and
+reported, as moving their rows to the default partition would defeat
+partition pruning.
+
+Partitions are named for the table and month, such as `reportables_p202610`.
+Each table also has a default partition, `<table>_default`, for rows outside
+the ranges of the monthly partitions.
+"""
+
+import calendar
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from manager.db import get_db, get_schema_version, SQL_SCRIPTS_DIR
+from manager.log import get_log
+from manager import exceptions
+
+# ---------------------------------------------------------------------------
+#                                                               SQL queries
+# ---------------------------------------------------------------------------
+
+SQL_IS_PARTITIONED = '''
+  SELECT  partrelid
+  FROM    pg_partitioned_table
+  WHERE   partrelid = to_regclass(?)
+'''
+
+SQL_GET_PARTITIONS = '''
+  SELECT    C.relname AS name
+  FROM      pg_inherits I
+  JOIN      pg_class C
+  ON        (C.oid = I.inhrelid)
+  WHERE     I.inhparent = to_regclass(?)
+'''
+
+## use with `.format(table)`
+SQL_GET_EARLIEST = '''
+  SELECT  MIN({}) AS earliest
+  FROM    {}_unpartitioned
+'''
+
+## use with `.format(partition, table)`
+SQL_CREATE_PARTITION = '''
+  CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+'''
+
+## use with `.format(partition, table, key, lower, upper)`.  Rows in
+## the default partition must be moved out before the new partition can be
+## attached.
+SQL_MOVE_FROM_DEFAULT = '''
+  WITH      moved AS (
+              DELETE FROM {1}_default
+              WHERE {2} >= {3} AND {2} < {4}
+              RETURNING *
+            )
+  INSERT INTO {0}
+  SELECT    *
+  FROM      moved
+'''
+
+## use with `.format(table, partition, lower, upper)`
+SQL_ATTACH_PARTITION = '''
+  ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})
+'''
+
+## use with `.format(table, partition)`
+SQL_DETACH_PARTITION = '''
+  ALTER TABLE {} DETACH PARTITION {}
+'''
+
+## use with `.format(table)`
+SQL_HAS_ROWS = '''
+  SELECT  1 AS found
+  FROM    {}
+  LIMIT   1
+'''
+
+## use with `.format(table, source)`
+SQL_COPY_ROWS = '''
+  INSERT INTO {}
+  SELECT    *
+  FROM      {}
+'''
+
+## use with `.format(table)`
+SQL_DROP_TABLE = '''
+  DROP TABLE {}
+'''
+
+# ---------------------------------------------------------------------------
+#                                                                 constants
+# ---------------------------------------------------------------------------
+
+# script converting the tables
+PARTITION_SCRIPT = 'partition.psql'
+
+# partitioned tables, by name, and their partition key with a function giving
+# the SQL literal for the start of a month (year, month) in that key
+PARTITIONED = {
+  'reportables': ('epoch', lambda year, month: str(calendar.timegm((year, month, 1, 0, 0, 0)))),
+  'history': ('timestamp', lambda year, month: "'{:04d}-{:02d}-01'".format(year, month)),
+}
+
+# default number of months ahead for which partitions are created
+MONTHS_AHEAD = 3
+
+# maximum number of months before the current one for which partitions are
+# created when converting; older rows are placed in the default partition
+MONTHS_BACK = 12
+
+# ---------------------------------------------------------------------------
+#                                                                   helpers
+# ---------------------------------------------------------------------------
+
+def _add_months(month, count):
+  """
+  Return the month (year, month) the given number of months after another.
+  """
+  index = month[0] * 12 + month[1] - 1 + count
+  return (index // 12, index % 12 + 1)
+
+def _current_month():
+  now = datetime.now(timezone.utc)
+  return (now.year, now.month)
+
+def _partition_name(table, month):
+  return '{}_p{:04d}{:02d}'.format(table, month[0], month[1])
+
+def _partition_months(table):
+  """
+  Get the months of the monthly partitions of a table, as a dict of months
+  (year, month) to partition names.
+  """
+  prefix = table + '_p'
+  months = {}
+  for rec in get_db().execute(SQL_GET_PARTITIONS, (table,)).fetchall() or []:
+    name = rec['name']
+    suffix = name[len(prefix):]
+    if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+      months[(int(suffix[:4]), int(suffix[4:]))] = name
+  return months
+
+def _add_partition(table, month):
+  """
+  Create and attach the partition of a table for the given month, moving
+  into it any rows for that month from the default partition.  The caller
+  must commit.
+  """
+  (key, literal) = PARTITIONED[table]
+  partition = _partition_name(table, month)
+  lower = literal(*month)
+  upper = literal(*_add_months(month, 1))
+
+  db = get_db()
+  db.execute(SQL_CREATE_PARTITION.format(partition, table))
+  db.execute(SQL_MOVE_FROM_DEFAULT.format(partition, table, key, lower, upper))
+  db.execute(SQL_ATTACH_PARTITION.format(table, partition, lower, upper))
+  get_log().info("Created partition %s", partition)
+  return partition
+
+def _detach_partition(table, partition):
+  """
+  Detach and drop a partition of a table if it is empty.  The partition is
+  checked once detached, so that no rows can be added meanwhile.  The caller
+  must commit if the partition was dropped, or otherwise roll back to
+  reattach it.
+
+  Returns:
+    True if the partition was dropped, or False if it still has rows.
+  """
+  db = get_db()
+  db.execute(SQL_DETACH_PARTITION.format(table, partition))
+  if db.execute(SQL_HAS_ROWS.format(partition)).fetchone():
+    get_log().info("Not detaching partition %s, which still has rows", partition)
+    return False
+  db.execute(SQL_DROP_TABLE.format(partition))
+  get_log().info("Detached partition %s", partition)
+  return True
+
+def _check_postgres():
+  db = get_db()
+  if db.type != 'postgres':
+    raise exceptions.UnsupportedDatabase(db.type)
+  return db
+
+# ---------------------------------------------------------------------------
+#                                                          module functions
+# ---------------------------------------------------------------------------
+
+def is_partitioned():
+  """
+  Determine whether the database's tables have been partitioned.
+  """
+  db = get_db()
+  if db.type != 'postgres':
+    return False
+  return db.execute(SQL_IS_PARTITIONED, ('reportables',)).fetchone() is not None
+
+def partition_db(months_ahead=MONTHS_AHEAD):
+  """
+  Convert the database's `reportables` and `history` tables to partitioned
+  tables, with monthly partitions from the earliest data (but no more than
+  `MONTHS_BACK` months ago) to the given number of months ahead.  This is
+  done in a single transaction, during which the tables are locked.
+
+  Args:
+    months_ahead: Number of months after the current one for which to create
+      partitions.
+
+  Returns:
+    List of descriptions of actions taken.
+
+  Raises:
+    UnsupportedDatabase: The database is not Postgres.
+    DatabaseException: The tables have already been partitioned or the
+      schema is not at the version expected.
+  """
+  db = _check_postgres()
+  if is_partitioned():
+    raise exceptions.DatabaseException("Database is already partitioned")
+  (actual, expected) = get_schema_version()
+  if actual != expected:
+    raise exceptions.DatabaseException(
+      "Database schema is at version {} rather than {}; upgrade first".format(actual, expected))
+
+  actions = []
+  current = _current_month()
+  try:
+    with current_app.open_resource("{}/{}".format(SQL_SCRIPTS_DIR, PARTITION_SCRIPT)) as f:
+      db.executescript(f.read().decode('utf8'))
+
+    for (table, (key, _literal)) in PARTITIONED.items():
+      month = _add_months(current, -MONTHS_BACK)
+      earliest = db.execute(SQL_GET_EARLIEST.format(key, table)).fetchone()['earliest']
+      if earliest is not None:
+        if isinstance(earliest, int):
+          earliest = datetime.fromtimestamp(earliest, timezone.utc)
+        month = max(month, (earliest.year, earliest.month))
+      month = min(month, current)
+
+      while month <= _add_months(current, months_ahead):
+        actions.append("Created partition {}".format(_add_partition(table, month)))
+        month = _add_months(month, 1)
+
+      count = db.execute(SQL_COPY_ROWS.format(table, table + '_unpartitioned')).rowcount
+      db.execute(SQL_DROP_TABLE.format(table + '_unpartitioned'))
+      actions.append("Moved {} rows to partitioned {}".format(count, table))
+    db.commit()
+  except Exception:
+    db.rollback()
+    raise
+
+  return actions
+
+def maintain_partitions(months_ahead=MONTHS_AHEAD, detach_after=None):
+  """
+  Create partitions for the current month and those ahead where missing, and
+  optionally detach old partitions.  Each partition is created or detached
+  in its own transaction.
+
+  Args:
+    months_ahead: Number of months after the current one for which to create
+      partitions.
+    detach_after: If given, partitions for months at least this many months
+      before the current one are detached and dropped if they are empty.
+
+  Returns:
+    List of descriptions of actions taken.
+
+  Raises:
+    UnsupportedDatabase: The database is not Postgres.
+    DatabaseException: The tables have not been partitioned.
+  """
+  db = _check_postgres()
+  if not is_partitioned():
+    raise exceptions.DatabaseException("Database is not partitioned; see `flask partition-db`")
+
+  actions = []
+  current = _current_month()
+  for table in PARTITIONED:
+    existing = _partition_months(table)
+    try:
+      for count in range(months_ahead + 1):
+        month = _add_months(current, count)
+        if month not in existing:
+          actions.append("Created partition {}".format(_add_partition(table, month)))
+          db.commit()
+
+      if detach_after is not None:
+        cutoff = _add_months(current, -detach_after)
+        for (month, partition) in sorted(existing.items()):
+          if month > cutoff:
+            continue
+          if _detach_partition(table, partition):
+            db.commit()
+            actions.append("Detached partition {}".format(partition))
+          else:
+            db.rollback()
+            actions.append("Kept partition {}, which still has rows".format(partition))
+    except Exception:
+      db.rollback()
+      raise
+
+  return actions
+
+# ---------------------------------------------------------------------------
+#                                                              CLI commands
+# ---------------------------------------------------------------------------
+
+@click.command('partition-db')
+@click.option('--months-ahead', type=int, default=MONTHS_AHEAD, show_default=True,
+  help="Number of months ahead for which to create partitions")
+@with_appcontext
+def partition_db_command(months_ahead):
+  """Partition case tables by month (Postgres only)."""
+  try:
+    actions = partition_db(months_ahead)
+  except exceptions.AppException as e:
+    raise click.ClickException(str(e)) from e
+  click.echo("\n".join(actions))
+  click.echo("Partitioned the database.")
+
+@click.command('maintain-partitions')
+@click.option('--months-ahead', type=int, default=MONTHS_AHEAD, show_default=True,
+  help="Number of months ahead for which to create partitions")
+@click.option('--detach-after', type=int, default=None,
+  help="Detach empty partitions for months at least this many months ago")
+@with_appcontext
+def maintain_partitions_command(months_ahead, detach_after):
+  """Create upcoming partitions and detach old ones (Postgres only)."""
+  if detach_after is not None and detach_after < 1:
+    raise click.BadParameter("Must be at least 1", param_hint='--detach-after')
+  try:
+    actions = maintain_partitions(months_ahead, detach_after)
+  except exceptions.AppException as e:
+    raise click.ClickException(str(e)) from e
+  click.echo("\n".join(actions) if actions else "No changes to partitions.")
@@ -1,22 +1,48 @@
 DROP TABLE IF EXISTS schemalog;
+DROP TABLE IF EXISTS schema_progress;
 DROP TABLE IF EXISTS apikeys;
+DROP TABLE IF EXISTS report_ledger;
 DROP TABLE IF EXISTS notifications;
 DROP TABLE IF EXISTS components;
+DROP TABLE IF EXISTS history_archive;
+DROP TABLE IF EXISTS case_users_archive;
+DROP TABLE IF EXISTS bursts_archive;
+DROP TABLE IF EXISTS oldjobs_archive;
+DROP TABLE IF EXISTS reportables_archive;
 DROP TABLE IF EXISTS bursts;
 DROP TABLE IF EXISTS notifiers;
 DROP TABLE IF EXISTS oldjobs;
 DROP TABLE IF EXISTS history;
+DROP TABLE IF EXISTS case_users;
+DROP TABLE IF EXISTS case_metrics;
+DROP TABLE IF EXISTS case_metrics_rollup;
 DROP TABLE IF EXISTS reportables;
 DROP TABLE IF EXISTS clusters;
 DROP TABLE IF EXISTS templates_content;
 DROP TABLE IF EXISTS appropriate_templates;
 DROP TABLE IF EXISTS templates;
+DROP TABLE IF EXISTS case_versions;
 
 CREATE TABLE schemalog (
   version VARCHAR(10) PRIMARY KEY,
   applied TIMESTAMP
 );
-INSERT INTO schemalog (version, applied) VALUES ('20211005', CURRENT_TIMESTAMP);
+INSERT INTO schemalog (version, applied) VALUES ('20261029', CURRENT_TIMESTAMP);
+
+/*
+ * Progress of upgrade scripts run in segments, by which an interrupted
+ * upgrade resumes where it stopped (see `manager.db.upgrade_schema()`).  Each
+ * segment of a script is recorded once completed, and batched segments also
+ * record the key from which to continue.  A script's rows are removed when it
+ * completes.
+ */
+CREATE TABLE schema_progress (
+  script VARCHAR(64) NOT NULL,
+  segment INTEGER NOT NULL,
+  position BIGINT,
+  completed INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (script, segment)
+);
 
 CREATE TABLE clusters (
   id VARCHAR(16) UNIQUE NOT NULL,
@@ -43,6 +69,26 @@ CREATE TABLE apikeys (
   FOREIGN KEY (component) REFERENCES components(id)
 );
 
+/*
+ * Ledger of reports received, by which retried reports are recognized and
+ * answered with the result of the original (see manager/ledger.py).  Reports
+ * are keyed by the digest of their payload or the Idempotency-Key given by
+ * the detector.  Entries are only kept for a short window so there is no
+ * foreign key to components.  A null status indicates the report is still
+ * being processed.
+ */
+CREATE TABLE report_ledger (
+  component VARCHAR(32) NOT NULL,
+  request_key VARCHAR(160) NOT NULL,
+  epoch INTEGER NOT NULL,
+  status INTEGER,
+  result TEXT,
+  PRIMARY KEY (component, request_key)
+) WITHOUT ROWID;
+
+-- supports expiring entries
+CREATE INDEX report_ledger_epoch_idx ON report_ledger (epoch);
+
 CREATE TABLE notifications (
   id INTEGER PRIMARY KEY,
   context INTEGER NOT NULL,
@@ -100,10 +146,17 @@ CREATE TABLE reportables (
   claimant CHAR(7),
   ticket_id INTEGER,
   ticket_no VARCHAR(9),
-  summary TEXT,
+  summary TEXT, -- JSON; JSONB in Postgres
   FOREIGN KEY (cluster) REFERENCES clusters(id)
 );
 
+-- supports searching for cases by account prefix across clusters
+CREATE INDEX reportables_account_idx ON reportables (account COLLATE NOCASE, cluster);
+
+-- supports finding the existing case matching a reported one; the index above
+-- does not serve exact matches as it ignores case
+CREATE INDEX reportables_case_idx ON reportables (account, cluster);
+
 /*
  * state: 'p' = pending/unactioned, 'a' = accepted, 'r' = rejected
  * resource: 'c' = CPU, 'g' = GPU
@@ -123,6 +176,9 @@ CREATE TABLE bursts (
   FOREIGN KEY (id) REFERENCES reportables(id)
 ) WITHOUT ROWID;
 
+-- supports matching reported bursts to those they continue
+CREATE INDEX bursts_continuation_idx ON bursts (resource, lastjob);
+
 -- tables keying to reportables must be declared as WITHOUT ROWID
 -- so that the primary key is not tied to the row ID
 CREATE TABLE oldjobs (
@@ -142,3 +198,120 @@ CREATE TABLE history (
   change TEXT,
   FOREIGN KEY (case_id) REFERENCES reportables(id)
 );
+
+-- supports paging through a case's history in order of time
+CREATE INDEX history_case_idx ON history (case_id, timestamp, id);
+
+/*
+ * Users involved in each case, such as the submitters of a burst's jobs, so
+ * that the cases involving a user can be found.  There is no foreign key to
+ * reportables so that it may be partitioned (see manager/sql/README.md).
+ */
+CREATE TABLE case_users (
+  case_id INTEGER NOT NULL,
+  username VARCHAR(32) NOT NULL,
+  PRIMARY KEY (case_id, username)
+) WITHOUT ROWID;
+
+CREATE INDEX case_users_username_idx ON case_users (username, case_id);
+
+/*
+ * Samples of the primary metric of each case, such as a burst's pain, taken
+ * each time the case is reported, and their hourly and daily rollups, from
+ * which a case's trend is charted (see manager/metrics.py).  Rollups are
+ * maintained by `flask rollup-metrics`.  As with case_users there are no
+ * foreign keys to reportables, and samples are kept when cases are archived.
+ */
+CREATE TABLE case_metrics (
+  case_id INTEGER NOT NULL,
+  epoch INTEGER NOT NULL,
+  value REAL NOT NULL,
+  PRIMARY KEY (case_id, epoch)
+) WITHOUT ROWID;
+
+-- supports rolling up samples since the latest bucket
+CREATE INDEX case_metrics_epoch_idx ON case_metrics (epoch);
+
+CREATE TABLE case_metrics_rollup (
+  case_id INTEGER NOT NULL,
+  resolution INTEGER NOT NULL,
+  bucket INTEGER NOT NULL,
+  low REAL NOT NULL,
+  high REAL NOT NULL,
+  total REAL NOT NULL,
+  samples INTEGER NOT NULL,
+  PRIMARY KEY (case_id, resolution, bucket)
+) WITHOUT ROWID;
+
+-- supports finding the latest bucket of each resolution
+CREATE INDEX case_metrics_rollup_bucket_idx ON case_metrics_rollup (resolution, bucket);
+
+/*
+ * Archived cases, moved from the tables above by `flask archive-cases` once
+ * they are no longer reported, so that those tables and their indexes stay
+ * small.  Each case type's table has an archive counterpart named with the
+ * suffix "_archive", with the same columns as the original, by name.
+ */
+CREATE TABLE reportables_archive (
+  id INTEGER PRIMARY KEY,
+  epoch INTEGER NOT NULL,
+  ticks INTEGER NOT NULL DEFAULT 1,
+  account VARCHAR(32) NOT NULL,
+  cluster VARCHAR(16) NOT NULL,
+  claimant CHAR(7),
+  ticket_id INTEGER,
+  ticket_no VARCHAR(9),
+  summary TEXT,
+  FOREIGN KEY (cluster) REFERENCES clusters(id)
+);
+
+CREATE TABLE bursts_archive (
+  id INTEGER PRIMARY KEY,
+  state CHAR(1) NOT NULL DEFAULT 'p',
+  resource CHAR(1) NOT NULL DEFAULT 'c',
+  pain REAL NOT NULL,
+  firstjob INTEGER NOT NULL,
+  lastjob INTEGER NOT NULL,
+  submitters TEXT NOT NULL,
+  FOREIGN KEY (id) REFERENCES reportables_archive(id)
+) WITHOUT ROWID;
+
+CREATE TABLE oldjobs_archive (
+  id INTEGER PRIMARY KEY,
+  submitter VARCHAR(32) NOT NULL,
+  resource CHAR(1) NOT NULL DEFAULT 'c',
+  age INTEGER NOT NULL,
+  FOREIGN KEY (id) REFERENCES reportables_archive(id)
+) WITHOUT ROWID;
+
+CREATE TABLE history_archive (
+  id INTEGER PRIMARY KEY,
+  case_id INTEGER NOT NULL,
+  analyst CHAR(7),
+  timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  note TEXT,
+  change TEXT,
+  FOREIGN KEY (case_id) REFERENCES reportables_archive(id)
+);
+
+CREATE INDEX history_archive_case_idx ON history_archive (case_id, timestamp, id);
+
+CREATE TABLE case_users_archive (
+  case_id INTEGER NOT NULL,
+  username VARCHAR(32) NOT NULL,
+  PRIMARY KEY (case_id, username),
+  FOREIGN KEY (case_id) REFERENCES reportables_archive(id)
+) WITHOUT ROWID;
+
+/*
+ * Modification counter for the current cases of each type on each cluster,
+ * incremented whenever those cases are reported or updated.  Used to derive
+ * entity tags for the case views.  epoch is that of the latest report.
+ */
+CREATE TABLE case_versions (
+  cluster VARCHAR(16) NOT NULL,
+  casetype VARCHAR(32) NOT NULL,
+  serial INTEGER NOT NULL DEFAULT 0,
+  epoch INTEGER,
+  PRIMARY KEY (cluster, casetype)
+);
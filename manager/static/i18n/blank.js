@@ -8,6 +8,11 @@ i18n_strings = {
     "REVERT": "R#####",
     "TITLE": "T####",
     "BODY": "B###",
+    "ACCOUNT": "A######",
+    "LAST_REPORTED": "L### ########",
+    "ANALYST": "A######",
+    "TICKET": "T#####",
+    "SEARCH": "S#####",
 
     // used for accordion headers, like "Bursts candidates - reported 2021-11-22 03:42 a.m."
     "REPORT_HEADER": "$1 - ######## $2",
@@ -29,6 +34,17 @@ i18n_strings = {
     "FAILED_TO_RETRIEVE_CASE_INFO": "F##### ## ######## #### ####",
     "RETRIEVING_EVENTS": "R######### ######...",
     "FAILED_TO_RETRIEVE_EVENTS": "F##### ## ######## ######",
+    "OLDER_EVENTS": "S### ##### ######",
+    "SEARCH_ACCOUNTS": "S##### ########",
+    "SEARCHING_ACCOUNTS": "S######## ### ######## ######### #### $1...",
+    "FAILED_TO_SEARCH_ACCOUNTS": "F##### ## ###### ########",
+    "ACCOUNT_SEARCH_RESULTS": "C#### ## ######## ######### #### $1",
+    "NO_CASES_FOUND": "N# ##### #####.",
+    "RETRIEVING_TREND": "R######### #####...",
+    "FAILED_TO_RETRIEVE_TREND": "F##### ## ######## #####",
+    "LOADING_TREND": "L###### #####...",
+    "CASE_TREND": "T#### ## $1",
+    "NO_TREND": "N# ##### ########.",
     "UPDATING": "U#######...",
     "UPDATE_FAILED": "F##### ## ######",
     "CREATING_NOTE": "C####### ####...",
@@ -65,6 +81,7 @@ href='https://git.computecanada.ca/frak/burst/manager/-/issues'>###### ###
 
     // history modal and related strings
     "HISTORY": "H######",
+    "TREND": "T####",
     "EVENT_UPDATE": "U###### #### <strong>$1</strong> ## <strong>$2</strong>",
     "EVENT_CLEARED": "C###### (### <strong>$1</strong>)",
     "EVENT_SET": "S## ## <strong>$1</strong>",
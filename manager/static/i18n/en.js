@@ -6,6 +6,11 @@ i18n_strings = {
     "REVERT": "Revert",
     "TITLE": "Title",
     "BODY": "Body",
+    "ACCOUNT": "Account",
+    "LAST_REPORTED": "Last reported",
+    "ANALYST": "Analyst",
+    "TICKET": "Ticket",
+    "SEARCH": "Search",
     "OKAY": "Okay",
     "NAME": "Name",
     "KEY": "Key",
@@ -40,6 +45,17 @@ i18n_strings = {
     "FAILED_TO_RETRIEVE_CASE_INFO": "Failed to retrieve case info",
     "RETRIEVING_EVENTS": "Retrieving events...",
     "FAILED_TO_RETRIEVE_EVENTS": "Failed to retrieve events",
+    "OLDER_EVENTS": "Show older events",
+    "SEARCH_ACCOUNTS": "Search accounts",
+    "SEARCHING_ACCOUNTS": "Searching for accounts beginning with $1...",
+    "FAILED_TO_SEARCH_ACCOUNTS": "Failed to search accounts",
+    "ACCOUNT_SEARCH_RESULTS": "Cases of accounts beginning with $1",
+    "NO_CASES_FOUND": "No cases found.",
+    "RETRIEVING_TREND": "Retrieving trend...",
+    "FAILED_TO_RETRIEVE_TREND": "Failed to retrieve trend",
+    "LOADING_TREND": "Loading trend...",
+    "CASE_TREND": "Trend of $1",
+    "NO_TREND": "No trend recorded.",
     "UPDATING": "Updating...",
     "UPDATE_FAILED": "Failed to update",
     "CREATING_NOTE": "Creating note...",
@@ -76,6 +92,7 @@ issues</a> you may find.</p>`,
 
     // history modal and related strings
     "HISTORY": "History",
+    "TREND": "Trend",
     "EVENT_UPDATE": "Updated from <strong>$1</strong> to <strong>$2</strong>",
     "EVENT_CLEARED": "Cleared (was <strong>$1</strong>)",
     "EVENT_SET": "Set to <strong>$1</strong>",
@@ -100,8 +100,11 @@ function displayClusters(clusters, stats, jqXHR) {
 
 function requestReports(cluster) {
   var status_id = status(i18n('RETRIEVING_CASE_REPORTS', cluster_lookup[cluster]));
+
+  // cases are paged in from the server by the report tables, so here just
+  // determine which reports are available
   $.ajax({
-    url: `/xhr/cases/?cluster=${cluster}`,
+    url: `/xhr/cases/?cluster=${cluster}&length=0`,
     method: 'GET',
     success: function(reports, status, jqXHR) {
       status_clear(status_id);
@@ -149,7 +152,7 @@ function makeTableBlank(cluster, report) {
 }
 
 
-function createReportTable(cluster, report, results) {
+function createReportTable(cluster, report) {
 
   // get ordering from preferences
   var ordering = getReportSortOrder(cluster, report);
@@ -159,7 +162,7 @@ function createReportTable(cluster, report, results) {
       <div class="accordion-body">
         ${makeTableBlank(cluster, report)}
       </div>`);
-  populateReportTable(cluster, report, results, [ordering]);
+  populateReportTable(cluster, report, [ordering]);
 
   // set up ordering update handler
   $(`#${report}_table_${cluster}`).on('order.dt', function(event) {
@@ -217,7 +220,7 @@ function displayReports(reports, status, jqXHR) {
       accordionParent.appendChild(accordion);
 
       // create and populate report table
-      createReportTable(cluster, report, reports[report]['results']);
+      createReportTable(cluster, report);
     }
 
     // determine which report should be expanded by default
@@ -279,12 +282,14 @@ function refreshReports(reports) {
   else {
     for (var i=0; i < report_names.length; i++) {
       var report = report_names[i];
-      createReportTable(cluster, report, reports[report]['results']);
+
+      // reload current page of table from server, keeping paging position
+      $(`#${report}_table_${cluster}`).DataTable().ajax.reload(null, false);
     }
   }
 }
 
-function populateReportTable(cluster, report, data, ordering) {
+function populateReportTable(cluster, report, ordering) {
 
   // build array of column definitions of the format {"name": name}
   var columnNames = report_specs[report]['cols'].map(function(x) {
@@ -294,9 +299,25 @@ function populateReportTable(cluster, report, data, ordering) {
   ]);
   var idRowIdx = columnNames.length - 1;
 
+  // paging, sorting and searching are done by the server
   $(`#${report}_table_${cluster}`).dataTable({
     "autoWidth": false,
-    "data": renderTableData(data, report_specs[report]['metric'], columnNames),
+    "serverSide": true,
+    "processing": true,
+    "searchDelay": 500,
+    "ajax": {
+      "url": '/xhr/cases/',
+      "data": function(params) {
+        params.cluster = cluster;
+        params.report = report;
+      },
+      "dataSrc": function(json) {
+        return renderTableData(json.results, report_specs[report]['metric'], columnNames);
+      },
+      "error": function() {
+        error(i18n("FAILED_TO_RETRIEVE_CASE_REPORTS"));
+      }
+    },
     "columnDefs": [
       { searchable: false, targets: 'nosearch' },
       { orderable: false, targets: 'nosort' },
@@ -2,6 +2,8 @@
 # pylint:
 #
 import re
+import time
+from flask import current_app
 from flask_babel import _
 from manager.db import get_db
 from manager.log import get_log
@@ -41,19 +43,55 @@ SQL_GET_TEMPLATES_FOR_CASE = '''
 # ---------------------------------------------------------------------------
 
 def get_templates_for_case_type(casetype, language):
+  cached = _cache_get('casetypes', (casetype, language))
+  if cached is not None:
+    return [dict(template) for template in cached]
+
   get_log().debug("Retrieving templates available for case type %s and language %s", casetype, language)
   res = get_db().execute(
     SQL_GET_TEMPLATES_FOR_CASE,
     (language, casetype)
   ).fetchall()
 
-  return [
+  templates = [
     {
       'name': rec['name'],
       'label': rec['label'],
       'pi_only': rec['pi_only'],
     } for rec in res
   ]
+  _cache_put('casetypes', (casetype, language), templates)
+  return [dict(template) for template in templates]
+
+def invalidate_templates():
+  """
+  Discard all cached templates for the current application.  This must be
+  called whenever template records change; the cache is otherwise refreshed
+  after `TEMPLATE_CACHE_TTL` seconds, which covers changes made by other
+  processes.
+  """
+  current_app.extensions.pop('templates', None)
+
+# ---------------------------------------------------------------------------
+#                                                                     cache
+# ---------------------------------------------------------------------------
+
+def _cache():
+  """
+  Return the current application's template cache, a dict of cache
+  sections, each a dict of keys to tuples (expiry, value).
+  """
+  return current_app.extensions.setdefault('templates', {})
+
+def _cache_get(section, key):
+  entry = _cache().get(section, {}).get(key)
+  if entry and entry[0] > time.monotonic():
+    return entry[1]
+  return None
+
+def _cache_put(section, key, value):
+  ttl = float(current_app.config['TEMPLATE_CACHE_TTL'])
+  _cache().setdefault(section, {})[key] = (time.monotonic() + ttl, value)
 
 # ---------------------------------------------------------------------------
 #                                                                   helpers
@@ -79,15 +117,55 @@ def _resolve(dikt, var):
   except KeyError:
     return None
 
-def _render(content, values):
-  # trivial case, but retain empty string or None as given
+def _compile(content):
+  """
+  Compile template content into a tuple of segments for rendering.
+
+  Args:
+    content: Template content, with variables in braces.
+
+  Returns:
+    A tuple of segments, each either a string of literal text or a tuple of
+    keys giving the path of a variable, or the content itself if empty or
+    None.
+  """
   if not content:
     return content
-  return re.sub(
-    _rec,
-    lambda x: str(_resolve(values, x['var']) or _("[undefined]")),
-    content
-  )
+  segments = []
+  pos = 0
+  for match in _rec.finditer(content):
+    if match.start() > pos:
+      segments.append(content[pos:match.start()])
+    segments.append(tuple(match['var'].split('.')))
+    pos = match.end()
+  if pos < len(content):
+    segments.append(content[pos:])
+  return tuple(segments)
+
+def _render_compiled(segments, values):
+  """
+  Render compiled template content with the given values.  Undefined
+  variables are rendered as "[undefined]".
+  """
+  # trivial case, but retain empty string or None as given
+  if not segments:
+    return segments
+  parts = []
+  for segment in segments:
+    if isinstance(segment, str):
+      parts.append(segment)
+      continue
+    value = values
+    try:
+      for key in segment:
+        value = value[key]
+    except KeyError:
+      value = None
+    parts.append(str(value or _("[undefined]")))
+  return ''.join(parts)
+
+def _render(content, values):
+  return _render_compiled(_compile(content), values)
 
 # ---------------------------------------------------------------------------
 #                                                            Template class
@@ -118,20 +196,29 @@ class Template:
       persisted for future use.
     """
     if name and not body:
-      # retrieve template record
-      res = get_db().execute(SQL_GET, (name, language or '')).fetchone()
-      if not res:
-        error = "Could not load requested template (name=%s, language=%s) from database" % \
-          (name, language)
-        get_log().error(error)
-        raise ResourceNotFound(error)
+      # retrieve template record, compiled, from cache or database
+      key = (name, language or '')
+      res = _cache_get('templates', key)
+      if res is None:
+        res = get_db().execute(SQL_GET, key).fetchone()
+        if not res:
+          error = "Could not load requested template (name=%s, language=%s) from database" % \
+            (name, language)
+          get_log().error(error)
+          raise ResourceNotFound(error)
+        res = dict(res,
+          title_compiled=_compile(res['title']),
+          body_compiled=_compile(res['body']))
+        _cache_put('templates', key, res)
       self._name = name
       self._label = res['label']
       self._title = res['title']
       self._body = res['body']
+      self._compiled = (res['title_compiled'], res['body_compiled'])
     elif body:
       self._title = title
       self._body = body
+      self._compiled = (_compile(title), _compile(body))
       if name:
         self._name = name
         self._label = label or name
@@ -143,8 +230,8 @@ class Template:
 
   def render(self, values=None):
     values = values or {}
-    self._title_rendered = _render(self._title, values)
-    self._body_rendered = _render(self._body, values)
+    self._title_rendered = _render_compiled(self._compiled[0], values)
+    self._body_rendered = _render_compiled(self._compiled[1], values)
 
   @property
   def title(self):
@@ -159,5 +246,6 @@ class Template:
     dikt = {
       key.lstrip('_'): val
       for (key, val) in self.__dict__.items()
+      if key != '_compiled'
     }
     return dikt
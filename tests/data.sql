@@ -12,8 +12,9 @@ INSERT INTO apikeys (access, secret, component) VALUES ('testapikey_s', 'T3h5mwE
 -- bursts
 -- specifying the ID for the reportable causes issues with Postgres (the serial isn't properly initialized so
 -- on the next insertion it tries to reuse it and gets a uniqueness violation error
-INSERT INTO reportables (epoch, account, cluster, summary) VALUES (1634316499, 'def-pi1', 'testcluster', '');
+INSERT INTO reportables (epoch, account, cluster, summary) VALUES (1634316499, 'def-pi1', 'testcluster', NULL);
 INSERT INTO bursts (id, pain, firstjob, lastjob, submitters) VALUES (1, 1.00, 1005, 2000, 'user3');
+INSERT INTO case_users (case_id, username) VALUES (1, 'user3');
 
 -- template data
 INSERT INTO templates (name) VALUES ('other language follows');
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint: disable=import-outside-toplevel
+#
+"""
+Synthetic Detector load generator for the Manager.
+
+Where `benchmark.py` drives the application in-process, this replays
+realistic component traffic against a running server over HTTP for capacity
+planning.  Each simulated cluster has a Detector, which reports bursts and old
+jobs on a schedule, and a Scheduler, which polls the adjustor view.  All
+requests are signed with the cluster component's API key, just as the real
+components do.
+
+Latency percentiles and error rates for each kind of request are written as
+newline-delimited JSON, in the same format as `benchmark.py`.
+
+Usage:
+```
+# create benchmark clusters, components and API keys in the database the
+# server uses (as determined by the environment, like the `flask` command)
+$ PYTHONPATH=.:tests python3 tests/loadgen.py --clusters 20 --provision
+
+# then run against the server
+$ PYTHONPATH=.:tests python3 tests/loadgen.py --clusters 20 --cases 20000 \\
+    --interval 30 --duration 600 http://localhost:5000
+```
+
+The same `--clusters`, `--cases` and `--seed` must be given when provisioning
+and when generating load so that the generated API keys match.
+"""
+
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from ssl import create_default_context, CERT_NONE
+from datetime import datetime, timezone
+
+from benchmark import Workload, measurement
+from manager.version import version
+from manager.apikey import sign_request
+
+ADJUSTOR_RESOURCE = '/api/cases/?report=bursts&view=adjustor'
+REPORT_RESOURCE = '/api/cases/'
+
+class Stats:
+  """
+  Thread-safe collection of request outcomes by kind of request.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._latencies = {}
+    self._statuses = {}
+
+  def record(self, name, elapsed, status):
+    """
+    Record a request outcome.
+
+    Args:
+      name: Kind of request.
+      elapsed: Time taken by the request, in seconds.
+      status: HTTP status code, or the name of the exception raised if the
+        request did not complete.
+    """
+    with self._lock:
+      self._latencies.setdefault(name, []).append(elapsed)
+      statuses = self._statuses.setdefault(name, {})
+      statuses[status] = statuses.get(status, 0) + 1
+
+  def records(self, duration, **extra):
+    """
+    Summarize the requests made.
+
+    Args:
+      duration: Wall-clock duration of the run, in seconds.
+      extra: Additional key-value pairs to include in each record.
+
+    Returns:
+      List of measurement records, one for each kind of request.
+    """
+    records = []
+    with self._lock:
+      for (name, latencies) in self._latencies.items():
+        statuses = self._statuses[name]
+        errors = sum(
+          count for (status, count) in statuses.items()
+          if not isinstance(status, int) or status >= 400
+        )
+        records.append(measurement(name, latencies, unit='requests/s',
+          rate=len(latencies) / duration if duration else None,
+          errors=errors,
+          error_rate=errors / len(latencies),
+          statuses={str(status): count for (status, count) in statuses.items()},
+          duration=duration,
+          **extra))
+    return records
+
+class LoadGenerator:
+  """
+  Runs a Detector and a Scheduler thread for each cluster of the workload.
+  """
+
+  def __init__(self, options):
+    self.options = options
+    self.workload = Workload(
+      options.clusters, options.cases, options.churn, options.seed)
+    self.stats = Stats()
+
+    # the workload is shared between Detector threads
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._random = random.Random(options.seed)
+
+    self._context = None
+    if options.insecure:
+      self._context = create_default_context()
+      self._context.check_hostname = False
+      self._context.verify_mode = CERT_NONE
+
+  def request(self, name, component, method, resource, payload=None):
+    """
+    Make a signed request to the server and record the outcome.
+    """
+    headers = sign_request(
+      component['access'], component['secret'], method, resource)
+    data = None
+    if payload is not None:
+      data = json.dumps(payload).encode('utf-8')
+      headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(
+      self.options.url.rstrip('/') + resource,
+      data=data, headers=headers, method=method)
+
+    start = time.perf_counter()
+    try:
+      with urllib.request.urlopen(
+          req, timeout=self.options.timeout, context=self._context) as response:
+        response.read()
+        status = response.status
+    except urllib.error.HTTPError as e:
+      status = e.code
+    except (urllib.error.URLError, OSError) as e:
+      status = type(e).__name__
+    self.stats.record(name, time.perf_counter() - start, status)
+
+  def detector(self, cluster):
+    """
+    Report the cluster's cases every interval, advancing the workload between
+    reports.
+    """
+    component = self.workload.clusters[cluster]['components']['detector']
+    epochs = 0
+    while not self._wait(self.options.interval):
+      with self._lock:
+        if epochs:
+          self.workload.advance([cluster])
+        payload = copy.deepcopy(self.workload.report(cluster))
+      self.request('report', component, 'POST', REPORT_RESOURCE, payload)
+      epochs += 1
+      if self.options.epochs and epochs >= self.options.epochs:
+        break
+
+  def scheduler(self, cluster):
+    """
+    Poll the adjustor view every poll interval.
+    """
+    component = self.workload.clusters[cluster]['components']['scheduler']
+    while not self._wait(self.options.poll_interval):
+      self.request('adjustor', component, 'GET', ADJUSTOR_RESOURCE)
+
+  def _wait(self, interval):
+    """
+    Wait for the given interval, staggered so components don't report in
+    lockstep.  Returns true if the run is over.
+    """
+    with self._lock:
+      jitter = self._random.uniform(-0.1, 0.1) * interval
+    return self._stop.wait(max(0, interval + jitter))
+
+  def run(self):
+    """
+    Run until the duration has passed or every Detector has sent the
+    requested number of epochs.
+
+    Returns:
+      Wall-clock duration of the run, in seconds.
+    """
+    detectors = []
+    threads = []
+    for cluster in self.workload.clusters:
+      detector = threading.Thread(target=self.detector, args=(cluster,))
+      detectors.append(detector)
+      threads.append(detector)
+      if self.options.poll_interval:
+        threads.append(threading.Thread(target=self.scheduler, args=(cluster,)))
+
+    start = time.time()
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    deadline = start + self.options.duration
+    try:
+      for detector in detectors:
+        detector.join(max(0, deadline - time.time()))
+    except KeyboardInterrupt:
+      pass
+    self._stop.set()
+    for thread in threads:
+      thread.join()
+    return time.time() - start
+
+  def provision(self):
+    """
+    Create the workload's clusters, components and API keys in the database
+    configured for the application.
+    """
+    from manager import create_app
+
+    app = create_app()
+    with app.app_context():
+      return self.workload.provision()
+
+  def describe(self):
+    """
+    Parameters common to all records of this run.
+    """
+    return {
+      'url': self.options.url,
+      'cases': self.workload.cases_per_epoch(),
+      'clusters': len(self.workload.clusters),
+      'churn': self.options.churn,
+      'interval': self.options.interval,
+      'poll_interval': self.options.poll_interval,
+      'version': version,
+      'timestamp': datetime.now(timezone.utc).isoformat(),
+    }
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(
+    description="Replay synthetic Detector and Scheduler traffic against a "
+                "running Manager.")
+  parser.add_argument('url', nargs='?', default='http://localhost:5000',
+    help="base URL of the server (default http://localhost:5000)")
+  parser.add_argument('--provision', action='store_true',
+    help="create clusters, components and API keys in the database configured "
+         "for the application, then exit")
+  parser.add_argument('--clusters', type=int, default=10,
+    help="number of clusters (default 10)")
+  parser.add_argument('--cases', type=int, default=1000,
+    help="cases reported per epoch, over all clusters (default 1000)")
+  parser.add_argument('--churn', type=float, default=0.2,
+    help="proportion of cases replaced each epoch (default 0.2)")
+  parser.add_argument('--interval', type=float, default=10,
+    help="seconds between reports from each Detector (default 10)")
+  parser.add_argument('--poll-interval', type=float, default=5,
+    help="seconds between adjustor polls from each Scheduler, or 0 to "
+         "disable polling (default 5)")
+  parser.add_argument('--duration', type=float, default=60,
+    help="maximum length of the run in seconds (default 60)")
+  parser.add_argument('--epochs', type=int, default=0,
+    help="stop after each Detector has sent this many reports (default no limit)")
+  parser.add_argument('--timeout', type=float, default=60,
+    help="request timeout in seconds (default 60)")
+  parser.add_argument('--insecure', action='store_true',
+    help="don't verify the server's certificate")
+  parser.add_argument('--seed', type=int, default=1,
+    help="random seed (default 1)")
+  parser.add_argument('--output', default=None,
+    help="file to append results to (default stdout)")
+  options = parser.parse_args(argv)
+
+  # the API uses the time of the request as the report epoch
+  if options.interval < 1:
+    parser.error("interval must be at least one second")
+  return options
+
+def main(argv=None):
+  options = parse_args(argv)
+  generator = LoadGenerator(options)
+
+  if options.provision:
+    created = generator.provision()
+    print("Provisioned {} of {} clusters".format(
+      created, len(generator.workload.clusters)), file=sys.stderr)
+    return
+
+  duration = generator.run()
+  output = open(options.output, 'a') if options.output else sys.stdout
+  try:
+    common = generator.describe()
+    for record in generator.stats.records(duration):
+      output.write(json.dumps(dict(common, **record)) + '\n')
+  finally:
+    if options.output:
+      output.close()
+
+if __name__ == '__main__':
+  main()
@@ -3,3 +3,4 @@
 #
 from tests_cases import *
 from tests_templates import *
+from tests_jsonstream import *
@@ -6,8 +6,17 @@ from email.utils import formatdate
 import hmac
 import base64
 import json
+import gzip
+import zlib
+import pytest
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 from manager.api import API_VERSION
+from manager.apikey import make_digest, sign_request
 
 def api_get(client, resource, access=None, secret=None):
 
@@ -74,6 +83,19 @@ def test_api_unsigned(client):
   response = client.get('/api/cases/')
   assert response.status_code == 401
 
+def test_make_digest():
+  # from the example in manager/apikey.py
+  assert make_digest('secret', 'So this is how the world ends') == \
+    'MH9b+fxXcpNgLYYOpD5hCr32TDVisjSvZwSwfPqueE8='
+
+def test_api_signed_with_helper(client):
+
+  headers = sign_request(
+    'testapikey_s', 'T3h5mwEk7mrVwxdon+s9blWhVh8zHDd7PVoUoWJsTf5Qd2EUie6I4pdBuyRykw==',
+    'GET', '/api/cases/?report=bursts')
+  response = client.get('/api/cases/?report=bursts', headers=headers)
+  assert response.status_code == 200
+
 # This test won't run without a _mostly_ empty client, one that has the API
 # key defined already
 #def test_get_bursts_but_there_are_none(empty_client):
@@ -334,6 +356,55 @@ def test_post_empty_burst_report(client):
   })
   assert response.status_code == 201
 
+def test_post_report_version_last(client):
+  """
+  Test that report sections preceding the version are processed once the
+  version is known.
+  """
+  response = api_post(client, '/api/cases/', {
+    'oldjobs': [
+      {
+        'account': 'def-pi1',
+        'resource': 'cpu',
+        'age': 12,
+        'summary': None,
+        'submitter': 'user1'
+      }
+    ],
+    'version': 2,
+  })
+  assert response.status_code == 201
+
+def test_post_report_malformed(client):
+  headers = signed_post_headers('identity')
+  response = client.post('/api/cases/', headers=headers,
+    data='{"version": 2, "oldjobs": [{"account": "def-pi1"')
+  assert response.status_code == 400
+  assert json.loads(response.data)['error'].startswith(
+    '400 Bad Request: Could not parse report')
+
+def test_post_report_malformed_writes_nothing(client, notifier):
+  """
+  Test that sections of a report preceding an error are not ingested.
+  """
+  from manager.db import get_db
+
+  notifier.clear()
+  headers = signed_post_headers('identity')
+  burst = {
+    'account': 'def-partial', 'resource': 'cpu', 'pain': 1.0, 'firstjob': 1000,
+    'lastjob': 2000, 'summary': None, 'submitters': ['user1']
+  }
+  for _ in range(2):
+    response = client.post('/api/cases/', headers=headers,
+      data='{"version": 2, "bursts": [' + json.dumps(burst) + '], "oldjobs": [{"account": "x",')
+    assert response.status_code == 400
+
+  with client.application.app_context():
+    assert not get_db().execute(
+      "SELECT id FROM reportables WHERE account = 'def-partial'").fetchall()
+  assert notifier.notifications == []
+
 class TestPostingSuccessiveReports:
 
   def test_post_burst(self, client, notifier):
@@ -672,3 +743,497 @@ class TestPostingSuccessiveReports:
       'beam-dev: ReportReceived: bursts on testcluster: 0 new record(s) and 2 existing.  In total there are 2 pending, 0 accepted, 0 rejected.  0 have been claimed.',
       'beam-dev: ReportReceived: bursts on testcluster: 0 new record(s) and 2 existing.  In total there are 1 pending, 0 accepted, 1 rejected.  1 have been claimed.'
     ]
+
+class TestConditionalGet:
+
+  resource = '/api/cases/?report=bursts&view=adjustor'
+
+  def signed_get(self, client, etag=None):
+    headers = sign_request(
+      'testapikey_s', 'T3h5mwEk7mrVwxdon+s9blWhVh8zHDd7PVoUoWJsTf5Qd2EUie6I4pdBuyRykw==',
+      'GET', self.resource)
+    if etag:
+      headers['If-None-Match'] = '"{}"'.format(etag)
+    return client.get(self.resource, headers=headers)
+
+  def test_not_modified(self, client):
+    response = self.signed_get(client)
+    assert response.status_code == 200
+    (etag, weak) = response.get_etag()
+    assert etag and not weak
+
+    response = self.signed_get(client, etag)
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.get_etag() == (etag, False)
+
+  def test_modified_by_update(self, client):
+    etag = self.signed_get(client).get_etag()[0]
+
+    client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    response = client.patch('/xhr/cases/1', json=[{'note': 'Accepting', 'state': 'accepted'}])
+    assert response.status_code == 200
+
+    response = self.signed_get(client, etag)
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+    assert json.loads(response.data) == [{'account': 'def-pi1', 'pain': 1.0, 'resource': 'cpu'}]
+
+  def test_modified_by_report(self, client):
+    etag = self.signed_get(client).get_etag()[0]
+
+    response = api_post(client, '/api/cases/', {'version': 2, 'bursts': []})
+    assert response.status_code == 201
+
+    response = self.signed_get(client, etag)
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+
+  def test_xhr_not_modified(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster')
+    assert response.status_code == 200
+    etag = response.get_etag()[0]
+
+    response = client.get('/xhr/cases/?cluster=testcluster', headers={'If-None-Match': '"{}"'.format(etag)})
+    assert response.status_code == 304
+
+    # different parameters or language are different representations
+    response = client.get('/xhr/cases/?cluster=testcluster&length=0', headers={'If-None-Match': '"{}"'.format(etag)})
+    assert response.status_code == 200
+    response = client.get('/xhr/cases/?cluster=testcluster', headers={'If-None-Match': '"{}"'.format(etag), 'Accept-Language': 'fr'})
+    assert response.status_code == 200
+
+def signed_post_headers(encoding):
+  headers = sign_request(
+    'testapikey_d', 'WuHheVDysQQwdb+NK98w8EOHdiNUjLlz2Uxg/kIHqIGOek4DAmC5NCd2gZv7RQ==',
+    'POST', '/api/cases/')
+  headers['Content-Type'] = 'application/json'
+  headers['Content-Encoding'] = encoding
+  return headers
+
+class TestCompression:
+
+  report = json.dumps({
+    'version': 2,
+    'oldjobs': [
+      {
+        'account': 'def-pi1',
+        'resource': 'cpu',
+        'age': 12,
+        'summary': {'padding': 'x' * 5000},
+        'submitter': 'user1'
+      }
+    ]}).encode('utf-8')
+
+  def test_post_gzip(self, client):
+    response = client.post('/api/cases/', headers=signed_post_headers('gzip'),
+      data=gzip.compress(self.report))
+    assert response.status_code == 201
+
+  def test_post_deflate(self, client):
+    response = client.post('/api/cases/', headers=signed_post_headers('deflate'),
+      data=zlib.compress(self.report))
+    assert response.status_code == 201
+
+  def test_post_unsupported_encoding(self, client):
+    response = client.post('/api/cases/', headers=signed_post_headers('br'),
+      data=self.report)
+    assert response.status_code == 415
+
+  def test_post_corrupt(self, client):
+    response = client.post('/api/cases/', headers=signed_post_headers('gzip'),
+      data=self.report)
+    assert response.status_code == 400
+
+  def test_post_too_large(self, client):
+    client.application.config['API_MAX_DECOMPRESSED_SIZE'] = 1000
+    try:
+      response = client.post('/api/cases/', headers=signed_post_headers('gzip'),
+        data=gzip.compress(self.report))
+    finally:
+      client.application.config['API_MAX_DECOMPRESSED_SIZE'] = 64 * 1024 * 1024
+    assert response.status_code == 413
+
+  def test_get_compressed(self, client):
+    client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    plain = client.get('/xhr/cases/?cluster=testcluster')
+    assert plain.status_code == 200
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    response = client.get('/xhr/cases/?cluster=testcluster', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain.data
+    (etag, weak) = response.get_etag()
+    assert etag == plain.get_etag()[0] + '-gzip'
+    assert not weak
+
+    response = client.get('/xhr/cases/?cluster=testcluster', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"{}"'.format(etag)})
+    assert response.status_code == 304
+
+  def test_get_small_not_compressed(self, client):
+    response = client.get('/xhr/clusters/', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+
+def signed_msgpack_headers(method, resource):
+  headers = sign_request(
+    'testapikey_d', 'WuHheVDysQQwdb+NK98w8EOHdiNUjLlz2Uxg/kIHqIGOek4DAmC5NCd2gZv7RQ==',
+    method, resource)
+  headers['Content-Type'] = 'application/msgpack'
+  headers['Accept'] = 'application/msgpack'
+  return headers
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack is not installed")
+class TestMsgpack:
+
+  def post(self, client, report):
+    return client.post('/api/cases/', headers=signed_msgpack_headers('POST', '/api/cases/'),
+      data=msgpack.packb(report))
+
+  def test_post_maps(self, client):
+    response = self.post(client, {
+      'version': 2,
+      'bursts': [{
+        'account': 'def-pi1',
+        'resource': 'cpu',
+        'pain': 1.5,
+        'firstjob': 1000,
+        'lastjob': 2000,
+        'submitters': ['userQ'],
+        'summary': {'num_jobs': 3}
+      }]})
+    assert response.status_code == 201
+    assert response.mimetype == 'application/msgpack'
+    assert msgpack.unpackb(response.data) == {'status': 201}
+
+  def test_post_arrays(self, client):
+    response = self.post(client, {
+      'version': 2,
+      'oldjobs': [
+        ['def-pi1', 'cpu', 12, 'user1', None],
+        ['def-pi2', 'gpu', 24.5, 'user2', {'jobs': 2}],
+      ]})
+    assert response.status_code == 201
+
+  def test_post_wrong_type(self, client):
+    response = self.post(client, {
+      'version': 2,
+      'bursts': [{
+        'account': 'def-pi1',
+        'resource': 'cpu',
+        'pain': 1.5,
+        'firstjob': '1000',
+        'lastjob': 2000,
+        'submitters': ['userQ'],
+        'summary': None
+      }]})
+    assert response.status_code == 400
+    assert 'firstjob' in json.loads(response.data)['detail']
+
+  def test_post_wrong_length(self, client):
+    response = self.post(client, {
+      'version': 2,
+      'oldjobs': [['def-pi1', 'cpu', 12]]})
+    assert response.status_code == 400
+
+  def test_post_no_version(self, client):
+    response = self.post(client, {'oldjobs': []})
+    assert response.status_code == 400
+
+  def test_post_truncated(self, client):
+    data = msgpack.packb({'version': 2, 'oldjobs': [['def-pi1', 'cpu', 12, 'user1', None]]})
+    response = client.post('/api/cases/', headers=signed_msgpack_headers('POST', '/api/cases/'),
+      data=data[:-5])
+    assert response.status_code == 400
+
+  def test_get_cases(self, client):
+    resource = '/api/cases/?report=bursts&view=adjustor'
+    plain = api_get(client, resource)
+    response = client.get(resource, headers=signed_msgpack_headers('GET', resource))
+    assert response.status_code == 200
+    assert response.mimetype == 'application/msgpack'
+    assert 'Accept' in response.headers['Vary']
+    assert msgpack.unpackb(response.data) == json.loads(plain.data)
+    assert response.get_etag()[0] != plain.get_etag()[0]
+
+class TestIdempotency:
+
+  report = {
+    'version': 2,
+    'oldjobs': [
+      {
+        'account': 'def-pi1',
+        'resource': 'cpu',
+        'age': 12,
+        'summary': None,
+        'submitter': 'user1'
+      }
+    ]
+  }
+
+  def post(self, client, report, key=None):
+    headers = signed_post_headers('identity')
+    if key:
+      headers['Idempotency-Key'] = key
+    return client.post('/api/cases/', headers=headers, data=json.dumps(report))
+
+  def ticks(self, client):
+    from manager.db import get_db
+
+    with client.application.app_context():
+      return get_db().execute("""
+        SELECT R.ticks FROM reportables R JOIN oldjobs O USING (id)
+        WHERE R.account = 'def-pi1'""").fetchone()['ticks']
+
+  def test_retry_replayed(self, client):
+    response = self.post(client, self.report)
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+    assert self.ticks(client) == 1
+
+    response = self.post(client, self.report)
+    assert response.status_code == 201
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert json.loads(response.data) == {'status': 201}
+    assert self.ticks(client) == 1
+
+  def test_different_report_processed(self, client):
+    report = dict(self.report, oldjobs=[dict(self.report['oldjobs'][0], age=13)])
+    response = self.post(client, report)
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+    assert self.ticks(client) == 2
+
+  def test_expired(self, client):
+    client.application.config['IDEMPOTENCY_WINDOW'] = -1
+    try:
+      response = self.post(client, self.report)
+    finally:
+      client.application.config['IDEMPOTENCY_WINDOW'] = 120
+    assert response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+    assert self.ticks(client) == 3
+
+  def test_idempotency_key(self, client):
+    report = dict(self.report, oldjobs=[dict(self.report['oldjobs'][0], age=14)])
+    assert self.post(client, report, key='report-1').status_code == 201
+    assert self.ticks(client) == 4
+
+    # the key identifies the report rather than its payload
+    report['oldjobs'][0]['age'] = 15
+    response = self.post(client, report, key='report-1')
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert self.post(client, report, key='report-2').status_code == 201
+    assert self.ticks(client) == 5
+
+    assert self.post(client, report, key='x' * 129).status_code == 400
+
+  def test_failure_not_recorded(self, client):
+    report = {'version': 2, 'oldjobs': [{'account': 'def-pi1'}]}
+    assert self.post(client, report).status_code == 400
+    response = self.post(client, report)
+    assert response.status_code == 400
+    assert 'Idempotent-Replayed' not in response.headers
+
+  def test_in_progress(self, client):
+    import hashlib
+    from manager.db import get_db
+
+    report = dict(self.report, oldjobs=[dict(self.report['oldjobs'][0], age=16)])
+    digest = hashlib.sha256(json.dumps(report).encode()).hexdigest()
+    with client.application.app_context():
+      db = get_db()
+      db.execute("""
+        INSERT INTO report_ledger (component, request_key, epoch)
+        VALUES ('testcluster_detector', ?, ?)""", ('sha256:' + digest, int(time.time())))
+      db.commit()
+    assert self.post(client, report).status_code == 409
+    assert self.ticks(client) == 5
+
+  def test_in_progress_after_window(self, client):
+    import hashlib
+    from manager.db import get_db
+
+    # a retry after the window of a report still being processed is refused
+    report = dict(self.report, oldjobs=[dict(self.report['oldjobs'][0], age=17)])
+    digest = hashlib.sha256(json.dumps(report).encode()).hexdigest()
+    with client.application.app_context():
+      db = get_db()
+      db.execute("""
+        INSERT INTO report_ledger (component, request_key, epoch)
+        VALUES ('testcluster_detector', ?, ?)""", ('sha256:' + digest, int(time.time()) - 600))
+      db.commit()
+    assert self.post(client, report).status_code == 409
+    assert self.ticks(client) == 5
+
+    # until the claim is stale
+    client.application.config['IDEMPOTENCY_LEASE'] = 300
+    try:
+      response = self.post(client, report)
+    finally:
+      client.application.config['IDEMPOTENCY_LEASE'] = 3600
+    assert response.status_code == 201
+    assert self.ticks(client) == 6
+
+  def test_failed_partway_retried(self, client):
+    # a report failing after a section is processed is rolled back before its
+    # claim is released, so that retries do not count the section again
+    report = dict(self.report, oldjobs=[dict(self.report['oldjobs'][0], age=18)])
+    invalid = dict(report, bursts=[{'account': 'def-pi1'}])
+    for _ in range(2):
+      assert self.post(client, invalid, key='report-3').status_code == 400
+      assert self.ticks(client) == 6
+    assert self.post(client, report, key='report-3').status_code == 201
+    assert self.ticks(client) == 7
+
+class TestDeltaReports:
+
+  def burst(self, account, lastjob, **kwargs):
+    return dict({
+      'account': account, 'resource': 'cpu', 'pain': 1.0, 'firstjob': lastjob - 10,
+      'lastjob': lastjob, 'submitters': ['user1'], 'summary': None
+    }, **kwargs)
+
+  def post(self, client, report):
+    return client.post('/api/cases/', headers=signed_post_headers('identity'),
+      data=json.dumps(report))
+
+  def rewind(self, client, seconds):
+    """
+    Move the cluster's reports back in time so that the next report has a
+    later epoch.
+    """
+    from manager.db import get_db
+
+    with client.application.app_context():
+      db = get_db()
+      db.execute("UPDATE reportables SET epoch = epoch - ? WHERE cluster = 'testcluster'", (seconds,))
+      db.execute("UPDATE case_versions SET epoch = epoch - ? WHERE cluster = 'testcluster'", (seconds,))
+      db.commit()
+
+  def latest(self, client):
+    from manager.case import get_report_epochs
+
+    with client.application.app_context():
+      return get_report_epochs('testcluster', ['bursts'])['bursts']
+
+  def bursts(self, client):
+    from manager.db import get_db
+
+    with client.application.app_context():
+      return {
+        rec['account']: (rec['epoch'], rec['ticks'], rec['pain'])
+        for rec in get_db().execute("""
+          SELECT R.account, R.epoch, R.ticks, B.pain
+          FROM   reportables R JOIN bursts B USING (id)
+          WHERE  R.account LIKE 'def-delta%'""").fetchall()
+      }
+
+  def test_full_report(self, client):
+    response = self.post(client, {
+      'version': 3,
+      'base': {'bursts': None},
+      'bursts': [self.burst('def-delta1', 100), self.burst('def-delta2', 200),
+        self.burst('def-delta3', 300)]
+    })
+    assert response.status_code == 201
+    epoch = json.loads(response.data)['epochs']['bursts']
+    assert self.latest(client) == epoch
+    assert {ticks for (_, ticks, _) in self.bursts(client).values()} == {1}
+
+  def test_delta_report(self, client):
+    from manager.db import get_db
+
+    self.rewind(client, 100)
+    base = self.latest(client)
+    response = self.post(client, {
+      'version': 3,
+      'base': {'bursts': base},
+      'bursts': [self.burst('def-delta1', 100, pain=2.0), self.burst('def-delta4', 400)],
+      'resolved': {'bursts': [{'account': 'def-delta2', 'resource': 'cpu', 'lastjob': 200}]}
+    })
+    assert response.status_code == 201
+    epoch = json.loads(response.data)['epochs']['bursts']
+    assert epoch > base
+    assert self.latest(client) == epoch
+    assert self.bursts(client) == {
+      'def-delta1': (epoch, 2, 2.0),
+      'def-delta2': (base, 1, 1.0),
+      'def-delta3': (epoch, 2, 1.0),
+      'def-delta4': (epoch, 1, 1.0),
+    }
+
+    # unchanged cases are sampled as well
+    with client.application.app_context():
+      assert get_db().execute("""
+        SELECT M.value FROM case_metrics M JOIN reportables R ON (R.id = M.case_id)
+        WHERE R.account = 'def-delta3' AND M.epoch = ?""", (epoch,)).fetchone()['value'] == 1.0
+
+  def test_empty_delta(self, client):
+    self.rewind(client, 100)
+    base = self.latest(client)
+    response = self.post(client, {'version': 3, 'base': {'bursts': base}})
+    assert response.status_code == 201
+    epoch = json.loads(response.data)['epochs']['bursts']
+    assert self.bursts(client)['def-delta3'] == (epoch, 3, 1.0)
+    assert self.bursts(client)['def-delta2'][0] < base
+
+  def test_stale_base(self, client):
+    self.rewind(client, 100)
+    latest = self.latest(client)
+    before = self.bursts(client)
+    response = self.post(client, {
+      'version': 3,
+      'base': {'bursts': latest - 100},
+      'bursts': [self.burst('def-delta5', 500)]
+    })
+    assert response.status_code == 409
+    assert json.loads(response.data)['epochs'] == {'bursts': latest}
+    assert self.bursts(client) == before
+
+  def test_resync(self, client):
+    response = self.post(client, {
+      'version': 3,
+      'bursts': [self.burst('def-delta3', 300)],
+      'base': {'bursts': None}
+    })
+    assert response.status_code == 201
+    epoch = json.loads(response.data)['epochs']['bursts']
+    bursts = self.bursts(client)
+    assert bursts['def-delta3'][0] == epoch
+    assert bursts['def-delta1'][0] < epoch
+
+  def test_sections_held_for_base(self, client):
+    self.rewind(client, 100)
+    base = self.latest(client)
+    response = client.post('/api/cases/', headers=signed_post_headers('identity'),
+      data='{{"bursts": [{}], "version": 3, "base": {{"bursts": {}}}}}'.format(
+        json.dumps(self.burst('def-delta6', 600)), base))
+    assert response.status_code == 201
+    assert self.bursts(client)['def-delta6'][1] == 1
+
+  @pytest.mark.parametrize('report', [
+    {'version': 3, 'bursts': []},
+    {'version': 3, 'base': ['bursts']},
+    {'version': 3, 'base': {'nonsense': None}},
+    {'version': 3, 'base': {'bursts': None}, 'resolved': {'oldjobs': []}},
+    {'version': 2, 'base': {'bursts': None}},
+    {'base': {'bursts': None}, 'version': 2},
+  ])
+  def test_invalid(self, client, report):
+    before = self.bursts(client)
+    assert self.post(client, report).status_code == 400
+    assert self.bursts(client) == before
+
+  def test_invalid_resolved(self, client):
+    self.rewind(client, 100)
+    base = self.latest(client)
+    response = self.post(client, {
+      'version': 3,
+      'base': {'bursts': base},
+      'resolved': {'bursts': [{'account': 'def-delta3', 'resource': 'cpu'}]}
+    })
+    assert response.status_code == 400
+    assert self.latest(client) == base
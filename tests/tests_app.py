@@ -1,6 +1,8 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+import sys
+import subprocess
 import pytest
 from manager import create_app
 from manager.db import init_db
@@ -24,3 +26,21 @@ def test_config_bad_database():
       init_db()
   assert e.value.scheme == 'stupid'
   assert str(e.value) == "Unsupported database type/scheme: stupid"
+
+
+def test_startup_lazy_imports():
+  """
+  Starting the application and answering a liveness probe should not load
+  the integrations, which are imported on first use.
+  """
+  heavy = ['pyotrs', 'ldap', 'ccldap.ccldap', 'requests', 'numpy', 'psycopg2']
+  script = """
+import sys
+from manager import create_app
+app = create_app({'TESTING': True, 'CONFIG': 'tests/app.conf'})
+assert app.test_client().get('/status/').status_code == 200
+print(' '.join(sorted(set(sys.argv[1:]) & set(sys.modules))))
+"""
+  output = subprocess.run([sys.executable, '-c', script] + heavy, check=True,
+    stdout=subprocess.PIPE, universal_newlines=True).stdout
+  assert output.split() == []
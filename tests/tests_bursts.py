@@ -2,6 +2,12 @@
 # pylint: disable=line-too-long,no-self-use
 #
 import json
+import pytest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # ---------------------------------------------------------------------------
 #                                                                      ajax
@@ -20,6 +26,19 @@ def test_get_cases_xhr_there_are_none(empty_client):
     'cluster': 'testcluster'
   }
 
+def test_get_cases_xhr_search_enumeration(client):
+
+  response = client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+  assert response.status_code == 200
+
+  for (state, expected) in (('pend', 1), ('rejected', 0)):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=bursts&start=0&length=10'
+      '&columns[0][name]=state&columns[0][search][value]={}&order[0][column]=0&order[0][dir]=asc'.format(state))
+    assert response.status_code == 200
+    interpreted = json.loads(response.data.decode('utf-8'))
+    assert interpreted['recordsTotal'] == 1
+    assert interpreted['recordsFiltered'] == expected
+
 def test_get_cases_xhr(client):
 
   response = client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
@@ -200,6 +219,41 @@ class TestCaseUpdates:
       },
     ]
 
+  def test_get_events_paged(self, client):
+    """
+    Page through events related to a case, newest first.
+    """
+    # log in
+    response = client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+
+    response = client.get('/xhr/cases/1/events/?limit=1')
+    assert response.status_code == 200
+    x = json.loads(response.data)
+    assert [event['id'] for event in x['events']] == [1]
+    assert x['next']
+
+    response = client.get('/xhr/cases/1/events/?limit=1&before={}'.format(x['next']))
+    assert response.status_code == 200
+    x = json.loads(response.data)
+    assert [event['id'] for event in x['events']] == [2]
+    assert x['next'] is None
+
+    response = client.get('/xhr/cases/1/events/?limit=5')
+    assert response.status_code == 200
+    x = json.loads(response.data)
+    assert [event['id'] for event in x['events']] == [1, 2]
+    assert x['next'] is None
+
+  def test_get_events_paged_bad_call(self, client):
+    # log in
+    response = client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+
+    for query in ['limit=0', 'limit=x', 'limit=1&before=bogus', 'limit=1&before=WzFd']:
+      response = client.get('/xhr/cases/1/events/?{}'.format(query))
+      assert response.status_code == 400
+
 def test_get_no_events(client):
   """
   Get events related to a burst when there are no events.
@@ -236,3 +290,408 @@ def test_update_cases_xhr_no_timestamps(client):
   response = client.patch('/xhr/cases/1', json=data, environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
   print(response.data)
   assert response.status_code == 200
+
+class TestIdentityMap:
+
+  def test_get_same_instance(self, client):
+    from manager.case import Case
+
+    with client.application.test_request_context('/'):
+      case = Case.get(1)
+      assert case is not None
+      assert Case.get(1) is case
+
+    # a new request starts afresh
+    with client.application.test_request_context('/'):
+      assert Case.get(1) is not case
+
+  def test_view_registers_instances(self, client):
+    from manager.case import Case
+    from manager.burst import Burst
+
+    with client.application.test_request_context('/'):
+      current = Burst.get_current('testcluster')
+      assert Case.get(current[0].id) is current[0]
+
+  def test_update_invalidates(self, client):
+    from manager.case import Case
+
+    with client.application.test_request_context('/'):
+      case = Case.get(1)
+      notes = case.notes
+      case.update({'note': 'Just a note'}, 'tst-003')
+      updated = Case.get(1)
+      assert updated is not case
+      assert updated.notes == notes + 1
+
+  def test_set_ticket_invalidates(self, client):
+    from manager.case import Case
+
+    with client.application.test_request_context('/'):
+      case = Case.get(1)
+      Case.set_ticket(1, 99, 'Ticket99')
+      updated = Case.get(1)
+      assert updated is not case
+      assert updated.ticket_no == 'Ticket99'
+
+class TestUserCases:
+
+  def _user_cases(self, client, uid):
+    response = client.get('/xhr/users/{}/cases'.format(uid), environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+    return json.loads(response.data)
+
+  def test_report(self, client):
+    from tests.tests_api import api_post
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'bursts': [{
+        'account': 'def-pi2',
+        'resource': 'cpu',
+        'pain': 1.5,
+        'firstjob': 3000,
+        'lastjob': 3100,
+        'submitters': ['user1', 'user2'],
+        'summary': None
+      }],
+      'oldjobs': [{
+        'account': 'def-pi3',
+        'resource': 'cpu',
+        'age': 10,
+        'submitter': 'user2',
+        'summary': None
+      }]
+    })
+    assert response.status_code == 201
+
+  def test_get_user_cases(self, client):
+    interpreted = self._user_cases(client, 'user2')
+    assert interpreted['user'] == 'user2'
+    assert [case['account'] for case in interpreted['bursts']] == ['def-pi2']
+    assert [case['account'] for case in interpreted['oldjobs']] == ['def-pi3']
+
+    # seeded case
+    interpreted = self._user_cases(client, 'user3')
+    assert [case['id'] for case in interpreted['bursts']] == [1]
+    assert 'oldjobs' not in interpreted
+
+  def test_get_user_cases_none(self, client):
+    assert self._user_cases(client, 'nobody') == {'user': 'nobody'}
+
+  def test_users_updated(self, client):
+    from tests.tests_api import api_post
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'bursts': [{
+        'account': 'def-pi2',
+        'resource': 'cpu',
+        'pain': 2.0,
+        'firstjob': 3050,
+        'lastjob': 3200,
+        'submitters': ['user4'],
+        'summary': None
+      }],
+      'oldjobs': [{
+        'account': 'def-pi3',
+        'resource': 'cpu',
+        'age': 20,
+        'submitter': 'user5',
+        'summary': None
+      }]
+    })
+    assert response.status_code == 201
+
+    # burst submitters accumulate
+    burst = self._user_cases(client, 'user4')['bursts'][0]
+    assert burst['submitters'] == ['user4', 'user1', 'user2']
+    assert [case['id'] for case in self._user_cases(client, 'user1')['bursts']] == [burst['id']]
+
+    # old job's submitter is replaced
+    interpreted = self._user_cases(client, 'user2')
+    assert 'oldjobs' not in interpreted
+    assert [case['account'] for case in self._user_cases(client, 'user5')['oldjobs']] == ['def-pi3']
+
+class TestAccountSearch:
+
+  def _search(self, client, prefix):
+    return client.get('/xhr/search/?account={}'.format(prefix), environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+
+  def test_report(self, client):
+    from tests.tests_api import api_post
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'bursts': [
+        {
+          'account': account,
+          'resource': 'cpu',
+          'pain': 1.5,
+          'firstjob': 3000 + i * 1000,
+          'lastjob': 3100 + i * 1000,
+          'submitters': ['user1'],
+          'summary': None
+        }
+        for (i, account) in enumerate(['def-pi2', 'def-pi22', 'rrg-pi2'])
+      ],
+      'oldjobs': [{
+        'account': 'def-pi2',
+        'resource': 'gpu',
+        'age': 10,
+        'submitter': 'user2',
+        'summary': None
+      }]
+    })
+    assert response.status_code == 201
+
+  def test_search(self, client):
+    response = self._search(client, 'def-pi2')
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['account'] == 'def-pi2'
+    assert [case['account'] for case in interpreted['bursts']] == ['def-pi2', 'def-pi22']
+    assert [case['account'] for case in interpreted['oldjobs']] == ['def-pi2']
+
+    # includes cases not of the latest report
+    interpreted = json.loads(self._search(client, 'def-').data)
+    assert [case['account'] for case in interpreted['bursts']] == ['def-pi1', 'def-pi2', 'def-pi22']
+
+    # ignores case
+    interpreted = json.loads(self._search(client, 'DEF-Pi2').data)
+    assert [case['account'] for case in interpreted['bursts']] == ['def-pi2', 'def-pi22']
+
+  def test_search_wildcards_escaped(self, client):
+    response = self._search(client, 'def_pi')
+    assert response.status_code == 200
+    assert json.loads(response.data) == {'account': 'def_pi'}
+
+  def test_search_no_account(self, client):
+    response = self._search(client, '')
+    assert response.status_code == 400
+
+class TestCaseSeries:
+
+  def _series(self, client, id, query=''):
+    return client.get('/xhr/cases/{}/series{}'.format(id, query), environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+
+  def _case_id(self, client, account):
+    from manager.db import get_db
+
+    with client.application.app_context():
+      return get_db().execute("SELECT id FROM reportables WHERE account = ?", (account,)).fetchone()['id']
+
+  def test_report(self, client):
+    from tests.tests_api import api_post
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'bursts': [{
+        'account': 'def-pi3',
+        'resource': 'cpu',
+        'pain': 2.5,
+        'firstjob': 5000,
+        'lastjob': 5100,
+        'submitters': ['user1'],
+        'summary': None
+      }]
+    })
+    assert response.status_code == 201
+
+  def test_series_sampled(self, client):
+    id = self._case_id(client, 'def-pi3')
+    response = self._series(client, id)
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['metric'] == 'pain'
+    assert interpreted['resolution'] == 'raw'
+    assert [point[1] for point in interpreted['series']] == [2.5]
+
+  def test_rollup(self, client, monkeypatch):
+    from manager import metrics
+    from manager.db import get_db
+
+    app = client.application
+    with app.app_context():
+      for (epoch, value) in ((7200, 1.0), (7300, 3.0), (10800, 4.0)):
+        metrics.record_sample(900001, epoch, value)
+      get_db().commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(metrics.rollup_metrics_command)
+    assert result.exit_code == 0
+    assert "Wrote 3 hour buckets" in result.output
+    assert "Wrote 2 day buckets" in result.output
+
+    with app.app_context():
+      (resolution, series) = metrics.get_series(900001, 'hour')
+      assert resolution == 'hour'
+      assert series == [[7200, 2.0, 1.0, 3.0], [10800, 4.0, 4.0, 4.0]]
+
+      # samples before the latest buckets are rolled up when asked
+      metrics.record_sample(900001, 10900, 6.0)
+      metrics.record_sample(900001, 90000, 8.0)
+      get_db().commit()
+      metrics.rollup_metrics()
+      assert len(metrics.get_series(900001, 'hour')[1]) == 2
+      assert metrics.rollup_metrics(since=10900) == {'hour': 3, 'day': 3}
+      assert metrics.get_series(900001, 'hour')[1] == [
+        [7200, 2.0, 1.0, 3.0], [10800, 5.0, 4.0, 6.0], [90000, 8.0, 8.0, 8.0]]
+      assert metrics.get_series(900001, 'day')[1] == [
+        [0, 3.5, 1.0, 6.0], [86400, 8.0, 8.0, 8.0]]
+
+      # the finest resolution within the limit is chosen
+      assert metrics.get_series(900001)[0] == 'raw'
+      monkeypatch.setattr(metrics, 'MAX_POINTS', 3)
+      assert metrics.get_series(900001)[0] == 'hour'
+      monkeypatch.setattr(metrics, 'MAX_POINTS', 2)
+      assert metrics.get_series(900001)[0] == 'day'
+      monkeypatch.setattr(metrics, 'MAX_POINTS', 1)
+      assert metrics.get_series(900001)[0] == 'day'
+
+  def test_series_resolution(self, client):
+    id = self._case_id(client, 'def-pi3')
+    interpreted = json.loads(self._series(client, id, '?resolution=day').data)
+    assert interpreted['resolution'] == 'day'
+    assert [point[1:] for point in interpreted['series']] == [[2.5, 2.5, 2.5]]
+
+  def test_series_errors(self, client):
+    id = self._case_id(client, 'def-pi3')
+    assert self._series(client, id, '?resolution=week').status_code == 400
+    assert self._series(client, id, '?since=yesterday').status_code == 400
+    assert self._series(client, 999999).status_code == 404
+
+class TestBurstContinuation:
+
+  def _report(self, client, bursts):
+    from tests.tests_api import api_post
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'bursts': [
+        dict({'resource': 'cpu', 'pain': 1.0, 'submitters': ['user1'], 'summary': None}, **burst)
+        for burst in bursts
+      ]
+    })
+    assert response.status_code == 201
+
+  def _bursts(self, client, account):
+    from manager.db import get_db
+
+    with client.application.app_context():
+      return [
+        (rec['resource'], rec['firstjob'], rec['lastjob'], rec['ticks'])
+        for rec in get_db().execute("""
+          SELECT B.resource, B.firstjob, B.lastjob, R.ticks
+          FROM   reportables R JOIN bursts B USING (id)
+          WHERE  R.account = ?
+          ORDER  BY id""", (account,)).fetchall()
+      ]
+
+  def test_continuation(self, client):
+    self._report(client, [
+      {'account': 'def-pi4', 'firstjob': 100, 'lastjob': 200},
+      {'account': 'def-pi4', 'firstjob': 150, 'lastjob': 400},
+      {'account': 'def-pi4', 'resource': 'gpu', 'firstjob': 150, 'lastjob': 250},
+    ])
+    # second record continues the first
+    assert self._bursts(client, 'def-pi4') == [('c', 100, 400, 2), ('g', 150, 250, 1)]
+
+    self._report(client, [
+      {'account': 'def-pi4', 'firstjob': 400, 'lastjob': 500},
+      {'account': 'def-pi4', 'resource': 'gpu', 'firstjob': 260, 'lastjob': 270},
+      {'account': 'def-pi5', 'firstjob': 100, 'lastjob': 200},
+    ])
+    assert self._bursts(client, 'def-pi4') == [
+      ('c', 100, 500, 3), ('g', 150, 250, 1), ('g', 260, 270, 1)
+    ]
+    assert self._bursts(client, 'def-pi5') == [('c', 100, 200, 1)]
+
+  def test_matcher(self, client):
+    from manager.burst import _BurstMatcher, Resource
+
+    with client.application.app_context():
+      matcher = _BurstMatcher('testcluster')
+      assert matcher.match('def-pi4', Resource.CPU, 500)['lastjob'] == 500
+      assert matcher.match('def-pi4', Resource.CPU, 501) is False
+      assert matcher.match('def-pi4', Resource.GPU, 100)['lastjob'] == 250
+      assert matcher.match('def-pi4', Resource.GPU, 251)['lastjob'] == 270
+      assert matcher.match('def-pi6', Resource.CPU, 100) is False
+
+@pytest.mark.skipif(numpy is None, reason="numpy is not installed")
+class TestPendingJobs:
+
+  def jobs(self, now):
+    hour = 3600
+    return {
+      'jobid':     [501, 502, 503, 504, 505, 506],
+      'account':   ['def-pi7', 'def-pi7', 'def-pi7', 'def-pi7', 'def-pi8', 'def-pi8'],
+      'submitter': ['user1', 'user2', 'user2', 'user1', 'user3', 'user3'],
+      'resource':  ['cpu', 'cpu', 'cpu', 'gpu', 'cpu', 'cpu'],
+      'submit':    [now - 2 * hour, now - hour, now - hour, now - hour, now - hour, now + hour],
+      'request':   [4, 2, 2, 1, 1, 1],
+      'allocations': {
+        'def-pi7': {'cpu': 10, 'gpu': 2},
+        'def-pi8': {'cpu': 10},
+      }
+    }
+
+  def test_score_jobs(self, client):
+    from manager.burstscore import score_jobs
+
+    with client.application.app_context():
+      candidates = score_jobs(self.jobs(10000), 10000)
+
+    # def-pi7's gpu jobs (0.5) and def-pi8's (0.1) are below the threshold
+    assert candidates == [{
+      'account': 'def-pi7',
+      'resource': 'cpu',
+      'pain': 1.2,
+      'firstjob': 501,
+      'lastjob': 503,
+      'submitters': ['user2', 'user1'],
+      'summary': {'num_jobs': 3, 'requested': 8.0, 'longest_wait': 2.0},
+    }]
+
+  @pytest.mark.parametrize('change', [
+    {'jobid': [1]},
+    {'resource': ['cpu', 'cpu', 'cpu', 'tpu', 'cpu', 'cpu']},
+    {'allocations': {'def-pi7': {'cpu': 10}}},
+    {'submit': ['yesterday'] * 6},
+  ])
+  def test_score_jobs_invalid(self, client, change):
+    from manager.burstscore import score_jobs
+    from manager.exceptions import InvalidApiCall
+
+    with client.application.app_context():
+      with pytest.raises(InvalidApiCall):
+        score_jobs(dict(self.jobs(10000), **change), 10000)
+
+  def test_report_pending_jobs(self, client):
+    import time
+    from tests.tests_api import api_post
+    from manager.db import get_db
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'pending_jobs': self.jobs(int(time.time()))
+    })
+    assert response.status_code == 201
+
+    with client.application.app_context():
+      rec = get_db().execute("""
+        SELECT B.resource, B.firstjob, B.lastjob, B.submitters, R.summary
+        FROM   reportables R JOIN bursts B USING (id)
+        WHERE  R.account = 'def-pi7'""").fetchone()
+    assert (rec['resource'], rec['firstjob'], rec['lastjob'], rec['submitters']) == \
+      ('c', 501, 503, 'user2 user1')
+    assert json.loads(rec['summary'])['num_jobs'] == 3
+
+  def test_report_pending_jobs_invalid(self, client):
+    from tests.tests_api import api_post
+
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'pending_jobs': {'jobid': [1]}
+    })
+    assert response.status_code == 400
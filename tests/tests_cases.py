@@ -3,7 +3,7 @@
 #
 import pytest
 from manager.exceptions import AppException, BadCall
-from manager.case import just_job_id, CaseRegistry, Case
+from manager.case import just_job_id, parse_summary_filters, CaseRegistry, Case
 
 # ---------------------------------------------------------------------------
 #                                                          just_job_id()
@@ -35,6 +35,22 @@ def test_just_job_id_bad_pattern():
     just_job_id("_32")
   assert str(e.value) == "Could not parse job ID ('_32') to extract base ID"
 
+# ---------------------------------------------------------------------------
+#                                                  parse_summary_filters()
+# ---------------------------------------------------------------------------
+
+def test_parse_summary_filters():
+  assert parse_summary_filters('num_jobs>100') == [('num_jobs', '>', 100)]
+  assert parse_summary_filters('num_jobs >= 1.5, partition=gpu') == [
+    ('num_jobs', '>=', 1.5),
+    ('partition', '=', 'gpu')
+  ]
+
+def test_parse_summary_filters_invalid():
+  for text in ('num_jobs', 'num jobs>1', "num_jobs'>1", 'num_jobs>inf', ''):
+    with pytest.raises(BadCall):
+      parse_summary_filters(text)
+
 # ---------------------------------------------------------------------------
 #                                                             CaseRegistry
 # ---------------------------------------------------------------------------
@@ -116,3 +132,51 @@ def test_registry_deregister_unknown():
   """
   registry = CaseRegistry.get_registry()
   registry.deregister('reporter')
+
+# ---------------------------------------------------------------------------
+#                                                            serialization
+# ---------------------------------------------------------------------------
+
+def test_compiled_serializer():
+  """
+  Test that the serializer compiled from the declared fields includes all
+  declared attributes and serializes enumerations.
+  """
+  from manager.burst import Burst, Resource, State
+
+  burst = Burst(record={
+    'id': 4, 'ticks': 2, 'account': 'def-pi1', 'cluster': 'testcluster',
+    'epoch': 1000, 'resource': 'c', 'pain': 1.5, 'firstjob': 10,
+    'lastjob': 20, 'submitters': 'user1 user2', 'state': 'p', 'summary': None,
+    'claimant': None, 'ticket_id': None, 'ticket_no': None, 'notes': 0
+  })
+  assert not hasattr(burst, '__dict__')
+  assert burst.resource == Resource.CPU
+  assert burst.state == State.PENDING
+  assert burst.serialize() == {
+    'id': 4, 'ticks': 2, 'account': 'def-pi1', 'cluster': 'testcluster',
+    'epoch': 1000, 'resource': 'cpu', 'pain': 1.5, 'jobrange': [10, 20],
+    'submitters': ['user1', 'user2'], 'state': 'pending', 'summary': None,
+    'claimant': None, 'ticket_id': None, 'ticket_no': None,
+    'other': {'notes': 0}
+  }
+
+def test_compiled_serializer_partial():
+  """
+  Test that attributes not (yet) set are left out of the serialization.
+  """
+  # pylint: disable=protected-access
+  case = RealizedCase.__new__(RealizedCase)
+  case._id = 3
+  case._account = 'def-pi1'
+  assert case.serialize() == {'id': 3, 'account': 'def-pi1'}
+
+def test_load_unexpected_column():
+  """
+  Test that loading a record with a column outside the schema fails.
+  """
+  from manager.oldjob import OldJob
+
+  with pytest.raises(AppException) as e:
+    OldJob(record={'id': 3, 'resource': 'c', 'bogus': 1})
+  assert str(e.value) == "Unexpected column for OldJob: bogus"
@@ -1,7 +1,10 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
-from manager.db import init_db_command
+import json
+import pytest
+from manager.db import init_db_command, upgrade_db_command, get_db
+from manager.archive import archive_cases_command
 
 
 # ---------------------------------------------------------------------------
@@ -20,6 +23,13 @@ def test_init_db(empty_app):
 #  assert "Initialized and seeded the database." in result.output
 
 
+def test_upgrade_db_dry_run(client):
+  runner = client.application.test_cli_runner()
+  result = runner.invoke(upgrade_db_command, ['--dry-run'])
+  assert result.exit_code == 0
+  assert "no action needed" in result.output
+
+
 #def test_upgrade_db_none_avail(app):
 #  runner = app.test_cli_runner()
 #  result = runner.invoke(upgrade_db_command)
@@ -30,3 +40,373 @@ def test_init_db(empty_app):
 #  runner = app.test_cli_runner()
 #  result = runner.invoke(import_csv_command, ["tests/import-test.csv"])
 #  assert str(result) == '<Result okay>'
+
+
+# ---------------------------------------------------------------------------
+#                                                                  archival
+# ---------------------------------------------------------------------------
+
+class TestArchive:
+
+  # cases added to seed data: (id, epoch, claimant)
+  cases = [
+    (2, 1634316499, 'tst-003'),
+    (3, 1634316499, None),
+    (4, 1634320099, None),
+  ]
+
+  def test_archive_cases(self, client):
+    app = client.application
+    with app.app_context():
+      db = get_db()
+      for (id, epoch, claimant) in self.cases:
+        db.execute("""
+          INSERT INTO reportables (id, epoch, account, cluster, claimant)
+          VALUES (?, ?, 'def-pi1', 'testcluster', ?)""", (id, epoch, claimant))
+        db.execute("""
+          INSERT INTO bursts (id, pain, firstjob, lastjob, submitters)
+          VALUES (?, 1.0, ?, ?, 'user3')""", (id, id * 10000, id * 10000 + 10))
+      db.execute("INSERT INTO history (case_id, analyst, note, change) VALUES (3, 'tst-003', 'Note', 'null')")
+
+      # case 4 is of the latest report from the cluster
+      db.execute("""
+        INSERT INTO case_versions (cluster, casetype, serial, epoch)
+        VALUES ('testcluster', 'bursts', 1, 1634320099)""")
+      db.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(archive_cases_command, ['--days', '30', '--batch-size', '1'])
+    assert result.exit_code == 0
+    assert "Archived 2 cases from bursts" in result.output
+    assert "Archived 0 cases from oldjobs" in result.output
+
+    with app.app_context():
+      db = get_db()
+      current = [rec['id'] for rec in db.execute("SELECT id FROM reportables ORDER BY id").fetchall()]
+      archived = [rec['id'] for rec in db.execute("SELECT id FROM bursts_archive ORDER BY id").fetchall()]
+      assert current == [2, 4]
+      assert archived == [1, 3]
+      assert db.execute("SELECT COUNT(*) AS n FROM history").fetchone()['n'] == 0
+      assert db.execute("SELECT COUNT(*) AS n FROM history_archive").fetchone()['n'] == 1
+      assert [rec['case_id'] for rec in db.execute("SELECT case_id FROM case_users_archive").fetchall()] == [1]
+      assert not db.execute("SELECT case_id FROM case_users WHERE case_id = 1").fetchone()
+
+  def test_archive_by_id(self, client):
+    from manager import archive
+
+    with client.application.app_context():
+      db = get_db()
+      if db.type != 'sqlite':
+        pytest.skip("Query plans are checked in SQLite")
+
+      # each batch's rows are found through indexes on the case ID rather
+      # than by scanning the tables
+      for (name, key) in archive._tables('bursts'):
+        for sql in (
+            archive.SQL_COPY_ARCHIVED.format(name + '_archive',
+              archive._columns(name + '_archive'), name, key, '?, ?'),
+            archive.SQL_PURGE_ARCHIVED.format(name, key, '?, ?')):
+          plan = ' '.join(rec['detail'] for rec in
+            db.execute('EXPLAIN QUERY PLAN ' + sql, (1, 2)).fetchall())
+          assert 'SEARCH' in plan and 'SCAN' not in plan, plan
+
+  def test_chunks(self, monkeypatch):
+    from manager import archive
+
+    monkeypatch.setattr(archive, 'MAX_IDS', 2)
+    assert archive._chunks([1, 2, 3, 4, 5]) == [[1, 2], [3, 4], [5]]
+    assert archive._chunks([]) == []
+
+  def test_get_archived(self, client):
+    from manager.case import Case
+    from manager.burst import Burst
+
+    with client.application.test_request_context('/'):
+      case = Case.get(3)
+      assert isinstance(case, Burst)
+      assert list(case.serialize()['jobrange']) == [30000, 30010]
+      assert case.notes == 1
+      assert Case.get(5) is None
+
+    # history remains available
+    response = client.get('/', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+    response = client.get('/xhr/cases/3/events/')
+    assert response.status_code == 200
+    assert [event['text'] for event in response.get_json()] == ['Note']
+    response = client.get('/xhr/cases/3/events/?limit=1')
+    assert response.status_code == 200
+    assert [event['text'] for event in response.get_json()['events']] == ['Note']
+
+  def test_update_restores(self, client):
+    from manager.case import Case
+
+    with client.application.test_request_context('/'):
+      Case.get(3).update({'note': 'Another note'}, 'tst-003')
+      db = get_db()
+      assert db.execute("SELECT id FROM reportables WHERE id = 3").fetchone()
+      assert not db.execute("SELECT id FROM reportables_archive WHERE id = 3").fetchone()
+      assert not db.execute("SELECT id FROM bursts_archive WHERE id = 3").fetchone()
+      assert Case.get(3).notes == 2
+
+  def test_set_ticket_restores(self, client):
+    from manager.case import Case
+
+    with client.application.test_request_context('/'):
+      Case.set_ticket(1, 101, '000101')
+      case = Case.get(1)
+      assert case.ticket_no == '000101'
+      assert get_db().execute("SELECT id FROM bursts WHERE id = 1").fetchone()
+      assert get_db().execute("SELECT case_id FROM case_users WHERE case_id = 1").fetchone()
+
+    # a case with a ticket is not archived
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(archive_cases_command, ['--days', '30'])
+    assert "Archived 1 cases from bursts" in result.output
+
+class TestArchiveColumnOrder:
+
+  def test_archive_restore(self, client):
+    from manager.archive import archive_cases, restore_case
+
+    # upgraded databases list the archive tables' columns in other orders
+    with client.application.app_context():
+      db = get_db()
+      cascade = ' CASCADE' if db.type == 'postgres' else ''
+      summary = 'JSONB' if db.type == 'postgres' else 'TEXT'
+      db.execute("DROP TABLE oldjobs_archive")
+      db.execute("DROP TABLE reportables_archive" + cascade)
+      db.execute("""
+        CREATE TABLE reportables_archive (
+          id INTEGER PRIMARY KEY, epoch INTEGER NOT NULL,
+          ticks INTEGER NOT NULL DEFAULT 1, cluster VARCHAR(16) NOT NULL,
+          claimant CHAR(7), ticket_id INTEGER, ticket_no VARCHAR(9),
+          summary {}, account VARCHAR(32) NOT NULL)""".format(summary))
+      db.execute("""
+        CREATE TABLE oldjobs_archive (
+          id INTEGER PRIMARY KEY, age INTEGER NOT NULL,
+          resource CHAR(1) NOT NULL DEFAULT 'c', submitter VARCHAR(32) NOT NULL)""")
+      db.execute("""
+        INSERT INTO reportables (id, epoch, account, cluster)
+        VALUES (10, 1634316499, 'def-pi1', 'testcluster')""")
+      db.execute("""
+        INSERT INTO oldjobs (id, submitter, resource, age)
+        VALUES (10, 'user3', 'g', 12)""")
+      db.commit()
+
+      assert archive_cases('oldjobs', 1634316500) == 1
+      rec = db.execute("""
+        SELECT R.account, R.cluster, O.submitter, O.resource, O.age
+        FROM   reportables_archive R JOIN oldjobs_archive O USING (id)""").fetchone()
+      assert dict(rec) == {'account': 'def-pi1', 'cluster': 'testcluster',
+        'submitter': 'user3', 'resource': 'g', 'age': 12}
+
+      assert restore_case('oldjobs', 10)
+      rec = db.execute("""
+        SELECT R.account, R.cluster, O.submitter, O.age
+        FROM   reportables R JOIN oldjobs O USING (id) WHERE id = 10""").fetchone()
+      assert dict(rec) == {'account': 'def-pi1', 'cluster': 'testcluster',
+        'submitter': 'user3', 'age': 12}
+
+# ---------------------------------------------------------------------------
+#                                                                    export
+# ---------------------------------------------------------------------------
+
+class TestExport:
+
+  def _export(self, client, query):
+    return client.get('/xhr/export/?' + query, environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+
+  def test_setup(self, client):
+    with client.application.app_context():
+      db = get_db()
+      db.execute("INSERT INTO clusters (id, name) VALUES ('othercluster', 'Other Cluster')")
+      for (id, cluster, ticket_id) in ((2, 'testcluster', 101), (3, 'othercluster', None)):
+        db.execute("""
+          INSERT INTO reportables (id, epoch, account, cluster, ticket_id, ticket_no)
+          VALUES (?, 1634316499, 'def-pi2', ?, ?, ?)""",
+          (id, cluster, ticket_id, ticket_id and '000101'))
+        db.execute("""
+          INSERT INTO bursts (id, pain, firstjob, lastjob, submitters, resource)
+          VALUES (?, 2.0, 1, 10, 'user1 user2', 'g')""", (id,))
+      db.execute("""
+        INSERT INTO reportables_archive (id, epoch, account, cluster)
+        VALUES (4, 1634230099, 'def-pi3', 'testcluster')""")
+      db.execute("""
+        INSERT INTO bursts_archive (id, state, resource, pain, firstjob, lastjob, submitters)
+        VALUES (4, 'p', 'c', 3.0, 1, 10, 'user3')""")
+      db.execute("""
+        INSERT INTO history (case_id, analyst, note, timestamp, change)
+        VALUES (1, 'tst-003', 'First', '2021-10-15 17:00:00', NULL),
+               (1, 'tst-003', NULL, '2021-10-15 18:00:00', '{"datum": "state", "was": "pending", "now": "accepted"}')""")
+      db.commit()
+
+  def test_export_csv(self, client):
+    import csv
+    from manager.export import export_cases_command
+
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(export_cases_command, ['bursts', '--since', '2021-10-14', '--until', '2021-10-16'])
+    assert result.exit_code == 0
+    rows = list(csv.DictReader(result.output.splitlines()))
+    assert [(row['id'], row['event_note']) for row in rows] == [
+      ('1', 'First'), ('1', ''), ('2', ''), ('3', ''), ('4', '')
+    ]
+    assert rows[1]['event_change'] == '{"datum": "state", "was": "pending", "now": "accepted"}'
+    assert rows[2]['ticket_no'] == '000101'
+    assert rows[2]['resource'] == 'gpu'
+    assert rows[3]['cluster'] == 'othercluster'
+    assert rows[4]['archived'] == 'True'
+
+    # range excludes cases by their latest report
+    result = runner.invoke(export_cases_command, ['bursts', '--since', '2021-10-15', '--until', '2021-10-16'])
+    assert [row['id'] for row in csv.DictReader(result.output.splitlines())] == ['1', '1', '2', '3']
+
+  def test_export_ndjson(self, client, monkeypatch):
+    from manager import export
+
+    # batch size does not change the result
+    for size in (export.BATCH_SIZE, 1):
+      monkeypatch.setattr(export, 'BATCH_SIZE', size)
+      response = self._export(client, 'type=bursts&format=ndjson&since=2021-10-14&until=2021-10-16&cluster=testcluster')
+      assert response.status_code == 200
+      assert response.is_streamed
+      assert response.mimetype == 'application/x-ndjson'
+      cases = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+      assert [case['id'] for case in cases] == [1, 2, 4]
+      assert [event['note'] for event in cases[0]['history']] == ['First', None]
+      assert cases[0]['history'][1]['change']['now'] == 'accepted'
+      assert cases[1]['history'] == []
+      assert cases[1]['submitters'] == 'user1 user2'
+
+  def test_export_errors(self, client):
+    assert self._export(client, 'type=nothing&since=2021-10-14&until=2021-10-16').status_code == 400
+    assert self._export(client, 'type=bursts&format=xml&since=2021-10-14&until=2021-10-16').status_code == 400
+    assert self._export(client, 'type=bursts&since=2021-10-14').status_code == 400
+    assert self._export(client, 'type=bursts&since=yesterday&until=2021-10-16').status_code == 400
+
+# ---------------------------------------------------------------------------
+#                                                           schema upgrades
+# ---------------------------------------------------------------------------
+
+class TestUpgradeScripts:
+
+  script = """
+UPDATE upgrade_test SET value = 0 WHERE id = 1;
+
+-- batch: upgrade_test.id 10
+UPDATE upgrade_test SET value = value * 2
+WHERE  id >= ? AND id < ?;
+
+INSERT INTO upgrade_test (id, value) VALUES (100, 100);
+"""
+
+  def test_parse(self):
+    from manager.db import parse_upgrade_script
+
+    segments = parse_upgrade_script(self.script)
+    assert [segment.batch for segment in segments] == [None, ('upgrade_test', 'id', 10), None]
+    assert segments[1].sql == "UPDATE upgrade_test SET value = value * 2\nWHERE  id >= ? AND id < ?"
+    assert len(parse_upgrade_script("CREATE TABLE t (id INTEGER);")) == 1
+
+  def test_parse_invalid(self):
+    from manager.db import parse_upgrade_script
+    from manager.exceptions import ImpossibleSchemaUpgrade
+
+    with pytest.raises(ImpossibleSchemaUpgrade):
+      parse_upgrade_script("-- batch: upgrade_test.id 10\nUPDATE upgrade_test SET value = 1;")
+    with pytest.raises(ImpossibleSchemaUpgrade):
+      parse_upgrade_script("-- batch: upgrade_test.id 10\n")
+
+  def test_run_resumes(self, client):
+    from manager.db import _run_upgrade_script
+
+    with client.application.app_context():
+      db = get_db()
+      db.execute("CREATE TABLE upgrade_test (id INTEGER PRIMARY KEY, value INTEGER)")
+      db.executemany("INSERT INTO upgrade_test (id, value) VALUES (?, ?)",
+        [(id, id) for id in range(1, 26)])
+
+      # interrupted after the first segment and the first batch of the second
+      db.execute("INSERT INTO schema_progress (script, segment, position, completed) VALUES ('test.sql', 0, NULL, 1)")
+      db.execute("INSERT INTO schema_progress (script, segment, position, completed) VALUES ('test.sql', 1, 11, 0)")
+      db.commit()
+
+      _run_upgrade_script('test.sql', self.script)
+      values = {
+        rec['id']: rec['value']
+        for rec in db.execute("SELECT id, value FROM upgrade_test").fetchall()
+      }
+      assert values[1] == 1
+      assert values[10] == 10
+      assert [values[id] for id in (11, 25)] == [22, 50]
+      assert values[100] == 100
+      assert not db.execute("SELECT script FROM schema_progress").fetchall()
+
+  def test_run_creates_progress(self, client):
+    from manager.db import _run_upgrade_script
+
+    # scripts older than the schema adding the progress table may have batches
+    with client.application.app_context():
+      db = get_db()
+      db.execute("DROP TABLE schema_progress")
+      db.commit()
+      _run_upgrade_script('test.sql', "-- batch: upgrade_test.id 10\n"
+        "UPDATE upgrade_test SET value = value + 1 WHERE id >= ? AND id < ?;")
+      assert db.execute("SELECT value FROM upgrade_test WHERE id = 100").fetchone()['value'] == 101
+      assert not db.execute("SELECT script FROM schema_progress").fetchall()
+
+  def test_estimate(self, client, tmp_path):
+    from manager.db import estimate_upgrade
+
+    script = tmp_path / '1_to_2.sql'
+    script.write_text("""
+ALTER TABLE upgrade_test ADD COLUMN note TEXT;
+ALTER TABLE upgrade_test ALTER COLUMN value TYPE BIGINT;
+CREATE TABLE upgrade_new (id INTEGER);
+CREATE INDEX upgrade_new_idx ON upgrade_new (id);
+-- batch: upgrade_test.id 10
+UPDATE upgrade_test SET value = 1 WHERE id >= ? AND id < ?;
+""")
+    with client.application.app_context():
+      db = get_db()
+      if db.type == 'postgres':
+        db.execute("ANALYZE upgrade_test")
+      estimates = estimate_upgrade([('1', str(script))])
+      assert [(e['kind'], e['table'], e['rows'], e['batches'], e['blocking']) for e in estimates] == [
+        ('alter', 'upgrade_test', 26, None, False),
+        ('rewrite', 'upgrade_test', 26, None, True),
+        ('update', 'upgrade_test', 26, 10, False),
+      ]
+      assert estimates[0]['seconds'] == 26 / client.application.config['UPGRADE_ROWS_PER_SECOND']
+
+  def test_shipped_scripts(self):
+    import glob
+    from manager.db import parse_upgrade_script
+
+    # large data migrations of the shipped scripts are batched
+    batched = {}
+    for path in sorted(glob.glob('manager/sql/*_to_*.psql')):
+      with open(path) as f:
+        segments = parse_upgrade_script(f.read())
+      batched[path.rsplit('/', 1)[1]] = [segment.batch[0] for segment in segments if segment.batch]
+    assert batched['20261021_to_20261022.psql'] == ['reportables', 'reportables_archive']
+    assert batched['20261022_to_20261023.psql'] == ['bursts', 'oldjobs', 'bursts_archive', 'oldjobs_archive']
+    assert batched['20261024_to_20261025.psql'] == ['bursts', 'oldjobs']
+
+  def test_upgrade_graph(self, tmp_path):
+    from manager.db import _upgrade_graph
+    from manager.exceptions import ImpossibleSchemaUpgrade
+
+    (tmp_path / '1_to_2.sql').write_text('')
+    graph = _upgrade_graph(str(tmp_path), 'sql')
+    assert graph == {'1': ('2', '{}/1_to_2.sql'.format(tmp_path))}
+
+    # scripts are only found once
+    (tmp_path / '2_to_3.sql').write_text('')
+    assert _upgrade_graph(str(tmp_path), 'sql') is graph
+
+    (tmp_path / '1_to_3.psql').write_text('')
+    (tmp_path / '1_to_4.psql').write_text('')
+    with pytest.raises(ImpossibleSchemaUpgrade):
+      _upgrade_graph(str(tmp_path), 'psql')
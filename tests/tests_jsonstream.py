@@ -0,0 +1,121 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+import json
+import pytest
+from manager.jsonstream import ObjectStream, ArrayStream, JsonStreamError
+
+def chunked(text, size):
+  data = text.encode('utf-8')
+  return [data[i:i + size] for i in range(0, len(data), size)]
+
+def parse(chunks):
+  """
+  Parse members, materializing arrays.
+  """
+  return [
+    (name, list(value) if isinstance(value, ArrayStream) else value)
+    for (name, value) in ObjectStream(chunks).members()
+  ]
+
+DOCUMENT = {
+  'version': 2,
+  'bursts': [
+    {'account': 'def-pi1', 'pain': 1.25, 'firstjob': 1000, 'lastjob': 12345678},
+    {'account': 'def-pi2', 'pain': 10, 'summary': {'note': 'Üñíçødé ☃'}},
+  ],
+  'empty': [],
+  'oldjobs': [1, [2, 3], "four", None, True, 5e-3],
+}
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 4096])
+def test_members_chunk_boundaries(size):
+  """
+  Test that the document is parsed correctly however it is split into chunks,
+  including within multibyte characters and numbers.
+  """
+  text = json.dumps(DOCUMENT, ensure_ascii=False, indent=2)
+  assert parse(chunked(text, size)) == list(DOCUMENT.items())
+
+def test_members_number_split():
+  """
+  Test that a number split across chunks is not truncated.
+  """
+  assert parse([b'{"version": 1', b'23}']) == [('version', 123)]
+  assert parse([b'{"a": [1', b'2, 3', b'4]}']) == [('a', [12, 34])]
+  assert parse([b'{"a": 1.', b'5, "b": 2e', b'-', b'1}']) == [('a', 1.5), ('b', 0.2)]
+
+def test_members_empty_object():
+  assert parse([b' {  } ']) == []
+
+def test_members_unconsumed_array():
+  """
+  Test that arrays which are not iterated, or only partially, are skipped so
+  the following members are still parsed.
+  """
+  stream = ObjectStream(chunked(json.dumps(DOCUMENT), 5))
+  members = []
+  for (name, value) in stream.members():
+    members.append(name)
+    if name == 'bursts':
+      assert next(value)['account'] == 'def-pi1'
+  assert members == list(DOCUMENT)
+
+def test_members_is_lazy():
+  """
+  Test that records are parsed as they are read rather than all at once.
+  """
+  read = []
+  def chunks():
+    for chunk in [b'{"a": [', b'{"x": 1}', b', {"x": 2}', b', {"x": 3}', b']}']:
+      read.append(chunk)
+      yield chunk
+
+  for (_, value) in ObjectStream(chunks()).members():
+    assert next(value) == {'x': 1}
+    assert len(read) < 5
+    value.drain()
+
+@pytest.mark.parametrize('text', [
+  '',
+  '[]',
+  '{"a": 1',
+  '{"a": [1, 2}',
+  '{"a" 1}',
+  '{1: 2}',
+  '{"a": 1,}',
+  '{"a": 1} {}',
+  '{"a": [1 2]}',
+  '{"a": tru}',
+])
+def test_members_invalid(text):
+  with pytest.raises(JsonStreamError):
+    parse(chunked(text, 3))
+
+def test_members_invalid_utf8():
+  with pytest.raises(JsonStreamError):
+    parse([b'{"a": "\xff"}'])
+
+def test_members_invalid_not_read_further():
+  """
+  Test that an invalid record is reported without reading the rest of the
+  document.
+  """
+  read = []
+  def chunks():
+    yield b'{"a": [{"x": 1}, {"x": oops}, '
+    for _ in range(10000):
+      read.append(1)
+      yield b'{"x": 1}, ' * 100
+    yield b'{"x": 1}]}'
+
+  with pytest.raises(JsonStreamError):
+    parse(chunks())
+  assert len(read) < 5
+
+def test_members_max_value():
+  text = json.dumps({'a': ['x' * 1000, 'y']})
+  assert parse(chunked(text, 64)) == [('a', ['x' * 1000, 'y'])]
+  with pytest.raises(JsonStreamError):
+    for (_, value) in ObjectStream(chunked(text, 64), max_value=100).members():
+      list(value)
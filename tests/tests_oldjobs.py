@@ -1051,3 +1051,150 @@ def test_post_oldjobs_and_bursts_first_one_then_the_other(client, notifier):
     'beam-dev: ReportReceived: bursts on testcluster: 2 new record(s) and 0 existing.  In total there are 2 pending, 0 accepted, 0 rejected.  0 have been claimed.',
     'beam-dev: ReportReceived: oldjobs on testcluster: There are 2 cases (2 new and 0 existing).  0 are claimed.'
   ]
+
+class TestPagingOldJobs:
+
+  def test_post_oldjobs(self, client):
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'oldjobs': [
+        {
+          'account': 'def-pi{}'.format(i),
+          'resource': 'gpu' if i % 2 else 'cpu',
+          'age': 10 * i,
+          'summary': None,
+          'submitter': 'user{}'.format(i)
+        }
+        for i in range(1, 6)
+      ]})
+    assert response.status_code == 201
+
+  def test_get_counts_only(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&length=0', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['oldjobs']['total'] == 5
+    assert interpreted['oldjobs']['filtered'] == 5
+    assert interpreted['oldjobs']['results'] == []
+    assert interpreted['oldjobs']['epoch']
+
+  def test_get_page_ordered(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&draw=3&start=1&length=2'
+      '&columns[0][name]=age&columns[1][name]=account&order[0][column]=0&order[0][dir]=desc')
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['draw'] == 3
+    assert interpreted['recordsTotal'] == 5
+    assert interpreted['recordsFiltered'] == 5
+    assert [case['age'] for case in interpreted['results']] == [40, 30]
+
+  def test_get_page_column_search(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&draw=1&start=0&length=10'
+      '&columns[0][name]=resource&columns[0][search][value]=GPU&columns[1][name]=age&order[0][column]=1&order[0][dir]=asc')
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['recordsTotal'] == 5
+    assert interpreted['recordsFiltered'] == 3
+    assert [case['age'] for case in interpreted['results']] == [10, 30, 50]
+
+  def test_get_page_global_search(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&start=0&length=10&search[value]=USER4')
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['recordsFiltered'] == 1
+    assert interpreted['results'][0]['submitter'] == 'user4'
+
+  def test_get_page_search_escapes_wildcards(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&start=0&length=10&search[value]=%25')
+    assert response.status_code == 200
+    assert json.loads(response.data)['recordsFiltered'] == 0
+
+  def test_get_page_unsortable_column(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs'
+      '&columns[0][name]=summary&order[0][column]=0&order[0][dir]=asc')
+    assert response.status_code == 400
+
+  def test_get_page_unknown_column(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs'
+      '&columns[0][name]=age; DROP TABLE oldjobs&order[0][column]=0&order[0][dir]=asc')
+    assert response.status_code == 400
+
+  def test_get_page_unknown_report(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=nonsense')
+    assert response.status_code == 400
+
+class TestSummaryFilters:
+
+  def test_post_oldjobs(self, client):
+    response = api_post(client, '/api/cases/', {
+      'version': 2,
+      'oldjobs': [
+        {
+          'account': 'def-pi{}'.format(i),
+          'resource': 'cpu',
+          'age': 10 * i,
+          'summary': {'num_jobs': 50 * i, 'partition': 'gpu' if i % 2 else 'cpu'},
+          'submitter': 'user{}'.format(i)
+        }
+        for i in range(1, 6)
+      ] + [
+        {
+          'account': 'def-pi6',
+          'resource': 'cpu',
+          'age': 60,
+          'summary': {'num_jobs': 'many'},
+          'submitter': 'user6'
+        },
+        {
+          'account': 'def-pi7',
+          'resource': 'cpu',
+          'age': 70,
+          'summary': None,
+          'submitter': 'user7'
+        }
+      ]})
+    assert response.status_code == 201
+
+  def test_summary_stored(self, client):
+    response = api_get(client, '/api/cases/?report=oldjobs')
+    assert response.status_code == 200
+    summaries = {case['account']: case.get('summary') for case in json.loads(response.data)['results']}
+    assert summaries['def-pi2'] == {'num_jobs': 100, 'partition': 'cpu'}
+    assert summaries['def-pi7'] is None
+
+  def test_filter_numeric(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&start=0&length=10'
+      '&columns[0][name]=age&order[0][column]=0&order[0][dir]=asc&summary=num_jobs>100', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['recordsTotal'] == 7
+    assert interpreted['recordsFiltered'] == 3
+    assert [case['age'] for case in interpreted['results']] == [30, 40, 50]
+
+  def test_filter_combined(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&start=0&length=10'
+      '&summary=num_jobs<=150,partition=gpu', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['recordsFiltered'] == 2
+    assert sorted(case['age'] for case in interpreted['results']) == [10, 30]
+
+  def test_filter_string(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&start=0&length=10'
+      '&summary=num_jobs=many', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert [case['age'] for case in interpreted['results']] == [60]
+
+  def test_filter_api(self, client):
+    response = api_get(client, '/api/cases/?report=oldjobs&summary=partition!=gpu')
+    assert response.status_code == 200
+    interpreted = json.loads(response.data)
+    assert interpreted['filtered'] == 2
+    assert sorted(case['age'] for case in interpreted['results']) == [20, 40]
+
+  def test_filter_invalid(self, client):
+    response = client.get('/xhr/cases/?cluster=testcluster&report=oldjobs&summary=num_jobs~1', environ_base={'HTTP_X_AUTHENTICATED_USER': 'user1'})
+    assert response.status_code == 400
+    response = api_get(client, '/api/cases/?report=oldjobs&summary=num_jobs')
+    assert response.status_code == 400
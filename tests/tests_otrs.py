@@ -51,6 +51,65 @@ Best regards,
 User 1
 Compute Canada Support""")
 
+class TestTemplateCache:
+
+  def test_template_cached(self, client):
+    from manager.db import get_db
+    from manager.template import Template
+
+    with client.application.test_request_context('/'):
+      template = Template('impossible', 'en')
+
+      # cached compiled template is used rather than the changed record
+      get_db().execute("UPDATE templates_content SET title = 'Changed' WHERE template = 'impossible'")
+      cached = Template('impossible', 'en')
+      assert cached.serialize() == template.serialize()
+      cached.render({})
+      assert cached.title == "NOTICE: Your computations on [undefined] may be optimized"
+      get_db().rollback()
+
+  def test_template_cache_expires(self, client):
+    from manager.db import get_db
+    from manager.template import Template, invalidate_templates
+
+    app = client.application
+    with app.app_context():
+      invalidate_templates()
+      app.config['TEMPLATE_CACHE_TTL'] = 0
+      try:
+        Template('impossible', 'en')
+        get_db().execute("UPDATE templates_content SET title = 'Changed' WHERE template = 'impossible'")
+        assert Template('impossible', 'en').serialize()['title'] == 'Changed'
+      finally:
+        get_db().rollback()
+        app.config['TEMPLATE_CACHE_TTL'] = 300
+
+  def test_invalidate_templates(self, client):
+    from manager.db import get_db
+    from manager.template import Template, get_templates_for_case_type, invalidate_templates
+
+    with client.application.app_context():
+      Template('impossible', 'en')
+      templates = get_templates_for_case_type('bursts', 'en')
+      assert 'impossible' in [template['name'] for template in templates]
+
+      # callers may modify the list returned without affecting the cache
+      templates[0]['label'] = 'Modified'
+      assert get_templates_for_case_type('bursts', 'en')[0]['label'] != 'Modified'
+
+      get_db().execute("UPDATE templates_content SET title = 'Changed' WHERE template = 'impossible'")
+      get_db().execute("DELETE FROM appropriate_templates WHERE template = 'impossible'")
+      assert get_templates_for_case_type('bursts', 'en') != []
+      try:
+        invalidate_templates()
+        assert Template('impossible', 'en').serialize()['title'] == 'Changed'
+        assert 'impossible' not in [
+          template['name'] for template in get_templates_for_case_type('bursts', 'en')
+        ]
+      finally:
+        get_db().rollback()
+        invalidate_templates()
+
 # ---------------------------------------------------------------------------
 #                                                                OTRS TESTS
 # ---------------------------------------------------------------------------
@@ -0,0 +1,95 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Tests for partitioning of the case tables.  These apply only to partitioned
+Postgres databases and are skipped otherwise.
+"""
+
+import time
+import pytest
+from manager.db import get_db
+from manager.partition import (
+  is_partitioned, maintain_partitions, _add_months, _add_partition, _current_month,
+  _partition_months, _partition_name, MONTHS_AHEAD
+)
+from manager.case import SQL_GET_PAGE_FOR_EPOCH
+
+def _require_partitioned():
+  if not is_partitioned():
+    pytest.skip("Database is not partitioned")
+
+def test_add_months():
+  assert _add_months((2026, 10), 0) == (2026, 10)
+  assert _add_months((2026, 10), 3) == (2027, 1)
+  assert _add_months((2026, 1), -1) == (2025, 12)
+  assert _add_months((2026, 10), -22) == (2024, 12)
+
+class TestPartitions:
+
+  def test_partitions_created(self, client):
+    with client.application.app_context():
+      _require_partitioned()
+      current = _current_month()
+      for table in ('reportables', 'history'):
+        months = _partition_months(table)
+        for count in range(MONTHS_AHEAD + 1):
+          assert _add_months(current, count) in months
+
+  def test_view_prunes_partitions(self, client):
+    with client.application.app_context():
+      _require_partitioned()
+      sql = SQL_GET_PAGE_FOR_EPOCH.format('bursts', '', 'R.id', '')
+      plan = get_db().execute('EXPLAIN ' + sql, ('testcluster', int(time.time()))).fetchall()
+      plan = '\n'.join(rec['QUERY PLAN'] for rec in plan)
+      scanned = [
+        partition for partition in _partition_months('reportables').values()
+        if partition in plan
+      ]
+      assert len(scanned) == 1
+      assert 'reportables_default' not in plan
+
+  def test_maintain_partitions(self, client):
+    from manager.case import Case
+
+    app = client.application
+    with app.app_context():
+      _require_partitioned()
+      db = get_db()
+      current = _current_month()
+      epoch = int(time.time())
+
+      # add case in current month
+      db.execute("""
+        INSERT INTO reportables (id, epoch, account, cluster)
+        VALUES (1001, ?, 'def-pi1', 'testcluster')""", (epoch,))
+      db.execute("""
+        INSERT INTO bursts (id, pain, firstjob, lastjob, submitters)
+        VALUES (1001, 1.0, 100100, 100110, 'user3')""")
+      db.commit()
+
+      # create partition for an additional month ahead
+      actions = maintain_partitions(months_ahead=MONTHS_AHEAD + 1)
+      added = _partition_name('reportables', _add_months(current, MONTHS_AHEAD + 1))
+      assert "Created partition {}".format(added) in actions
+      assert maintain_partitions(months_ahead=MONTHS_AHEAD + 1) == []
+
+      # partitions with rows are kept
+      partition = _partition_name('reportables', current)
+      actions = maintain_partitions(months_ahead=0, detach_after=0)
+      assert "Kept partition {}, which still has rows".format(partition) in actions
+      assert current in _partition_months('reportables')
+      assert not db.execute("SELECT id FROM reportables_default WHERE id = 1001").fetchone()
+
+    with app.test_request_context('/'):
+      assert Case.get(1001) is not None
+
+    # empty partitions are detached and dropped
+    with app.app_context():
+      db = get_db()
+      empty = _add_partition('reportables', (2000, 1))
+      db.commit()
+      actions = maintain_partitions(months_ahead=0, detach_after=1)
+      assert "Detached partition {}".format(empty) in actions
+      assert (2000, 1) not in _partition_months('reportables')
+      assert current in _partition_months('reportables')
@@ -1,7 +1,7 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
-from manager.template import _resolve, _render, Template
+from manager.template import _resolve, _compile, _render, _render_compiled, Template
 
 # ---------------------------------------------------------------------------
 #                                                                _resolve()
@@ -41,6 +41,35 @@ def test_resolve():
   assert _resolve(d, 'raz.ma') is None
   assert _resolve(d, 'ding') == {'dang': 'doo', 'dong': 'bell'}
 
+# ---------------------------------------------------------------------------
+#                                                                _compile()
+# ---------------------------------------------------------------------------
+
+def test_compile():
+  """
+  Test that template content is compiled into literal text and variable paths,
+  and that empty or null content is retained.
+  """
+  assert _compile(None) is None
+  assert _compile('') == ''
+  assert _compile('meh') == ('meh',)
+  assert _compile('{a}') == (('a',),)
+  assert _compile('Dear {user},\n{summary.cpu} CPUs {x}{y.z}.') == (
+    'Dear ', ('user',), ',\n', ('summary', 'cpu'), ' CPUs ', ('x',), ('y', 'z'), '.'
+  )
+
+  # not variables
+  assert _compile('{} { x } {.x}') == ('{} { x } {.x}',)
+
+def test_render_compiled_reused():
+  """
+  Test that compiled content can be rendered repeatedly with different
+  values.
+  """
+  segments = _compile('{who} has {what.count}')
+  assert _render_compiled(segments, {'who': 'A', 'what': {'count': 1}}) == 'A has 1'
+  assert _render_compiled(segments, {'who': 'B'}) == 'B has [undefined]'
+
 # ---------------------------------------------------------------------------
 #                                                                 _render()
 # ---------------------------------------------------------------------------